@@ -1 +1,2 @@
-import android_tasks, build, check_tasks, customer_goals, customer_phases, customer_tasks, firefox_tasks, ie_tasks, internal_goals, internal_tasks, ios_tasks, predicates, web_tasks
+# modules defining tasks and predicates are imported on demand: see registry.py
+import lib, build, customer_goals, customer_phases, internal_goals, internal_tasks, registry
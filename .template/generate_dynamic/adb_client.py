@@ -0,0 +1,201 @@
+'''Talk to the adb server over its socket, instead of running ``adb`` for every command.
+
+The adb server (started by ``adb start-server``) listens on localhost, port 5037 unless
+``ANDROID_ADB_SERVER_PORT`` says otherwise. Each request is a 4 hex digit length followed
+by the request itself; the server answers ``OKAY``, or ``FAIL`` and a length-prefixed
+message. Requests for a device are made on a connection first switched to that device
+with ``host:transport:<serial>``.
+
+The server closes the connection after each request (or, for ``shell:``, once the
+command finishes), so every call here makes a new one: connecting to localhost is
+cheap, unlike starting an ``adb`` process.
+'''
+from collections import namedtuple
+import logging
+import os
+from os import path
+import socket
+import struct
+import time
+
+import lib
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_PORT = 5037
+# the most data a single sync DATA packet may hold
+_SYNC_DATA_MAX = 64 * 1024
+
+class AdbError(lib.BASE_EXCEPTION):
+	'The adb server, or a device, refused or failed a request'
+	pass
+
+class AdbUnavailable(AdbError):
+	'There\'s no adb server to talk to'
+	pass
+
+Device = namedtuple('Device', 'serial state properties')
+
+def _parse_devices(text):
+	'''Parse a ``host:devices-l`` device list, e.g.
+	``emulator-5554          device product:sdk model:sdk device:generic``'''
+	devices = []
+	for line in text.splitlines():
+		words = line.split()
+		if len(words) < 2:
+			continue
+		properties = dict(word.split(':', 1) for word in words[2:] if ':' in word)
+		devices.append(Device(words[0], words[1], properties))
+	return devices
+
+def _read_exactly(sock, length):
+	data = []
+	while length:
+		chunk = sock.recv(length)
+		if not chunk:
+			raise AdbError('adb server closed the connection')
+		data.append(chunk)
+		length -= len(chunk)
+	return ''.join(data)
+
+def _read_all(sock):
+	data = []
+	for chunk in iter(lambda: sock.recv(_SYNC_DATA_MAX), ''):
+		data.append(chunk)
+	return ''.join(data)
+
+class AdbClient(object):
+	def __init__(self, host='127.0.0.1', port=None, timeout=10):
+		'''
+		:param host: where the adb server is
+		:param port: its port: by default, ``ANDROID_ADB_SERVER_PORT`` or 5037
+		:param timeout: seconds to wait for any one read or write
+		'''
+		if port is None:
+			port = int(os.environ.get('ANDROID_ADB_SERVER_PORT', DEFAULT_PORT))
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+
+	def _connect(self):
+		try:
+			return socket.create_connection((self.host, self.port), self.timeout)
+		except socket.error, e:
+			raise AdbUnavailable('no adb server at {0}:{1}: {2}'.format(self.host, self.port, e))
+
+	def _request(self, sock, request):
+		'Send a request, and wait for the server to accept it'
+		sock.sendall('{0:04x}{1}'.format(len(request), request))
+		status = _read_exactly(sock, 4)
+		if status == 'OKAY':
+			return
+		if status == 'FAIL':
+			raise AdbError('{0} failed: {1}'.format(request, self._read_string(sock)))
+		raise AdbError('unexpected response to {0}: {1!r}'.format(request, status))
+
+	def _read_string(self, sock):
+		return _read_exactly(sock, int(_read_exactly(sock, 4), 16))
+
+	def _call(self, request):
+		'Run ``request(sock)`` on a new connection, turning timeouts into :class:`AdbError`'
+		sock = self._connect()
+		try:
+			return request(sock)
+		except socket.timeout:
+			raise AdbError('timed out talking to the adb server')
+		except socket.error, e:
+			raise AdbError('lost connection to the adb server: {0}'.format(e))
+		finally:
+			sock.close()
+
+	def devices(self):
+		':return: list of :class:`Device`, in every state (``device``, ``offline``, ``unauthorized``...)'
+		def request(sock):
+			self._request(sock, 'host:devices-l')
+			return _parse_devices(self._read_string(sock))
+		return self._call(request)
+
+	def wait_for_devices(self, timeout):
+		'''Wait for at least one device to be ready, as the server tells us of devices
+		coming and going
+
+		:param timeout: seconds to wait
+		:return: list of :class:`Device` ready for use (empty if none turned up in time)
+		'''
+		def request(sock):
+			deadline = time.time() + timeout
+			self._request(sock, 'host:track-devices')
+			while True:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					return []
+				sock.settimeout(remaining)
+				# the server sends the whole list at once, and again whenever it changes
+				try:
+					devices = _parse_devices(self._read_string(sock))
+				except socket.timeout:
+					return []
+				ready = [device for device in devices if device.state == 'device']
+				if ready:
+					return ready
+		return self._call(request)
+
+	def _transport(self, sock, serial):
+		self._request(sock, 'host:transport:{0}'.format(serial))
+
+	def shell(self, serial, command):
+		'''Run a shell command on a device
+
+		:param serial: which device
+		:param command: the command line, as a string
+		:return: everything the command wrote
+		'''
+		def request(sock):
+			self._transport(sock, serial)
+			self._request(sock, 'shell:{0}'.format(command))
+			return _read_all(sock)
+		LOG.debug('adb shell on {0}: {1}'.format(serial, command))
+		return self._call(request)
+
+	def push(self, serial, local, remote, mode=0644):
+		'''Copy a file to a device, using the sync protocol
+
+		:param serial: which device
+		:param local: file to copy
+		:param remote: path on the device to copy it to
+		:param mode: permissions to give it there
+		'''
+		def request(sock):
+			self._transport(sock, serial)
+			self._request(sock, 'sync:')
+			target = '{0},{1}'.format(remote, mode)
+			sock.sendall('SEND' + struct.pack('<I', len(target)) + target)
+			with open(local, 'rb') as local_file:
+				for chunk in iter(lambda: local_file.read(_SYNC_DATA_MAX), ''):
+					sock.sendall('DATA' + struct.pack('<I', len(chunk)) + chunk)
+			sock.sendall('DONE' + struct.pack('<I', int(path.getmtime(local))))
+			status, length = struct.unpack('<4sI', _read_exactly(sock, 8))
+			if status != 'OKAY':
+				message = _read_exactly(sock, length) if status == 'FAIL' else repr(status)
+				raise AdbError('pushing {0} to {1} failed: {2}'.format(local, remote, message))
+			sock.sendall('QUIT' + struct.pack('<I', 0))
+		LOG.debug('adb push to {0}: {1} -> {2}'.format(serial, local, remote))
+		self._call(request)
+
+	def install(self, serial, apk, replace=True):
+		'''Install an APK, as ``adb install`` does: push it, then run the package manager
+
+		:return: what the package manager said
+		'''
+		remote = '/data/local/tmp/{0}'.format(path.basename(apk))
+		# the package manager won't install anything not called .apk
+		if not remote.endswith('.apk'):
+			remote += '.apk'
+		self.push(serial, apk, remote)
+		try:
+			output = self.shell(serial, 'pm install {0}{1}'.format('-r ' if replace else '', remote))
+		finally:
+			self.shell(serial, 'rm {0}'.format(remote))
+		if 'Success' not in output:
+			raise AdbError('installing {0} failed: {1}'.format(apk, output.strip()))
+		return output
@@ -1,5 +1,6 @@
 from collections import namedtuple
 from getpass import getpass
+import json
 import logging
 import os
 from os import path
@@ -13,9 +14,13 @@ import time
 import urllib
 import zipfile
 
+from adb_client import AdbClient, AdbError, AdbUnavailable
+from digests import FileDigests
 import lib
 from lib import cd, task, CouldNotLocate
-from utils import run_shell
+from utils import run_shell, run_shells
+import tracing
+from zip_assembler import ZipAssembler, ZipAssemblyError
 
 LOG = logging.getLogger(__name__)
 
@@ -29,6 +34,7 @@ def _run_adb(cmd, timeout, path_info):
 		"process": None,
 		"std_out": None
 	}
+	tracing.record_subprocess(cmd)
 	def target():
 		try:
 			runner['process'] = Popen(cmd, stdout=PIPE, stderr=STDOUT)
@@ -313,6 +319,94 @@ def _create_apk_with_aapt(path_info):
 			
 	return apk_name
 
+def _digests_under(digests, *tops):
+	'''Digests of the files under each of ``tops`` (files or directories), keyed by the
+	name they have inside an APK'''
+	found = {}
+	for top in tops:
+		if path.isfile(top):
+			found[top.replace(os.sep, '/')] = digests.digest(top)
+			continue
+		for dirpath, dirnames, filenames in os.walk(top):
+			for filename in filenames:
+				name = path.join(dirpath, filename)
+				found[name.replace(os.sep, '/')] = digests.digest(name)
+	return found
+
+def _patch_apk(previous_apk, apk_name, previous_assets, assets):
+	'''Make a copy of ``previous_apk`` with the current contents of the assets which have
+	changed since, copying every other entry across as it is, still compressed
+
+	:return: number of assets re-compressed
+	'''
+	changed = 0
+	with zipfile.ZipFile(previous_apk) as source:
+		with ZipAssembler(apk_name) as out:
+			for info in source.infolist():
+				name = info.filename
+				if not name.startswith('assets/') or previous_assets.get(name) == assets.get(name):
+					out.copy_entry(source, info)
+					continue
+				with open(name, 'rb') as asset_file:
+					data = asset_file.read()
+				tracing.record_read(name, len(data))
+				# keep aapt's choice of whether to compress the entry or not
+				out.add_bytes(name, data, info.compress_type,
+						date_time=time.localtime(path.getmtime(name))[:6], external_attr=info.external_attr)
+				changed += 1
+	return changed
+
+def _create_apk(build, path_info):
+	'''Create an unsigned APK in the current directory
+
+	aapt is only run if something other than the contents of existing assets has changed
+	since the last time: otherwise the APK it made then is patched, re-compressing only
+	the assets which have changed.
+
+	:return: name of the APK
+	'''
+	cache_dir = path.join(build.output_dir, '.forge-cache', 'android')
+	state_file = path.join(cache_dir, 'apk.json')
+	previous_apk = path.join(cache_dir, 'unsigned.apk')
+	try:
+		with open(state_file) as state_in:
+			state = json.load(state_in)
+	except (IOError, ValueError):
+		state = {}
+
+	digests = FileDigests(state.get('digests'))
+	platform_apk = path.join(os.getcwd(), path.pardir, path.pardir, '.template', 'lib', 'android-platform.apk')
+	inputs = {
+		'aapt': path_info.aapt,
+		'files': _digests_under(digests, 'res', 'output', 'AndroidManifest.xml', platform_apk),
+	}
+	assets = _digests_under(digests, 'assets')
+	previous_assets = state.get('assets', {})
+
+	apk_name = None
+	# assets which have been added or removed may or may not be ignored by aapt: let it decide
+	if state.get('inputs') == inputs and set(previous_assets) == set(assets) and path.isfile(previous_apk):
+		try:
+			changed = _patch_apk(previous_apk, 'app.apk', previous_assets, assets)
+		except (zipfile.BadZipfile, ZipAssemblyError, EnvironmentError), e:
+			LOG.debug("couldn't patch previous APK, running aapt: {0}".format(e))
+		else:
+			LOG.info('Only assets changed: re-used previous APK, re-compressing {0} assets'.format(changed))
+			apk_name = 'app.apk'
+	if apk_name is None:
+		apk_name = _create_apk_with_aapt(path_info)
+
+	if not path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+	# never leave the state describing a different APK
+	if path.exists(state_file):
+		os.remove(state_file)
+	with lib.replacing(previous_apk) as tmp_file:
+		shutil.copyfile(apk_name, tmp_file)
+	with open(state_file, 'w') as state_out:
+		json.dump({'inputs': inputs, 'assets': assets, 'digests': digests.state()}, state_out)
+	return apk_name
+
 def _sign_zipf(jre, keystore, storepass, keyalias, keypass, signed_zipf_name, zipf_name):
 	lib_path = path.join(
 		os.getcwd(), path.pardir, path.pardir,
@@ -380,11 +474,13 @@ def _generate_package_name(build):
 		build.config["package_names"]["android"] = "io.trigger.forge"+build.config["uuid"]
 	return build.config["package_names"]["android"]
 	
-def _follow_log(path_info, chosen_device):
+def _follow_log(path_info, chosen_devices):
+	'Show the log of each device: prefixed with its serial number, if there\'s more than one'
 	LOG.info('Clearing android log')
-	args = [path_info.adb, '-s', chosen_device, 'logcat', '-c']
-	proc = Popen(args, stdout=sys.stdout, stderr=sys.stderr)
-	proc.wait()
+	for chosen_device in chosen_devices:
+		args = [path_info.adb, '-s', chosen_device, 'logcat', '-c']
+		proc = Popen(args, stdout=sys.stdout, stderr=sys.stderr)
+		proc.wait()
 
 	LOG.info('Showing android log')
 
@@ -392,7 +488,109 @@ def _follow_log(path_info, chosen_device):
 	# logcat, otherwise Trigger Toolkit seems to inherit some kind of lock on
 	# the android folder :(
 	os.chdir(path.abspath('/'))
-	run_shell(path_info.adb, '-s', chosen_device, 'logcat', 'WebCore:D', 'Forge:D', '*:s', command_log_level=logging.INFO)
+	if len(chosen_devices) == 1:
+		run_shell(path_info.adb, '-s', chosen_devices[0], 'logcat', 'WebCore:D', 'Forge:D', '*:s', command_log_level=logging.INFO)
+	else:
+		run_shells([
+			(chosen_device, [path_info.adb, '-s', chosen_device, 'logcat', 'WebCore:D', 'Forge:D', '*:s'])
+			for chosen_device in chosen_devices
+		], command_log_level=logging.INFO)
+
+def _choose_devices(device, available_devices):
+	'''Which of the available devices to run on
+
+	:param device: the serial number of a device, several separated by commas, or
+		``all``; if empty, the first available device is used
+	'''
+	if not device:
+		LOG.info('No android device specified, defaulting to %s' % available_devices[0])
+		return available_devices[:1]
+	if device == 'all':
+		LOG.info('Using all %d android devices: %s' % (len(available_devices), ', '.join(available_devices)))
+		return list(available_devices)
+
+	chosen_devices = [serial.strip() for serial in device.split(',') if serial.strip()]
+	missing = [serial for serial in chosen_devices if serial not in available_devices]
+	if missing:
+		LOG.error('No such device "%s"' % '", "'.join(missing))
+		LOG.error('The available devices are:')
+		LOG.error("\n".join(available_devices))
+		raise AndroidError
+	LOG.info('Using specified android device %s' % ', '.join(chosen_devices))
+	return chosen_devices
+
+def _install_and_launch(path_info, chosen_device, apk_name, package_name, purge):
+	''':return: ``(seconds taken to install, seconds taken to launch)``'''
+	start = time.time()
+	if purge:
+		_adb_shell(path_info, chosen_device, ['pm', 'uninstall', package_name], 30)
+
+	LOG.info('Installing apk on %s' % chosen_device)
+	proc_std = _install_apk(path_info, chosen_device, apk_name)
+	LOG.debug(proc_std)
+	installed = time.time()
+
+	proc_std = _adb_shell(path_info, chosen_device, ['am', 'start', '-n', package_name+'/'+package_name+'.LoadActivity'], 60)
+	LOG.debug(proc_std)
+	return installed - start, time.time() - installed
+
+def _install_and_launch_everywhere(path_info, chosen_devices, apk_name, package_name, purge):
+	'''Install and launch the app on several devices at the same time
+
+	:return: the devices it was launched on
+	'''
+	if len(chosen_devices) == 1:
+		_install_and_launch(path_info, chosen_devices[0], apk_name, package_name, purge)
+		return chosen_devices
+
+	timings = {}
+	failures = {}
+	def target(chosen_device):
+		try:
+			timings[chosen_device] = _install_and_launch(path_info, chosen_device, apk_name, package_name, purge)
+		except Exception, e:
+			LOG.error('Failed to install or launch on %s: %s' % (chosen_device, e))
+			failures[chosen_device] = sys.exc_info()
+
+	threads = [threading.Thread(target=target, args=(chosen_device,)) for chosen_device in chosen_devices]
+	for thread in threads:
+		thread.daemon = True
+		thread.start()
+	for thread in threads:
+		# joining in short steps lets KeyboardInterrupt through
+		while thread.is_alive():
+			thread.join(1)
+
+	LOG.info('Device timings:')
+	for chosen_device in chosen_devices:
+		if chosen_device in timings:
+			LOG.info('  {0}: installed in {1:.1f}s, launched in {2:.1f}s'.format(chosen_device, *timings[chosen_device]))
+		else:
+			LOG.info('  {0}: failed'.format(chosen_device))
+
+	if not timings:
+		exc_info = failures[chosen_devices[0]]
+		raise exc_info[0], exc_info[1], exc_info[2]
+	return [chosen_device for chosen_device in chosen_devices if chosen_device in timings]
+
+def _adb_shell(path_info, device, args, timeout):
+	'Run a shell command on a device, over the adb server\'s socket if we can'
+	try:
+		return AdbClient(timeout=timeout).shell(device, ' '.join(args))
+	except AdbUnavailable, e:
+		LOG.debug('{0}: using adb shell instead'.format(e))
+	except AdbError, e:
+		raise AndroidError(str(e))
+	return _run_adb([path_info.adb, '-s', device, 'shell'] + list(args), timeout, path_info)
+
+def _install_apk(path_info, device, apk_name):
+	try:
+		return AdbClient(timeout=60).install(device, apk_name)
+	except AdbUnavailable, e:
+		LOG.debug('{0}: using adb install instead'.format(e))
+	except AdbError, e:
+		raise AndroidError(str(e))
+	return _run_adb([path_info.adb, '-s', device, 'install', '-r', apk_name], 60, path_info)
 
 def _create_avd_if_necessary(path_info):
 	# Create avd
@@ -414,7 +612,21 @@ def _create_path_info_from_sdk(sdk):
 		sdk=sdk,
 	)
 	
-def _get_available_devices(path_info, try_count=0):
+def _get_available_devices(path_info):
+	'''Serial numbers of the devices ready for use, asking the adb server directly if we
+	can, and waiting a little for one to turn up if there are none'''
+	client = AdbClient()
+	try:
+		devices = [device for device in client.devices() if device.state == 'device']
+		if not devices:
+			LOG.debug('No devices found, waiting for one')
+			devices = client.wait_for_devices(timeout=6)
+		return [device.serial for device in devices]
+	except AdbUnavailable, e:
+		LOG.debug('{0}: using adb devices instead'.format(e))
+	return _get_available_devices_with_adb(path_info)
+
+def _get_available_devices_with_adb(path_info, try_count=0):
 	proc_std = _run_adb([path_info.adb, 'devices'], timeout=10, path_info=path_info)
 		
 	available_devices = _scrape_available_devices(proc_std)
@@ -424,7 +636,7 @@ def _get_available_devices(path_info, try_count=0):
 		time.sleep(2)
 		if try_count == 1:
 			_restart_adb(path_info)
-		return _get_available_devices(path_info, (try_count+1))
+		return _get_available_devices_with_adb(path_info, (try_count+1))
 	else:
 		return available_devices
 
@@ -468,22 +680,11 @@ def run_android(build, build_type_dir, sdk, device, interactive=True, purge=Fals
 			os.chdir(orig_dir)
 			return run_android(build, build_type_dir, sdk, device, interactive=interactive)
 
-		if device:
-			if device in available_devices:
-				chosen_device = device
-				LOG.info('Using specified android device %s' % chosen_device)
-			else:
-				LOG.error('No such device "%s"' % device)
-				LOG.error('The available devices are:')
-				LOG.error("\n".join(available_devices))
-				raise AndroidError
-		else:
-			chosen_device = available_devices[0]
-			LOG.info('No android device specified, defaulting to %s' % chosen_device)
+		chosen_devices = _choose_devices(device, available_devices)
 		
 		LOG.info('Creating Android .apk file')
 		#zip
-		zipf_name = _create_apk_with_aapt(path_info)
+		zipf_name = _create_apk(build, path_info)
 		signed_zipf_name = 'signed-{0}'.format(zipf_name)
 		out_apk = tempfile.mkstemp()
 		out_apk_name = out_apk[1]
@@ -500,26 +701,15 @@ def run_android(build, build_type_dir, sdk, device, interactive=True, purge=Fals
 		
 		package_name = _generate_package_name(build)
 		
-		#purge
-		if purge:
-			_run_adb([path_info.adb, 'uninstall', package_name], 30, path_info)
-
-		#install
-		LOG.info('Installing apk')
-		proc_std = _run_adb([path_info.adb, '-s', chosen_device, 'install', '-r', out_apk_name], 60, path_info)
-		LOG.debug(proc_std)
-		
-		#Delete apk
-		os.remove(out_apk_name)
-	
-		package_name = _generate_package_name(build)
-		
-		#run
-		proc_std = _run_adb([path_info.adb, '-s', chosen_device, 'shell', 'am', 'start', '-n', package_name+'/'+package_name+'.LoadActivity'], 60, path_info)
-		LOG.debug(proc_std)
+		#purge, install and run
+		try:
+			launched_devices = _install_and_launch_everywhere(path_info, chosen_devices, out_apk_name, package_name, purge)
+		finally:
+			#Delete apk
+			os.remove(out_apk_name)
 		
 		#follow log
-		_follow_log(path_info, chosen_device)
+		_follow_log(path_info, launched_devices)
 	finally:
 		pass
 
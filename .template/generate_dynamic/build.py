@@ -1,10 +1,19 @@
 import copy
 import logging
+import multiprocessing
 import os
 from os import path
 from pprint import pformat
+import sys
 
 import lib
+import plan
+import registry
+from versioned_config import VersionedDict
+from rewrite import RewriteEngine
+import scheduler
+from step_cache import StepCache
+from tracing import Tracer
 
 class ConfigurationError(lib.BASE_EXCEPTION):
 	'''Indicates there is a problem with a command.'''
@@ -40,6 +49,9 @@ class ToolConfig(dict):
 		self._flag_args = [
 			"android.purge",
 			"general.interactive",
+			"general.step_cache",
+			"general.explain_step_cache",
+			"general.fsync",
 		]
 		self._multi_value_args = [
 		]
@@ -235,8 +247,10 @@ class ToolConfig(dict):
 		return key in self
 
 class Build(object):
-	tasks = {}
-	predicates = {}
+	tasks = registry.LazyRegistry(registry.TASK_MODULES)
+	predicates = registry.LazyRegistry(registry.PREDICATE_MODULES)
+	task_resources = registry.LazyRegistry(registry.TASK_MODULES)
+	rewriting_tasks = set()
 	
 	def __init__(self, config, source_dir, output_dir, external=True, remove_attribution=False, usercode=None,
 			ignore_patterns=None, enabled_platforms=('chrome', 'firefox', 'safari', 'ie', 'android', 'web'),
@@ -280,11 +294,31 @@ class Build(object):
 		self.packaged = {} # will hold locations of packaged binaries
 		self.tool_config = ToolConfig(self.log, local_config, extra_args, self.enabled_platforms)
 		self.orig_wd = os.getcwd()
+		if self.tool_config.get('general.step_cache'):
+			self.step_cache = StepCache(
+				path.join(self.output_dir, '.forge-cache', 'steps'),
+				explain=self.tool_config.get('general.explain_step_cache', False),
+				log=self.log,
+			)
+		else:
+			self.step_cache = None
+		self.tracer = Tracer(self.log) if self.tool_config.get('general.trace') else None
+		self.rewrites = RewriteEngine(self.log, fsync=self.tool_config.get('general.fsync', False))
+		self.ignore_matchers = {} # (root, patterns) -> ignore.IgnoreMatcher
 		
+	@property
+	def config(self):
+		'''Application configuration: a :class:`versioned_config.VersionedDict`'''
+		return self._config
+
+	@config.setter
+	def config(self, config):
+		self._config = config if isinstance(config, VersionedDict) else VersionedDict(config)
+
 	def add_steps(self, steps):
 		'''Append a number of steps to the script that this runner will execute
 		
-		:param steps: a list of 5-tuple commands
+		:param steps: a list of raw 5-tuple commands
 		'''
 		self.script += steps
 		
@@ -301,39 +335,43 @@ class Build(object):
 		kw = kw or {}
 		self.log.debug('running %s(%s, %s)' % (func_name, args, kw))
 		try:
-			self.tasks[func_name](self, *args, **kw)
+			if self.tracer is not None:
+				with self.tracer.span(func_name, args, kw):
+					self._dispatch(func_name, args, kw)
+			else:
+				self._dispatch(func_name, args, kw)
 		except Exception, e:
 			self.log.error('%s while running %s(%s, %s)' % (e, func_name, args, kw))
 			raise
-	
-	def _get_predicate_functions(self, predicate_str):
-		'convert a comma-separated string of predicate names to an array of functions'
-		# predicate_str can be None - meaning do in any situation
-		# or a comma-separated list of predicate names to invoke
-		predicate_meths = []
-		if predicate_str:
-			for pred_name in [p.strip() for p in predicate_str.split(',')]:
-				if pred_name not in self.predicates:
-					raise ConfigurationError("{pred_name} has not been registered as a predicate".format(pred_name=pred_name))
-				predicate_meths.append(self.predicates[pred_name])
-		return predicate_meths
+
+	def _dispatch(self, func_name, args, kw):
+		function = self.tasks[func_name]
+		if func_name not in self.rewriting_tasks:
+			self.rewrites.flush(self._task_paths(func_name, args, kw))
+
+		if self.step_cache is not None:
+			# the step cache needs each step's outputs on disk as soon as it finishes
+			def function_then_flush(build, *args, **kw):
+				function(build, *args, **kw)
+				self.rewrites.flush()
+			self.step_cache.run(self, func_name, function_then_flush, args, kw)
+		else:
+			function(self, *args, **kw)
+
+	def _task_paths(self, func_name, args, kw):
+		'Every path a task has declared it reads or writes, or ``None`` if we don\'t know'
+		resources = self.task_resources.get(func_name)
+		if resources is None:
+			return None
+		try:
+			reads, writes = resources(self, *args, **kw)
+		except Exception:
+			return None
+		return [resource for resource in list(reads) + list(writes) if resource != scheduler.CONFIG]
 	
 	def _preprocess_script(self, script):
-		"""Pad tuples out to 5 elements and filter by predicate and platform"""
-		result = []
-		for raw_command in script:
-			# pad incomplete command with Nones (e.g. no kw supplied)
-			# 5 is expected length: platform , predicate , func_name , (args) , {kw}
-			command = list(raw_command) + [None]*(5-len(raw_command))
-			platform , predicate = command[:2]
-			
-			# "all" platform is wildcard
-			# can also configure >1 platform, comma separated, e.g. android,ios
-			if platform == 'all' or (set(platform.split(',')) & set(self.enabled_platforms)):
-				predicate_meths = self._get_predicate_functions(predicate)
-				if all(pred(self) for pred in predicate_meths):
-					result.append(tuple(command))
-		return result
+		"""Compile raw 5-tuples into :class:`plan.Step` objects, filtered by predicate and platform"""
+		return plan.compile_script(self, script, cache_dir=path.join(self.output_dir, '.forge-cache', 'plans'))
 		
 	def run(self):
 		'''Processes a declarative-ish script, describing a set of commands'''
@@ -344,12 +382,51 @@ class Build(object):
 		self.script = self._preprocess_script(self.script)
 		self.log.debug('{0} script:\n{1}'.format(self, pformat(self.script)))
 		
-		for command in self.script:
-			func_name , args , kw = command[2:]
-			self._run_task(func_name, args, kw)
+		jobs = self._jobs()
+		try:
+			if jobs > 1:
+				scheduler.run_concurrently(self, self.script, jobs)
+			else:
+				for step in self.script:
+					self._run_task(step.func_name, step.args, step.kw)
+			self.rewrites.flush()
+			self.rewrites.sync()
+		except:
+			exc_info = sys.exc_info()
+			# steps which finished have had their rewrites queued, but not necessarily
+			# written: write them, so the output is as those steps left it
+			try:
+				self.rewrites.flush()
+				self.rewrites.sync()
+			except Exception, e:
+				# don't remember steps whose output may not have been written
+				self.log.error('{0} while writing out rewrites after a failure'.format(e))
+			else:
+				if self.step_cache is not None:
+					# steps which finished are still worth remembering
+					self.step_cache.save()
+			raise exc_info[0], exc_info[1], exc_info[2]
+		else:
+			if self.step_cache is not None:
+				self.step_cache.finish()
+		finally:
+			if self.tracer is not None:
+				self.tracer.report(path.join(self.orig_wd, self.tool_config['general.trace']))
 			
 		self.log.info('{0} has finished'.format(self))
 	
+	def _jobs(self):
+		'How many steps we may run at the same time: ``general.jobs`` is a number, or "auto"'
+		jobs = self.tool_config.get('general.jobs')
+		if jobs is None:
+			return 1
+		if str(jobs).lower() == 'auto':
+			return multiprocessing.cpu_count()
+		try:
+			return max(int(jobs), 1)
+		except ValueError:
+			raise ConfigurationError("general.jobs should be a number or 'auto', not {jobs}".format(jobs=jobs))
+
 	def __repr__(self):
 		return '<ForgeTask ({0})>'.format(", ".join(self.enabled_platforms))
 
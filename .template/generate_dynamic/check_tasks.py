@@ -8,6 +8,7 @@ import sys
 
 from build import ConfigurationError
 from lib import task, BASE_EXCEPTION
+import tracing
 from utils import path_to_lib
 
 log = logging.getLogger(__name__)
@@ -28,6 +29,7 @@ def lint_javascript(build):
 	elif sys.platform.startswith("win"):
 		command = path.join(build.forge_root, "bin", "jsl.exe")
 	
+	tracing.record_subprocess([command])
 	data = subprocess.Popen(
 		[
 			command,
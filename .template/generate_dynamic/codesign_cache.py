@@ -0,0 +1,104 @@
+'''Remember which app bundles have been signed or verified, so as not to do it again.
+
+A bundle is identified by a Merkle hash of its tree: each file's digest (remembered
+against its size, inode and timestamps, so only files the build has rewritten since
+last time are read again), each symbolic link's target, and for each directory, the
+names and hashes of everything in it.
+
+After signing a bundle we record the hash of the signed tree, along with what it was
+signed with. If the bundle still has that hash next time, and would be signed with the
+same things, signing it again would change nothing.
+'''
+import hashlib
+import json
+import os
+from os import path
+import stat
+import time
+
+from digests import FileDigests
+import lib
+
+# the coarsest timestamps we expect a filesystem to keep (HFS+ keeps whole seconds, FAT two)
+_TIMESTAMP_GRANULARITY = 2
+
+class _BundleDigests(FileDigests):
+	'''File digests which are stricter about what counts as unchanged: a wrong guess
+	here means shipping an app which doesn't match its signature
+
+	Files replaced by renaming a new version over them get a new inode, and rewriting a
+	file in place changes its status change time, which unlike the modification time
+	can't be set back. A file changed twice within a filesystem's timestamp granularity
+	could still look the same, so a digest isn't saved in :meth:`state` until the file
+	has gone unchanged for longer than that, as git does with "racily clean" entries.
+	'''
+	def _key(self, stat_result):
+		return [stat_result.st_size, stat_result.st_ino, stat_result.st_mtime, stat_result.st_ctime]
+
+	def state(self):
+		settled = time.time() - _TIMESTAMP_GRANULARITY
+		return dict(
+			(filename, known) for filename, known in FileDigests.state(self).iteritems()
+			# [size, inode, modification time, status change time, digest]
+			if len(known) == 5 and max(known[2], known[3]) < settled
+		)
+
+class CodesignCache(object):
+	def __init__(self, state_file):
+		'''
+		:param state_file: where to remember what has been signed and verified
+		'''
+		self.state_file = state_file
+		try:
+			with open(state_file) as state_in:
+				state = json.load(state_in)
+		except (IOError, ValueError):
+			state = {}
+		self._digests = _BundleDigests(state.get('digests'))
+		self._signed = state.get('signed', {})
+		self._verified = state.get('verified', {})
+
+	def tree_digest(self, top):
+		'Merkle hash of everything under ``top``, not following symbolic links'
+		stat_result = os.lstat(top)
+		mode = stat_result.st_mode
+		sha = hashlib.sha1()
+		if stat.S_ISLNK(mode):
+			sha.update('link\0' + os.readlink(top))
+		elif stat.S_ISDIR(mode):
+			sha.update('dir\0')
+			for name in sorted(os.listdir(top)):
+				sha.update('{0}\0{1}\n'.format(name, self.tree_digest(path.join(top, name))))
+		else:
+			sha.update('file\0{0:o}\0{1}'.format(stat.S_IMODE(mode), self._digests.digest(top)))
+		return sha.hexdigest()
+
+	def is_signed(self, app, inputs):
+		'''Is ``app`` just as it was after we last signed it, with the same ``inputs``?
+
+		:param inputs: JSON-serialisable description of what it would be signed with
+		'''
+		known = self._signed.get(path.abspath(app))
+		return known is not None and known['inputs'] == inputs and known['tree'] == self.tree_digest(app)
+
+	def record_signed(self, app, inputs):
+		self._signed[path.abspath(app)] = {'inputs': inputs, 'tree': self.tree_digest(app)}
+
+	def is_verified(self, app):
+		'Has ``app`` been verified since it last changed?'
+		return self._verified.get(path.abspath(app)) == self.tree_digest(app)
+
+	def record_verified(self, app):
+		self._verified[path.abspath(app)] = self.tree_digest(app)
+
+	def save(self):
+		state_dir = path.dirname(self.state_file)
+		if not path.isdir(state_dir):
+			os.makedirs(state_dir)
+		with lib.replacing(self.state_file) as tmp_file:
+			with open(tmp_file, 'w') as state_out:
+				json.dump({
+					'digests': self._digests.state(),
+					'signed': self._signed,
+					'verified': self._verified,
+				}, state_out)
@@ -0,0 +1,193 @@
+'''Copy files and trees into the build, in one of several modes.
+
+Chosen with the ``general.copy_mode`` tool configuration:
+
+``copy``
+	plain copies, as :func:`shutil.copytree` and :func:`shutil.copy` make (the default)
+``reflink``
+	copy-on-write clones where the filesystem supports them (``FICLONE`` on Linux, e.g.
+	btrfs or XFS), plain copies elsewhere
+``hardlink``
+	hard links to the source files, falling back to copies across filesystems. Build
+	steps must replace files they change, rather than rewriting them in place, or they
+	would change the source too: the rewrites in :mod:`rewrite`, the step cache and
+	``set_in_biplist`` all do so
+``sync``
+	like ``rsync``: only copy files whose size, modification time or contents differ from
+	what's already at the destination, and delete anything at the destination which
+	isn't in the source
+'''
+import errno
+import logging
+import os
+from os import path
+import shutil
+
+try:
+	import fcntl
+except ImportError:
+	# e.g. on Windows
+	fcntl = None
+
+from digests import digest_file
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+MODES = ('copy', 'reflink', 'hardlink', 'sync')
+
+# from linux/fs.h: _IOW(0x94, 9, int)
+_FICLONE = 0x40049409
+# devices we've found can't clone files
+_no_reflink_devices = set()
+# what FICLONE fails with when the filesystem can't clone at all, rather than just this file
+_NO_REFLINK_ERRORS = frozenset((errno.EOPNOTSUPP, errno.ENOTTY, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)))
+
+def _reflink(src, dst):
+	'Clone ``src`` to ``dst`` if we can, copy it if we can\'t'
+	with open(src, 'rb') as in_file:
+		with open(dst, 'wb') as out_file:
+			device = os.fstat(out_file.fileno()).st_dev
+			if fcntl is not None and device not in _no_reflink_devices:
+				try:
+					fcntl.ioctl(out_file.fileno(), _FICLONE, in_file.fileno())
+					return
+				except (IOError, OSError), e:
+					# e.g. EXDEV, for a source on another filesystem, only rules out this file
+					LOG.debug("can't clone {0}: {1}".format(src, e))
+					if e.errno in _NO_REFLINK_ERRORS:
+						_no_reflink_devices.add(device)
+			shutil.copyfileobj(in_file, out_file)
+
+def _hardlink(src, dst):
+	try:
+		os.link(src, dst)
+	except OSError, e:
+		if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+			raise
+		shutil.copyfile(src, dst)
+
+def _unchanged(src, dst):
+	'Is ``dst`` already a copy of ``src``?'
+	try:
+		src_stat, dst_stat = os.stat(src), os.stat(dst)
+	except OSError:
+		return False
+	if src_stat.st_size != dst_stat.st_size:
+		return False
+	if int(src_stat.st_mtime) == int(dst_stat.st_mtime):
+		return True
+	if digest_file(src) == digest_file(dst):
+		# same contents: just bring the modification time into line for next time
+		shutil.copystat(src, dst)
+		return True
+	return False
+
+def copy_file(src, dst, mode='copy'):
+	'''Copy a file, as :func:`shutil.copy` does
+
+	:param src: file to copy
+	:param dst: file or directory to copy to
+	:param mode: one of :data:`MODES`
+	:return: ``True`` if anything was copied
+	'''
+	if path.isdir(dst):
+		dst = path.join(dst, path.basename(src))
+
+	if mode == 'sync':
+		if _unchanged(src, dst):
+			return False
+		shutil.copy2(src, dst)
+	elif mode == 'copy':
+		shutil.copy(src, dst)
+	else:
+		if path.lexists(dst):
+			os.remove(dst)
+		if mode == 'hardlink':
+			_hardlink(src, dst)
+		else:
+			_reflink(src, dst)
+			shutil.copymode(src, dst)
+
+	size = path.getsize(dst)
+	tracing.record_read(src, size)
+	tracing.record_write(dst, size)
+	return True
+
+def copy_tree(src, dst, ignore=None, mode='copy', log=None, keep=()):
+	'''Copy a directory tree, as :func:`shutil.copytree` does (following symlinks)
+
+	Except in ``sync`` mode, ``dst`` must not already exist.
+
+	:param src: directory to copy
+	:param dst: where to copy it to
+	:param ignore: as for :func:`shutil.copytree`
+	:param mode: one of :data:`MODES`
+	:param log: a :class:`logging.Logger` instance
+	:param keep: in ``sync`` mode, names (e.g. ``.git``) never to delete from ``dst``, at any level
+	:return: ``(files copied, files left alone, paths deleted)``
+	'''
+	log = log if log is not None else LOG
+	if mode == 'copy':
+		copied = [0]
+		def counting_ignore(directory, names):
+			ignored = ignore(directory, names) if ignore is not None else set()
+			copied[0] += sum(1 for name in names if name not in ignored and not path.isdir(path.join(directory, name)))
+			return ignored
+		shutil.copytree(src, dst, ignore=counting_ignore)
+		tracing.record_copy(src, dst)
+		return (copied[0], 0, 0)
+
+	counts = [0, 0, 0]
+	_copy_tree(src, dst, ignore, mode, counts, frozenset(keep))
+	log.debug('{mode} copied {0} files to {dst}, left {1} alone and deleted {2}'.format(*counts, mode=mode, dst=dst))
+	return tuple(counts)
+
+def _copy_tree(src, dst, ignore, mode, counts, keep):
+	names = os.listdir(src)
+	ignored = ignore(src, names) if ignore is not None else set()
+
+	if mode == 'sync':
+		if path.lexists(dst) and not path.isdir(dst):
+			os.remove(dst)
+			counts[2] += 1
+		if not path.isdir(dst):
+			os.makedirs(dst)
+		wanted = set(names) - set(ignored)
+		for stale in set(os.listdir(dst)) - wanted - keep:
+			stale_path = path.join(dst, stale)
+			if path.isdir(stale_path) and not path.islink(stale_path):
+				shutil.rmtree(stale_path)
+			else:
+				os.remove(stale_path)
+			counts[2] += 1
+	else:
+		os.makedirs(dst)
+
+	errors = []
+	for name in names:
+		if name in ignored:
+			continue
+		src_name, dst_name = path.join(src, name), path.join(dst, name)
+		try:
+			if path.isdir(src_name):
+				_copy_tree(src_name, dst_name, ignore, mode, counts, keep)
+				continue
+			if mode == 'sync' and path.isdir(dst_name) and not path.islink(dst_name):
+				# copy_file would copy into it
+				shutil.rmtree(dst_name)
+				counts[2] += 1
+			if copy_file(src_name, dst_name, mode):
+				counts[0] += 1
+			else:
+				counts[1] += 1
+		except shutil.Error, e:
+			errors.extend(e.args[0])
+		except EnvironmentError, e:
+			errors.append((src_name, dst_name, str(e)))
+	try:
+		shutil.copystat(src, dst)
+	except OSError, e:
+		errors.append((src, dst, str(e)))
+	if errors:
+		raise shutil.Error(errors)
@@ -1,16 +1,16 @@
-import codecs
 import glob
-import os
 from os import path
 import shutil
-import uuid
-import fnmatch
 
+import copying
 import utils
 from build import ConfigurationError
-from lib import task, walk_with_depth, read_file_as_str, cd
+from ignore import IgnoreMatcher
+from lib import task, accesses, queues_rewrites, replacing, walk_with_depth
+from scheduler import CONFIG
 
 @task
+@accesses(lambda build, **kw: ([CONFIG], [kw['from'], kw['to']]))
 def rename_files(build, **kw):
 	if 'from' not in kw or 'to' not in kw:
 		raise ConfigurationError('rename_files requires "from" and "to" keyword arguments')
@@ -18,48 +18,30 @@ def rename_files(build, **kw):
 	return _rename_or_copy_files(build, kw['from'], kw['to'], rename=True)
 
 @task
+@accesses(lambda build, **kw: ([CONFIG, kw['from']], [kw['to']]))
 def copy_files(build, **kw):
 	if 'from' not in kw or 'to' not in kw:
 		raise ConfigurationError('copy_files requires "from" and "to" keyword arguments')
 		
 	return _rename_or_copy_files(build, kw['from'], kw['to'], rename=False, ignore_patterns=kw.get('ignore_patterns'))
 
-class Pattern(object):
-	def __init__(self, type, value):
-		self.type = type
-		self.value = value
-
 def git_ignore(root, patterns):
-	classified_patterns = []
-	with cd(root):
-		for pattern in patterns:
-			if pattern:
-				if '/' in pattern[:-1]:
-					ignored_paths = (Pattern('path', match) for match in glob.glob(pattern))
-					classified_patterns.extend(ignored_paths)
-				else:
-					classified_patterns.append(Pattern('file', pattern))
-
-	def git_ignorer(src, names):
-		relative_src = src[len(root):].lstrip(r"""\/""")
-		ignored = []
-		for name in names:
-			for pattern in classified_patterns:
-				if pattern.type == 'path':
-					if path.join(relative_src, name) == os.path.normpath(pattern.value):
-						ignored.append(name)
-				elif pattern.type == 'file':
-					ignore_name = pattern.value
-					if pattern.value[-1] in ('/', '\\'):
-						if path.isdir(path.join(src, name)):
-							ignore_name = ignore_name[:-1]
-
-					if fnmatch.fnmatch(name, ignore_name):
-						ignored.append(name)
-
-		return set(ignored)
-
-	return git_ignorer
+	'Make an ignore function for :func:`shutil.copytree` from ``.forgeignore`` patterns'
+	return IgnoreMatcher(root, patterns)
+
+def _ignore_matcher(build, root, patterns):
+	'The :class:`ignore.IgnoreMatcher` for a tree, compiled once per build'
+	key = (root, tuple(patterns))
+	if key not in build.ignore_matchers:
+		build.ignore_matchers[key] = git_ignore(root, patterns)
+	return build.ignore_matchers[key]
+
+def _copy_mode(build):
+	mode = build.tool_config.get('general.copy_mode', 'copy')
+	if mode not in copying.MODES:
+		raise ConfigurationError('general.copy_mode should be one of {modes}, not "{mode}"'.format(
+			modes=', '.join(copying.MODES), mode=mode))
+	return mode
 
 @task
 def _rename_or_copy_files(build, frm, to, rename=True, ignore_patterns=None):
@@ -68,7 +50,7 @@ def _rename_or_copy_files(build, frm, to, rename=True, ignore_patterns=None):
 
 	from_, to = utils.render_string(build.config, frm), utils.render_string(build.config, to)
 	if path.isdir(from_):
-		ignore_func = git_ignore(from_, ignore_patterns)
+		ignore_func = _ignore_matcher(build, from_, ignore_patterns)
 	else:
 		ignore_func = None
 
@@ -84,14 +66,17 @@ def _rename_or_copy_files(build, frm, to, rename=True, ignore_patterns=None):
 			# don't glob in case the to path doesn't exist yet
 			tos = [to]
 		
+		mode = _copy_mode(build)
 		for found_to in tos:
-			build.log.debug('copying {from_} to {found_to}'.format(**locals()))
+			build.log.debug('copying {from_} to {found_to} ({mode})'.format(**locals()))
 			if path.isdir(from_):
-				shutil.copytree(from_, found_to, ignore=ignore_func)
+				copying.copy_tree(from_, found_to, ignore=ignore_func, mode=mode, log=build.log)
 			else:
-				shutil.copy(from_, found_to)
+				copying.copy_file(from_, found_to, mode=mode)
 
 @task
+@accesses(lambda build, *files, **kwargs: ([CONFIG], list(files)))
+@queues_rewrites
 def find_and_replace(build, *files, **kwargs):
 	'''replace one string with another in a set of files
 	
@@ -127,6 +112,8 @@ def find_and_replace(build, *files, **kwargs):
 			_replace_in_file(build, _file, find, replace)
 
 @task
+@accesses(lambda build, root_dir, *args, **kw: ([CONFIG], [root_dir]))
+@queues_rewrites
 def find_and_replace_in_dir(build, root_dir, find, replace, file_suffixes=("html",), template=False, **kw):
 	'For all files ending with one of the suffixes, under the root_dir, replace ``find`` with ``replace``'
 	if template:
@@ -149,16 +136,10 @@ def find_and_replace_in_dir(build, root_dir, find, replace, file_suffixes=("html
 
 def _replace_in_file(build, filename, find, replace):
 	build.log.debug("replacing {find} with {replace} in {filename}".format(**locals()))
-	
-	tmp_file = uuid.uuid4().hex
-	in_file_contents = read_file_as_str(filename)
-	in_file_contents = in_file_contents.replace(find, replace)
-	with codecs.open(tmp_file, 'w', encoding='utf8') as out_file:
-		out_file.write(in_file_contents)
-	os.remove(filename)
-	os.rename(tmp_file, filename)
+	build.rewrites.replace(filename, find, replace)
 
 @task
+@accesses(lambda build, filename, key, value: ([CONFIG], [filename]))
 def set_in_biplist(build, filename, key, value):
 	# biplist import must be done here, as in the server context, biplist doesn't exist
 	import biplist
@@ -175,9 +156,11 @@ def set_in_biplist(build, filename, key, value):
 	for found_file in found_files:
 		plist = biplist.readPlist(found_file)
 		plist[key] = value
-		biplist.writePlist(plist, found_file)
+		with replacing(found_file) as tmp_file:
+			biplist.writePlist(plist, tmp_file)
 
 @task
+@accesses(lambda build, *url_locations: ([], [CONFIG]))
 def resolve_urls(build, *url_locations):
 	'''Include "src" prefix for relative URLs, e.g. ``file.html`` -> ``src/file.html``
 	
@@ -189,10 +172,11 @@ def resolve_urls(build, *url_locations):
 	'''
 	def resolve_url_with_uuid(url):
 		return utils._resolve_url(build.config, url, 'src')
-	for location in url_locations:
-		build.config = utils.transform(build.config, location, resolve_url_with_uuid)
+	build.config = utils.transform_many(build.config, url_locations, resolve_url_with_uuid)
 
 @task
+@accesses(lambda build, location: ([CONFIG], [location]))
+@queues_rewrites
 def wrap_activations(build, location):
 	'''Wrap user activation code to prevent running in frames if required
 	
@@ -200,17 +184,13 @@ def wrap_activations(build, location):
 	for activation in build.config['activations']:
 		if not 'all_frames' in activation or activation['all_frames'] is False:
 			for script in activation['scripts']:
-				tmp_file = uuid.uuid4().hex
 				filename = location+script[3:]
 				build.log.debug("wrapping activation {filename}".format(**locals()))
-				in_file_contents = read_file_as_str(filename)
-				in_file_contents = 'if (forge._disableFrames === undefined || window.location == window.parent.location) {\n'+in_file_contents+'\n}';
-				with codecs.open(tmp_file, 'w', encoding='utf8') as out_file:
-					out_file.write(in_file_contents)
-				os.remove(filename)
-				os.rename(tmp_file, filename)
+				build.rewrites.wrap(filename,
+					'if (forge._disableFrames === undefined || window.location == window.parent.location) {\n', '\n}')
 		
 @task
+@accesses(lambda build, platform, icon_list: ([], [CONFIG]))
 def populate_icons(build, platform, icon_list):
 	'''
 	adds a platform's icons to a build config.
@@ -232,9 +212,11 @@ def populate_icons(build, platform, icon_list):
 		pass #no icons is valid, though it should have been caught priorly.
 
 @task
+@accesses(lambda build: ([], [CONFIG]))
 def populate_xml_safe_name(build):
 	build.config['xml_safe_name'] = build.config["name"].replace('"', '\\"').replace("'", "\\'")
 
 @task
+@accesses(lambda build: ([], [CONFIG]))
 def populate_json_safe_name(build):
 	build.config['json_safe_name'] = build.config["name"].replace('"', '\\"')
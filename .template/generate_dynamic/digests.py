@@ -0,0 +1,52 @@
+import hashlib
+import os
+import stat
+
+_CHUNK_SIZE = 64 * 1024
+
+def digest_file(filename):
+	'SHA-1 hex digest of the contents of a file'
+	sha = hashlib.sha1()
+	with open(filename, 'rb') as in_file:
+		for chunk in iter(lambda: in_file.read(_CHUNK_SIZE), ''):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+class FileDigests(object):
+	'''Digests of files, remembered against their size and modification time so
+	that files which haven't changed don't need to be read again.
+	'''
+	def __init__(self, known=None):
+		'''
+		:param known: previously saved :meth:`state`
+		'''
+		self._known = dict(known) if known else {}
+
+	def digest(self, filename):
+		'''SHA-1 digest of a regular file, or ``None`` if there is no such file'''
+		try:
+			stat_result = os.stat(filename)
+		except OSError:
+			return None
+		if not stat.S_ISREG(stat_result.st_mode):
+			return None
+
+		key = self._key(stat_result)
+		known = self._known.get(filename)
+		if known is not None and known[:-1] == key:
+			return known[-1]
+
+		digest = digest_file(filename)
+		self._known[filename] = key + [digest]
+		return digest
+
+	def _key(self, stat_result):
+		'What a file\'s digest is remembered against'
+		return [stat_result.st_size, stat_result.st_mtime]
+
+	def forget(self, filename):
+		self._known.pop(filename, None)
+
+	def state(self):
+		'JSON-serialisable state, to be passed back into the constructor next time'
+		return self._known
@@ -3,6 +3,7 @@ import shutil, glob
 from subprocess import Popen, PIPE, STDOUT
 
 from lib import cd, CouldNotLocate, task
+import tracing
 
 class IEError(Exception):
 	pass
@@ -23,6 +24,7 @@ def package_ie(build, root_dir, **kw):
 		for arch in ('x86', 'x64'):
 			nsi_filename = "setup-{arch}.nsi".format(arch=arch)
 			
+			tracing.record_subprocess(['makensis'])
 			package = Popen('makensis {nsi}'.format(nsi=path.join("dist", nsi_filename)),
 				stdout=PIPE, stderr=STDOUT, shell=True
 			)
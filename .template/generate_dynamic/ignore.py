@@ -0,0 +1,76 @@
+'''Match file names against ``.forgeignore`` patterns.
+
+Patterns follow (a subset of) ``.gitignore`` rules:
+
+* a pattern containing a ``/`` (other than at the end) is globbed relative to the root
+  of the tree, and ignores exactly the paths it finds
+* any other pattern is matched against each file and directory name, as
+  :func:`fnmatch.fnmatch` would; a pattern ending with ``/`` only matches directories
+
+An :class:`IgnoreMatcher` compiles its patterns once, into a set of exact paths and two
+combined regexes, so it can be re-used for every copy of the same tree.
+'''
+import fnmatch
+import glob
+import os
+from os import path
+import re
+
+def _combined_regex(patterns):
+	'One regex matching a name if any of the :mod:`fnmatch` patterns would'
+	if not patterns:
+		return None
+	translated = []
+	for pattern in patterns:
+		regex = fnmatch.translate(os.path.normcase(pattern))
+		# translate() anchors each pattern and sets flags: we do both once, for all of them
+		if regex.endswith('\\Z(?ms)'):
+			regex = regex[:-len('\\Z(?ms)')]
+		translated.append(regex)
+	return re.compile('(?:{0})\\Z'.format('|'.join(translated)), re.M | re.S)
+
+class IgnoreMatcher(object):
+	'''Callable suitable for the ``ignore`` argument of :func:`shutil.copytree` and
+	:func:`copying.copy_tree`'''
+	def __init__(self, root, patterns):
+		'''
+		:param root: top of the tree the patterns apply to
+		:param patterns: list of ``.forgeignore`` patterns
+		'''
+		self.root = root
+		self.paths = set()
+		names, dir_names = [], []
+		# don't chdir into root to glob: other build steps may be running concurrently
+		for pattern in patterns:
+			if not pattern:
+				continue
+			if '/' in pattern[:-1]:
+				self.paths.update(path.relpath(match, root) for match in glob.glob(path.join(root, pattern)))
+			elif pattern[-1] in ('/', '\\'):
+				dir_names.append(pattern[:-1])
+			else:
+				names.append(pattern)
+		self._names = _combined_regex(names)
+		self._dir_names = _combined_regex(dir_names)
+		self._isdir = {}
+
+	def __call__(self, src, names):
+		'Which of ``names``, in the directory ``src``, to ignore'
+		relative_src = src[len(self.root):].lstrip('\\/')
+		ignored = set()
+		for name in names:
+			if self.paths and path.join(relative_src, name) in self.paths:
+				ignored.add(name)
+				continue
+			normalised = os.path.normcase(name)
+			if self._names is not None and self._names.match(normalised):
+				ignored.add(name)
+			elif self._dir_names is not None and self._dir_names.match(normalised) and self._is_dir(path.join(src, name)):
+				ignored.add(name)
+		return ignored
+
+	def _is_dir(self, name):
+		# the same tree is copied once per platform: only look each name up once
+		if name not in self._isdir:
+			self._isdir[name] = path.isdir(name)
+		return self._isdir[name]
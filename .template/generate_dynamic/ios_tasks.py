@@ -1,18 +1,19 @@
-import codecs
 import datetime
 from glob import glob
 import logging
 import os
 from os import path
-import plistlib
 import re
 import subprocess
 import tempfile
 import time
-import uuid
 
+from codesign_cache import CodesignCache
+from digests import digest_file
+from ipa_writer import IPAWriter
 import lib
-from lib import task, read_file_as_str
+from lib import task
+from provisioning import ProfileStore, ProfileError, DEFAULT_PROFILES_DIRECTORY
 from utils import run_shell
 
 LOG = logging.getLogger(__name__)
@@ -37,6 +38,9 @@ class IOSRunner(object):
 		self.path_to_ios_build = path_to_ios_build
 
 		self.log_process = None
+		self.profiles = ProfileStore()
+		self._bundle_id_read = None
+		self.codesign_cache = CodesignCache(path.join(path_to_ios_build, '.forge-cache', 'ios', 'codesign.json'))
 
 	@staticmethod
 	def get_child_processes(target_parent_pid):
@@ -55,23 +59,27 @@ class IOSRunner(object):
 
 		return child_pids
 
-	def _grab_plist_from_binary_mess(self, file_path):
-		start_marker = '<?xml version="1.0" encoding="UTF-8"?>'
-		end_marker = '</plist>'
-		
-		with open(file_path, 'rb') as plist_file:
-			plist = plist_file.read()
-		start = plist.find(start_marker)
-		end = plist.find(end_marker)
-		if start < 0 or end < 0:
-			raise ValueError("{0} does not appear to be a valid provisioning profile".format(file_path))
-		
-		real_plist = plist[start:end+len(end_marker)]
-		return real_plist
-	
-	def _parse_plist(self, plist):
-		return plistlib.readPlistFromString(plist)
-		
+	def load_profile(self, build, provisioning_profile):
+		'The plist in a provisioning profile, as a dictionary'
+		try:
+			return self.profiles.load(path.join(build.orig_wd, provisioning_profile))
+		finally:
+			self.profiles.save()
+
+	def select_profile(self, build, distribution=None):
+		'''Find the installed provisioning profile for this app's bundle ID
+
+		:param distribution: as for :meth:`provisioning.ProfileStore.select`
+		'''
+		directory = build.tool_config.get('ios.profile.profiles_directory') or DEFAULT_PROFILES_DIRECTORY
+		try:
+			return self.profiles.select(self._bundle_id(), path.join(build.orig_wd, directory), distribution)
+		except ProfileError, e:
+			raise IOSError("You must specify a provisioning profile: "
+					"see http://current-docs.trigger.io/command-line.html#local-conf-ios ({0})".format(e))
+		finally:
+			self.profiles.save()
+
 	def _extract_seed_id(self, plist_dict):
 		'E.g. "DEADBEEDAA" from provisioning profile plist including "DEADBEEDAA.*"'
 		app_ids = plist_dict["ApplicationIdentifierPrefix"]
@@ -101,17 +109,22 @@ class IOSRunner(object):
 			raise IOError("Couldn't find the codesign command. Make sure you have xcode installed and codesign in your PATH.")
 		return stdout.strip()
 
+	def _bundle_id(self):
+		if self._bundle_id_read is None:
+			# biplist import must be done here, as in the server context, biplist doesn't exist
+			import biplist
+
+			info_plist_path = glob(self.path_to_ios_build + '/ios' + '/device-*')[0] + '/Info.plist'
+			self._bundle_id_read = biplist.readPlist(info_plist_path)['CFBundleIdentifier']
+		return self._bundle_id_read
+
 	def get_bundled_ai(self, plist_dict, path_to_ios_build):
 		'''
 		returns the application identifier, with bundle id
 		'''
-		# biplist import must be done here, as in the server context, biplist doesn't exist
-		import biplist
-		
-		info_plist_path = glob(path_to_ios_build + '/ios' + '/device-*')[0] + '/Info.plist'
 		return "%s.%s" % (
 			plist_dict['ApplicationIdentifierPrefix'][0],
-			biplist.readPlist(info_plist_path)['CFBundleIdentifier']
+			self._bundle_id(),
 		)
 
 	def check_plist_dict(self,plist_dict, path_to_ios_build):
@@ -176,6 +189,16 @@ class IOSRunner(object):
 					path=path_to_pp)
 			)
 
+		signed_with = {
+			'codesign': codesign,
+			'certificate': certificate,
+			'provisioning_profile': digest_file(path_to_pp),
+			'entitlements': digest_file(entitlements_file),
+		}
+		if self.codesign_cache.is_signed(path_to_app, signed_with):
+			LOG.info('{app} is already signed with this certificate, profile and entitlements'.format(app=app_folder_name.rstrip('/')))
+			return
+
 		try:
 			os.remove(path_to_embedded_profile)
 		except Exception:
@@ -187,6 +210,8 @@ class IOSRunner(object):
 				'--sign', certificate,
 				'--resource-rules={0}'.format(resource_rules),
 				path_to_app)
+		self.codesign_cache.record_signed(path_to_app, signed_with)
+		self.codesign_cache.save()
 
 
 	def create_ipa_from_app(self, build, provisioning_profile, certificate_to_sign_with=None, relative_path_to_itunes_artwork=None):
@@ -199,17 +224,6 @@ class IOSRunner(object):
 		:param relative_path_to_itunes_artwork: (Optional) A path to a 512x512 png picture for the App view in iTunes.
 			This should be relative to the location of the user assets.
 		"""
-		# XXX
-		# TODO: refactor _copy and _replace_in_file into common utility file
-		def _replace_in_file(filename, find, replace):
-			tmp_file = uuid.uuid4().hex
-			in_file_contents = read_file_as_str(filename)
-			in_file_contents = in_file_contents.replace(find, replace)
-			with codecs.open(tmp_file, 'w', encoding='utf8') as out_file:
-				out_file.write(in_file_contents)
-			os.remove(filename)
-			os.rename(tmp_file, filename)
-
 		LOG.info('Starting package process for iOS')
 		
 		if certificate_to_sign_with is None:
@@ -230,12 +244,16 @@ class IOSRunner(object):
 		
 		# Verify current signature
 		codesign = self._check_for_codesign()
-		run_shell(codesign, '--verify', '-vvvv', path_to_template_app)
+		if self.codesign_cache.is_verified(path_to_template_app):
+			LOG.debug('{app} is unchanged since it was last verified'.format(app=path_to_template_app))
+		else:
+			run_shell(codesign, '--verify', '-vvvv', path_to_template_app)
+			self.codesign_cache.record_verified(path_to_template_app)
+			self.codesign_cache.save()
 		
 		LOG.info('going to package: %s' % path_to_app)
 		
-		plist_str = self._grab_plist_from_binary_mess(provisioning_profile)
-		plist_dict = self._parse_plist(plist_str)
+		plist_dict = self.load_profile(build, provisioning_profile)
 		self.check_plist_dict(plist_dict, self.path_to_ios_build)
 		LOG.info("Plist OK.")
 		
@@ -248,21 +266,13 @@ class IOSRunner(object):
 		temp_dir = tempfile.mkdtemp()
 		with lib.cd(temp_dir):
 			LOG.debug('Moved into tempdir: %s' % temp_dir)
-			LOG.debug('Making Payload directory')
-			os.mkdir('Payload')
-
-			path_to_payload = path.abspath(path.join(temp_dir, 'Payload'))
-			path_to_payload_app = path.abspath(path.join(path_to_payload, app_folder_name))
-
-			if relative_path_to_itunes_artwork is not None:
-				path_to_itunes_artwork = path.join(path_to_payload_app, 'assets', 'src', relative_path_to_itunes_artwork)
-			else:
-				path_to_itunes_artwork = None
 
 			if self._is_distribution_profile(plist_dict):
 				bundle_id = self._extract_app_id(plist_dict)
 				_copy(path.join(self._lib_path(), 'template.entitlements'), temp_dir)
-				_replace_in_file(path.join(temp_dir, 'template.entitlements'), 'APP_ID', bundle_id)
+				entitlements = path.join(temp_dir, 'template.entitlements')
+				build.rewrites.replace(entitlements, 'APP_ID', bundle_id)
+				build.rewrites.flush([entitlements])
 				self._sign_app(build=build,
 						provisioning_profile=provisioning_profile,
 						certificate=certificate_to_sign_with,
@@ -274,12 +284,13 @@ class IOSRunner(object):
 						certificate=certificate_to_sign_with,
 						entitlements_file=path.join(self._lib_path(), 'dev.entitlements'),
 				)
-			_copy(path_to_app, path_to_payload)
-			
-			if path_to_itunes_artwork:
-				_copy(path_to_itunes_artwork, path.join(temp_dir, 'iTunesArtwork'))
 
-			run_shell('/usr/bin/zip', '--symlinks', '--verbose', '--recurse-paths', output_path_for_ipa, '.')
+		# straight from the signed app: no need to copy it into a Payload directory first
+		contents = [('Payload/' + app_folder_name.rstrip('/'), path_to_app)]
+		if relative_path_to_itunes_artwork is not None:
+			contents.append(('iTunesArtwork', path.join(path_to_app, 'assets', 'src', relative_path_to_itunes_artwork)))
+		writer = IPAWriter(output_path_for_ipa, path.join(self.path_to_ios_build, '.forge-cache', 'ios', 'ipa.json'))
+		writer.write(contents)
 		LOG.info("created IPA: {output}".format(output=output_path_for_ipa))
 		return output_path_for_ipa
 
@@ -369,10 +380,9 @@ def run_ios(build, device):
 	else:
 		LOG.info('Running on iOS device: {device}'.format(device=device))
 		certificate_to_sign_with = build.tool_config.get('ios.profile.developer_certificate', 'iPhone Developer')
-		provisioning_profile = build.tool_config['ios.profile.provisioning_profile']
+		provisioning_profile = build.tool_config.get('ios.profile.provisioning_profile')
 		if not provisioning_profile:
-			raise IOSError("You must specify a provisioning profile: "
-					"see http://current-docs.trigger.io/command-line.html#local-conf-ios")
+			provisioning_profile = runner.select_profile(build, distribution=False)
 
 		runner.run_idevice(
 				build=build,
@@ -382,13 +392,12 @@ def run_ios(build, device):
 
 @task
 def package_ios(build):
-	provisioning_profile = build.tool_config['ios.profile.provisioning_profile']
+	runner = IOSRunner(path.abspath('development'))
+	provisioning_profile = build.tool_config.get('ios.profile.provisioning_profile')
 	if not provisioning_profile:
-		raise IOSError("You must specify a provisioning profile: "
-				"see http://current-docs.trigger.io/command-line.html#local-conf-ios")
+		provisioning_profile = runner.select_profile(build)
 	certificate_to_sign_with = build.tool_config.get('ios.profile.developer_certificate', 'iPhone Developer') 
 
-	runner = IOSRunner(path.abspath('development'))
 	try:
 		relative_path_to_itunes_artwork = build.config['icons']['ios']['512']
 	except KeyError:
@@ -0,0 +1,206 @@
+'''Write an IPA straight from a signed ``.app`` bundle.
+
+The bundle isn't copied into a ``Payload`` directory first: each file, directory and
+symbolic link is written into the archive under ``Payload/``, with its permissions.
+Files are compressed on several threads at once (zlib lets go of the GIL), and written
+in order as they're ready.
+
+Alongside the IPA, we remember the size and modification time of every file which went
+into it. Files which are unchanged the next time are copied across from the previous IPA
+still compressed, so packaging again mostly costs as much as what has changed.
+'''
+import json
+import logging
+import multiprocessing
+import os
+from os import path
+import Queue
+import stat
+import sys
+import threading
+import time
+import zipfile
+
+from zip_assembler import ZipAssembler, compress, STORED, DEFLATED
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+# how many entries may be read and compressed ahead of the one being written, per thread
+_READ_AHEAD = 4
+# MS-DOS directory attribute, which unzip tools still look for
+_DOS_DIRECTORY = 0x10
+
+class _Entry(object):
+	__slots__ = ('name', 'filename', 'stat', 'result', 'error', 'ready')
+
+	def __init__(self, name, filename, stat_result):
+		self.name = name
+		self.filename = filename
+		self.stat = stat_result
+		# (compressed data, CRC-32, size, compression method), once ready
+		self.result = None
+		self.error = None
+		self.ready = threading.Event()
+
+	@property
+	def signature(self):
+		'What we remember about the file, to tell whether it has changed'
+		return [self.stat.st_size, self.stat.st_mtime, self.stat.st_mode]
+
+	@property
+	def date_time(self):
+		return time.localtime(self.stat.st_mtime)[:6]
+
+def _entries(top, name):
+	'''Everything under ``top``, in the order to write it, without following symbolic links
+
+	:param top: file or directory
+	:param name: what ``top`` is called in the archive
+	'''
+	stat_result = os.lstat(top)
+	if not stat.S_ISDIR(stat_result.st_mode):
+		yield _Entry(name, top, stat_result)
+		return
+	yield _Entry(name + '/', top, stat_result)
+	for child in sorted(os.listdir(top)):
+		for entry in _entries(path.join(top, child), '{0}/{1}'.format(name, child)):
+			yield entry
+
+def _compress_entry(entry):
+	mode = entry.stat.st_mode
+	if stat.S_ISLNK(mode):
+		# as zip --symlinks does: the entry holds the link's target
+		return compress(os.readlink(entry.filename), STORED) + (STORED,)
+	with open(entry.filename, 'rb') as in_file:
+		data = in_file.read()
+	tracing.record_read(entry.filename, len(data))
+	compressed, crc, size = compress(data, DEFLATED)
+	if len(compressed) >= size:
+		# already compressed (e.g. PNGs): not worth deflating
+		return data, crc, size, STORED
+	return compressed, crc, size, DEFLATED
+
+class IPAWriter(object):
+	def __init__(self, output, state_file, jobs=None, log=None):
+		'''
+		:param output: IPA to write
+		:param state_file: where to remember what went into this IPA, and find out what
+			went into the last one
+		:param jobs: how many threads to compress on (default: one per CPU)
+		:param log: a :class:`logging.Logger` instance
+		'''
+		self.output = output
+		self.state_file = state_file
+		self.jobs = jobs or multiprocessing.cpu_count()
+		self.log = log if log is not None else LOG
+
+	def _load_previous(self):
+		':return: ``(previous IPA as a ZipFile, or None; what went into it)``'
+		try:
+			with open(self.state_file) as state_in:
+				state = json.load(state_in)
+			return zipfile.ZipFile(state['ipa']), state['files']
+		except (IOError, ValueError, KeyError, zipfile.BadZipfile), e:
+			self.log.debug('not re-using a previous IPA: {0}'.format(e))
+			return None, {}
+
+	def write(self, contents):
+		'''Write the IPA
+
+		:param contents: list of ``(name in archive, file or directory)`` pairs, e.g.
+			``('Payload/Forge.app', path_to_app)``: entries for the directories a name is in
+			are added too
+		'''
+		entries = []
+		for name, top in contents:
+			parents = name.split('/')[:-1]
+			for depth in range(1, len(parents) + 1):
+				parent_name = '/'.join(parents[:depth]) + '/'
+				if not any(entry.name == parent_name for entry in entries):
+					parent = top
+					for _ in range(len(parents) - depth + 1):
+						parent = path.dirname(parent)
+					entries.append(_Entry(parent_name, parent, os.lstat(parent)))
+			entries.extend(_entries(top, name))
+		previous, previous_files = self._load_previous()
+		previous_entries = dict((info.filename, info) for info in previous.infolist()) if previous is not None else {}
+
+		def reusable(entry):
+			return (
+				entry.name in previous_entries and
+				previous_files.get(entry.name) == entry.signature and
+				stat.S_ISREG(entry.stat.st_mode)
+			)
+		to_compress = [
+			entry for entry in entries
+			if not entry.name.endswith('/') and not reusable(entry)
+		]
+
+		todo = Queue.Queue()
+		def worker():
+			while True:
+				entry = todo.get()
+				if entry is None:
+					return
+				try:
+					entry.result = _compress_entry(entry)
+				except Exception:
+					entry.error = sys.exc_info()
+				entry.ready.set()
+		workers = [threading.Thread(target=worker, name='ipa-{0}'.format(i)) for i in range(self.jobs)]
+		for thread in workers:
+			thread.daemon = True
+			thread.start()
+
+		# how many entries have been queued for compression, and how many of those written
+		progress = {'queued': 0, 'written': 0}
+		def queue_more():
+			# bound how much compressed data can be waiting to be written
+			while progress['queued'] < len(to_compress) and \
+					progress['queued'] - progress['written'] < self.jobs * _READ_AHEAD:
+				todo.put(to_compress[progress['queued']])
+				progress['queued'] += 1
+
+		reused = 0
+		succeeded = False
+		try:
+			with ZipAssembler(self.output) as out:
+				for entry in entries:
+					queue_more()
+					external_attr = (entry.stat.st_mode & 0xffff) << 16
+					if entry.name.endswith('/'):
+						out.add_compressed(entry.name, '', 0, 0, STORED, entry.date_time, external_attr | _DOS_DIRECTORY)
+					elif reusable(entry):
+						out.copy_entry(previous, previous_entries[entry.name])
+						reused += 1
+					else:
+						entry.ready.wait()
+						if entry.error is not None:
+							raise entry.error[0], entry.error[1], entry.error[2]
+						data, crc, size, method = entry.result
+						out.add_compressed(entry.name, data, crc, size, method, entry.date_time, external_attr)
+						# don't keep every file's data in memory
+						entry.result = None
+						progress['written'] += 1
+			succeeded = True
+		finally:
+			for thread in workers:
+				todo.put(None)
+			if previous is not None:
+				previous.close()
+			if not succeeded and path.exists(self.output):
+				os.remove(self.output)
+
+		tracing.record_write(self.output, path.getsize(self.output))
+		self.log.debug('wrote {0} entries to {1}: compressed {2}, re-used {3} from the previous IPA'.format(
+			len(entries), self.output, len(to_compress), reused))
+
+		state_dir = path.dirname(self.state_file)
+		if not path.isdir(state_dir):
+			os.makedirs(state_dir)
+		with open(self.state_file, 'w') as state_out:
+			json.dump({
+				'ipa': path.abspath(self.output),
+				'files': dict((entry.name, entry.signature) for entry in entries if stat.S_ISREG(entry.stat.st_mode)),
+			}, state_out)
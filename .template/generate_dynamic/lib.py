@@ -1,10 +1,10 @@
+import codecs
 from contextlib import contextmanager
 from functools import wraps
 import os
 from os import error, listdir
 from os.path import join, isdir, islink
-
-import chardet
+import threading
 
 # set up BASE_EXCEPTION early - it's relied upon by other imports
 # use ForgeError if we're on the client, so it can catch us
@@ -15,6 +15,7 @@ except ImportError:
 	BASE_EXCEPTION = Exception
 
 from build import Build
+import tracing
 
 class CouldNotLocate(Exception):
 	pass
@@ -27,6 +28,31 @@ def task(function):
 		return function(*args, **kw)
 	return wrapper
 	
+def accesses(resources):
+	'''Declare which paths a task reads and writes, so that steps which don't
+	interfere with each other can be run concurrently.
+
+	Use beneath :func:`task`.
+
+	:param resources: function taking the same arguments as the task and returning a
+		``(reads, writes)`` pair of path lists; paths may contain globs and templates,
+		and :data:`scheduler.CONFIG` stands for ``build.config``
+	'''
+	def decorator(function):
+		Build.task_resources[function.func_name] = resources
+		return function
+	return decorator
+
+def queues_rewrites(function):
+	'''Declare that a task only changes files by queueing rewrites with
+	:attr:`build.Build.rewrites`, so rewrites already queued for its files needn't be
+	written out before it runs.
+
+	Use beneath :func:`task`.
+	'''
+	Build.rewriting_tasks.add(function.func_name)
+	return function
+
 def predicate(function):
 	Build.predicates[function.func_name] = function
 	
@@ -93,9 +119,107 @@ def cd(target_dir):
 	finally:
 		os.chdir(old_dir)
 
+@contextmanager
+def replacing(filename):
+	'''Context manager giving a temporary file name to write a new version of
+	``filename`` to, which replaces ``filename`` when the context exits cleanly.
+
+	Files written like this never change other hard links to the same data.
+	'''
+	tmp_file = '{0}.{1}.tmp'.format(filename, threading.current_thread().ident)
+	try:
+		yield tmp_file
+		try:
+			os.rename(tmp_file, filename)
+		except OSError:
+			# Windows won't rename over an existing file
+			os.remove(filename)
+			os.rename(tmp_file, filename)
+	finally:
+		if os.path.exists(tmp_file):
+			os.remove(tmp_file)
+
+# longest first: the UTF-32 LE BOM starts with the UTF-16 LE one
+_BOMS = (
+	(codecs.BOM_UTF32_LE, 'utf-32'),
+	(codecs.BOM_UTF32_BE, 'utf-32'),
+	(codecs.BOM_UTF8, 'utf-8-sig'),
+	(codecs.BOM_UTF16_LE, 'utf-16'),
+	(codecs.BOM_UTF16_BE, 'utf-16'),
+)
+# how much of a file chardet gets to look at
+_DETECTION_SAMPLE = 64 * 1024
+
+# filename -> (size, mtime, encoding)
+_encodings = {}
+_encodings_lock = threading.Lock()
+
+def _detect_encoding(file_contents):
+	'''Work out what encoding some bytes are in, cheapest checks first
+
+	:return: ``(encoding, decoded contents)``
+	'''
+	for bom, encoding in _BOMS:
+		if file_contents.startswith(bom):
+			return encoding, file_contents.decode(encoding)
+	try:
+		return 'utf-8', file_contents.decode('utf-8')
+	except UnicodeDecodeError:
+		pass
+
+	# chardet import must be done here: it's slow to import and rarely needed
+	import chardet
+	encoding = chardet.detect(file_contents[:_DETECTION_SAMPLE])['encoding']
+	if encoding is not None:
+		try:
+			return encoding, file_contents.decode(encoding)
+		except (UnicodeDecodeError, LookupError):
+			pass
+	# the sample misled us: look at the whole thing
+	encoding = chardet.detect(file_contents)['encoding']
+	return encoding, file_contents.decode(encoding)
+
+def guess_encoding(filename):
+	'''The encoding of a file, if we know it already or it has a byte order mark, else ``None``
+
+	Doesn't read any more of the file than its first few bytes.
+	'''
+	stat = os.stat(filename)
+	with _encodings_lock:
+		known = _encodings.get(filename)
+	if known is not None and known[:2] == (stat.st_size, stat.st_mtime):
+		return known[2]
+	with open(filename, 'rb') as in_file:
+		start = in_file.read(4)
+	for bom, encoding in _BOMS:
+		if start.startswith(bom):
+			return encoding
+	return None
+
 def read_file_as_str(filename):
+	'''Read a file and decode it, detecting its encoding.
+
+	Detected encodings are remembered until the file changes size or modification time.
+	'''
+	return read_file_with_encoding(filename)[0]
+
+def read_file_with_encoding(filename):
+	'Like :func:`read_file_as_str`, but returns ``(decoded contents, encoding)``'
 	with open(filename, 'rb') as in_file:
+		stat = os.fstat(in_file.fileno())
 		file_contents = in_file.read()
-
-	char_result = chardet.detect(file_contents)
-	return file_contents.decode(char_result['encoding'])
+	tracing.record_read(filename, len(file_contents))
+
+	with _encodings_lock:
+		known = _encodings.get(filename)
+	if known is not None and known[:2] == (stat.st_size, stat.st_mtime):
+		try:
+			return file_contents.decode(known[2]), known[2]
+		except UnicodeDecodeError:
+			# changed without changing size or mtime
+			pass
+
+	encoding, decoded = _detect_encoding(file_contents)
+	with _encodings_lock:
+		_encodings[filename] = (stat.st_size, stat.st_mtime, encoding)
+	return decoded, encoding
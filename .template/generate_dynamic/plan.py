@@ -0,0 +1,237 @@
+'''Compile a build script of raw 5-tuples into a plan of :class:`Step` objects.
+
+Compiling pads out and parses each command once, filters by platform, evaluates
+each predicate at most once per build and drops exact duplicate steps.
+
+Compiled plans are saved, keyed by everything which can change their outcome, so
+that repeated invocations with the same script, configuration and platforms skip
+compilation entirely.
+'''
+import hashlib
+import json
+import logging
+import os
+from os import path
+import sys
+
+LOG = logging.getLogger(__name__)
+
+# bump this if the saved format changes
+_PLAN_VERSION = 2
+
+def _encode(value):
+	'''``value`` as JSON, keeping the difference between ``str`` and ``unicode``, and
+	between tuples and lists, so that tasks get the same arguments from a saved plan
+
+	:raises TypeError: for anything else JSON can't hold
+	'''
+	if isinstance(value, str):
+		try:
+			return value.decode('utf-8')
+		except UnicodeDecodeError:
+			return {'bytes': value.encode('base64')}
+	if isinstance(value, unicode):
+		return {'unicode': value}
+	if isinstance(value, tuple):
+		return {'tuple': [_encode(item) for item in value]}
+	if isinstance(value, list):
+		return [_encode(item) for item in value]
+	if isinstance(value, dict):
+		return {'dict': [[_encode(key), _encode(item)] for key, item in value.items()]}
+	if value is None or isinstance(value, (bool, int, long, float)):
+		return value
+	raise TypeError("can't save {0!r} in a plan".format(value))
+
+def _decode(raw):
+	'The value :func:`_encode` turned into ``raw``'
+	if isinstance(raw, unicode):
+		return raw.encode('utf-8')
+	if isinstance(raw, list):
+		return [_decode(item) for item in raw]
+	if isinstance(raw, dict):
+		(kind, contents), = raw.items()
+		if kind == 'bytes':
+			return contents.decode('base64')
+		if kind == 'unicode':
+			return contents
+		if kind == 'tuple':
+			return tuple(_decode(item) for item in contents)
+		if kind == 'dict':
+			return dict((_decode(key), _decode(item)) for key, item in contents)
+		raise ValueError('unknown value in plan: {0}'.format(kind))
+	return raw
+
+class Step(object):
+	'A single command in a compiled build plan'
+	__slots__ = ('platforms', 'func_name', 'args', 'kw')
+
+	def __init__(self, platforms, func_name, args=(), kw=None):
+		'''
+		:param platforms: frozenset of platform names, or ``None`` for all platforms
+		:param func_name: name of the task to run
+		:param args: positional arguments for the task
+		:param kw: keyword arguments for the task
+		'''
+		self.platforms = platforms
+		self.func_name = func_name
+		self.args = tuple(args or ())
+		self.kw = kw or {}
+
+	def identity(self):
+		'Equal for steps which do exactly the same thing'
+		platforms = sorted(self.platforms) if self.platforms is not None else None
+		return json.dumps([platforms, self.func_name, self.args, self.kw], sort_keys=True, default=repr)
+
+	def to_json(self):
+		platforms = sorted(self.platforms) if self.platforms is not None else None
+		return [_encode(platforms), _encode(self.func_name), _encode(self.args), _encode(self.kw)]
+
+	@classmethod
+	def from_json(cls, raw):
+		platforms, func_name, args, kw = [_decode(item) for item in raw]
+		return cls(frozenset(platforms) if platforms is not None else None, func_name, args, kw)
+
+	def __repr__(self):
+		platforms = ','.join(sorted(self.platforms)) if self.platforms is not None else 'all'
+		return '<Step {0}: {1}{2} {3}>'.format(platforms, self.func_name, self.args, self.kw)
+
+def _pad(raw_command):
+	'pad incomplete command with Nones (e.g. no kw supplied)'
+	# 5 is expected length: platform , predicate , func_name , (args) , {kw}
+	return list(raw_command) + [None]*(5-len(raw_command))
+
+def _predicate_names(predicate_str):
+	# predicate_str can be None - meaning do in any situation
+	# or a comma-separated list of predicate names to invoke
+	if not predicate_str:
+		return ()
+	return tuple(p.strip() for p in predicate_str.split(','))
+
+class Compiler(object):
+	def __init__(self, build):
+		self.build = build
+		self._predicate_results = {}
+
+	def compile(self, script):
+		'''Turn a list of raw 5-tuple commands into a list of :class:`Step` objects'''
+		enabled = set(self.build.enabled_platforms)
+		seen = set()
+		steps = []
+		for raw_command in script:
+			platform, predicate_str, func_name, args, kw = _pad(raw_command)
+
+			# "all" platform is wildcard
+			# can also configure >1 platform, comma separated, e.g. android,ios
+			if platform == 'all':
+				platforms = None
+			else:
+				platforms = frozenset(platform.split(','))
+				if not platforms & enabled:
+					continue
+
+			if not all(self._predicate(name) for name in _predicate_names(predicate_str)):
+				continue
+
+			step = Step(platforms, func_name, args, kw)
+			identity = step.identity()
+			if identity in seen:
+				LOG.debug('dropping duplicate step {0}'.format(step))
+				continue
+			seen.add(identity)
+			steps.append(step)
+		return steps
+
+	def load_tasks(self, steps):
+		'Import the modules defining the tasks in ``steps``, and nothing else'
+		for step in steps:
+			if step.func_name in self.build.tasks:
+				self.build.tasks[step.func_name]
+
+	def _predicate(self, name):
+		'Evaluate a predicate, at most once per build'
+		if name not in self._predicate_results:
+			self._predicate_results[name] = bool(self._predicate_function(name)(self.build))
+		return self._predicate_results[name]
+
+	def _predicate_function(self, name):
+		# leave this import here: build imports us
+		from build import ConfigurationError
+		if name not in self.build.predicates:
+			raise ConfigurationError("{pred_name} has not been registered as a predicate".format(pred_name=name))
+		return self.build.predicates[name]
+
+	def cache_key(self, script):
+		'''Digest of everything which could change the result of compiling ``script``'''
+		build = self.build
+		predicate_code = {}
+		for raw_command in script:
+			for name in _predicate_names(_pad(raw_command)[1]):
+				# the whole module: predicates call helpers, and use module-level constants
+				predicate_code[name] = _module_digest(self._predicate_function(name))
+
+		key = [
+			_PLAN_VERSION,
+			[_pad(raw_command) for raw_command in script],
+			build.config,
+			sorted(build.enabled_platforms),
+			bool(build.template_only),
+			bool(build.external),
+			sys.platform,
+			build.tool_config.all_config(),
+			predicate_code,
+		]
+		return hashlib.sha1(json.dumps(key, sort_keys=True, default=repr)).hexdigest()
+
+_module_digests = {}
+
+def _module_digest(function):
+	'''Digest of the source of the module defining ``function`` (or, if we can't find
+	that, of its own code)'''
+	module_name = function.__module__
+	if module_name not in _module_digests:
+		filename = getattr(sys.modules.get(module_name), '__file__', None)
+		if filename is not None and filename.endswith(('.pyc', '.pyo')):
+			filename = filename[:-1]
+		try:
+			with open(filename, 'rb') as source:
+				_module_digests[module_name] = hashlib.sha1(source.read()).hexdigest()
+		except (IOError, TypeError):
+			code = function.func_code
+			return hashlib.sha1(code.co_code + repr(code.co_consts)).hexdigest()
+	return _module_digests[module_name]
+
+def compile_script(build, script, cache_dir=None):
+	'''Compile a script for a build, re-using a previously saved plan if there is one.
+
+	:param build: the :class:`build.Build` the script belongs to
+	:param script: list of raw 5-tuple commands
+	:param cache_dir: where to save and look for compiled plans (``None``: don't)
+	'''
+	compiler = Compiler(build)
+	if cache_dir is None:
+		steps = compiler.compile(script)
+		compiler.load_tasks(steps)
+		return steps
+
+	plan_file = path.join(cache_dir, '{0}.json'.format(compiler.cache_key(script)))
+	try:
+		with open(plan_file) as plan_in:
+			steps = [Step.from_json(raw) for raw in json.load(plan_in)]
+		LOG.debug('using compiled plan {0}'.format(plan_file))
+		compiler.load_tasks(steps)
+		return steps
+	except (IOError, ValueError, TypeError):
+		pass
+
+	steps = compiler.compile(script)
+	try:
+		# before opening the file, so nothing is left half-written if a step can't be saved
+		saved = [step.to_json() for step in steps]
+		if not path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		with open(plan_file, 'w') as plan_out:
+			json.dump(saved, plan_out)
+	except (IOError, OSError, TypeError), e:
+		LOG.debug("couldn't save compiled plan: {0}".format(e))
+	compiler.load_tasks(steps)
+	return steps
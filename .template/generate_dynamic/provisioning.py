@@ -0,0 +1,203 @@
+'''Find and read iOS provisioning profiles, without parsing any profile twice.
+
+A ``.mobileprovision`` file is a signed blob with an XML plist inside it. A
+:class:`ProfileStore` keeps what we need from each profile it has read in an index
+file, against the profile's path, modification time and size, so a profile is only
+parsed again once it changes. The profiles in a directory are also indexed by the
+application identifier they're for, so the profile for a bundle ID can be found
+without looking at every profile: CI machines can have hundreds installed.
+'''
+import calendar
+import datetime
+import json
+import logging
+import os
+from os import path
+import plistlib
+import threading
+
+import lib
+
+LOG = logging.getLogger(__name__)
+
+# where Xcode installs profiles
+DEFAULT_PROFILES_DIRECTORY = path.expanduser(path.join('~', 'Library', 'MobileDevice', 'Provisioning Profiles'))
+DEFAULT_INDEX_FILE = path.expanduser(path.join('~', '.forge', 'provisioning-profiles.json'))
+# bump whenever what we keep about a profile changes
+_INDEX_VERSION = 1
+
+_START_MARKER = '<?xml version="1.0" encoding="UTF-8"?>'
+_END_MARKER = '</plist>'
+
+class ProfileError(lib.BASE_EXCEPTION):
+	pass
+
+def extract_plist(file_path):
+	'The XML plist inside a provisioning profile, as a string'
+	with open(file_path, 'rb') as profile_file:
+		profile = profile_file.read()
+	start = profile.find(_START_MARKER)
+	end = profile.find(_END_MARKER)
+	if start < 0 or end < 0:
+		raise ValueError("{0} does not appear to be a valid provisioning profile".format(file_path))
+	return profile[start:end + len(_END_MARKER)]
+
+def _plain(value):
+	'``value`` as something JSON can hold'
+	if isinstance(value, dict):
+		return dict((key, _plain(item)) for key, item in value.iteritems())
+	if isinstance(value, (list, tuple)):
+		return [_plain(item) for item in value]
+	if isinstance(value, datetime.datetime):
+		return calendar.timegm(value.utctimetuple())
+	if isinstance(value, plistlib.Data):
+		return value.data.encode('base64')
+	return value
+
+def _summarise(plist_dict):
+	'The parts of a profile\'s plist we use'
+	summary = {
+		'Name': plist_dict.get('Name'),
+		'UUID': plist_dict.get('UUID'),
+		'ApplicationIdentifierPrefix': plist_dict.get('ApplicationIdentifierPrefix', []),
+		'Entitlements': _plain(plist_dict.get('Entitlements', {})),
+		'ExpirationDate': _plain(plist_dict['ExpirationDate']),
+	}
+	if 'ProvisionedDevices' in plist_dict:
+		summary['ProvisionedDevices'] = plist_dict['ProvisionedDevices']
+	return summary
+
+def _as_plist_dict(summary):
+	'A summary, with the same keys and types :mod:`plistlib` would give us'
+	plist_dict = dict(summary)
+	plist_dict['ExpirationDate'] = datetime.datetime.utcfromtimestamp(summary['ExpirationDate'])
+	return plist_dict
+
+def _bundle_part(application_identifier):
+	'E.g. "io.trigger.forge.app" from "DEADBEEFAA.io.trigger.forge.app"'
+	return application_identifier.split('.', 1)[1] if '.' in application_identifier else application_identifier
+
+class ProfileStore(object):
+	def __init__(self, index_file=DEFAULT_INDEX_FILE):
+		'''
+		:param index_file: where to keep what we know about profiles between runs
+		'''
+		self.index_file = index_file
+		self._lock = threading.Lock()
+		self._changed = False
+		try:
+			with open(index_file) as index_in:
+				index = json.load(index_in)
+			if index.get('version') != _INDEX_VERSION:
+				raise ValueError('index version {0}'.format(index.get('version')))
+			self._profiles = index['profiles']
+		except (IOError, ValueError, KeyError), e:
+			LOG.debug('starting a new provisioning profile index: {0}'.format(e))
+			self._profiles = {}
+		# directory -> bundle part of application identifier -> list of profile paths
+		self._by_app_id = {}
+
+	def load(self, file_path):
+		'''Read a provisioning profile (or remember what it said, if it hasn't changed)
+
+		:return: the profile's plist, as a dictionary with (at least) the keys ``Name``,
+			``UUID``, ``ApplicationIdentifierPrefix``, ``Entitlements``, ``ExpirationDate``
+			and, for development profiles, ``ProvisionedDevices``
+		'''
+		file_path = path.abspath(file_path)
+		stat_result = os.stat(file_path)
+		key = [stat_result.st_mtime, stat_result.st_size]
+		with self._lock:
+			known = self._profiles.get(file_path)
+		if known is not None and known['key'] == key:
+			return _as_plist_dict(known['profile'])
+
+		LOG.debug('reading provisioning profile {0}'.format(file_path))
+		summary = _summarise(plistlib.readPlistFromString(extract_plist(file_path)))
+		with self._lock:
+			self._profiles[file_path] = {'key': key, 'profile': summary}
+			self._changed = True
+		return _as_plist_dict(summary)
+
+	def _index_directory(self, directory):
+		directory = path.abspath(directory)
+		if directory in self._by_app_id:
+			return self._by_app_id[directory]
+
+		by_app_id = {}
+		try:
+			names = os.listdir(directory)
+		except OSError, e:
+			LOG.debug("can't look for provisioning profiles in {0}: {1}".format(directory, e))
+			names = []
+		for name in names:
+			if not name.endswith('.mobileprovision'):
+				continue
+			file_path = path.join(directory, name)
+			try:
+				profile = self.load(file_path)
+			except (EnvironmentError, ValueError, KeyError), e:
+				LOG.debug('ignoring {0}: {1}'.format(file_path, e))
+				continue
+			app_id = profile['Entitlements'].get('application-identifier')
+			if app_id:
+				by_app_id.setdefault(_bundle_part(app_id), []).append(file_path)
+
+		# forget profiles which have been deleted
+		with self._lock:
+			for file_path in list(self._profiles):
+				if path.dirname(file_path) == directory and not path.isfile(file_path):
+					del self._profiles[file_path]
+					self._changed = True
+		self._by_app_id[directory] = by_app_id
+		return by_app_id
+
+	def select(self, bundle_id, directory=DEFAULT_PROFILES_DIRECTORY, distribution=None):
+		'''The best profile in ``directory`` for an app
+
+		An exact match for the bundle ID is preferred to a wildcard one (``io.trigger.*``
+		before ``*``); after that, the profile which expires last.
+
+		:param bundle_id: e.g. ``io.trigger.forge.app``
+		:param distribution: ``True`` for distribution profiles only, ``False`` for
+			development ones only, ``None`` for either
+		:return: path to the profile
+		'''
+		by_app_id = self._index_directory(directory)
+		now = datetime.datetime.utcnow()
+
+		parts = bundle_id.split('.')
+		candidates = [bundle_id] + ['.'.join(parts[:i] + ['*']) for i in range(len(parts) - 1, -1, -1)]
+		for candidate in candidates:
+			usable = []
+			for file_path in by_app_id.get(candidate, []):
+				profile = self.load(file_path)
+				if profile['ExpirationDate'] < now:
+					continue
+				if distribution is not None and distribution == ('ProvisionedDevices' in profile):
+					continue
+				usable.append((profile['ExpirationDate'], file_path))
+			if usable:
+				chosen = max(usable)[1]
+				LOG.info('Using provisioning profile {0} for {1}'.format(chosen, bundle_id))
+				return chosen
+
+		raise ProfileError("Couldn't find a{kind} provisioning profile for {bundle_id} in {directory}".format(
+			kind={True: ' distribution', False: ' development', None: ''}[distribution],
+			bundle_id=bundle_id,
+			directory=directory,
+		))
+
+	def save(self):
+		'Write the index out, if it has changed'
+		with self._lock:
+			if not self._changed:
+				return
+			index = {'version': _INDEX_VERSION, 'profiles': self._profiles}
+			self._changed = False
+		index_dir = path.dirname(self.index_file)
+		if not path.isdir(index_dir):
+			os.makedirs(index_dir)
+		with lib.replacing(self.index_file) as tmp_file:
+			with open(tmp_file, 'w') as index_out:
+				json.dump(index, index_out)
@@ -0,0 +1,97 @@
+'''Lazily import the modules which define tasks and predicates.
+
+Tasks and predicates register themselves with the ``@task`` and ``@predicate``
+decorators when their module is imported. Rather than importing every platform's
+module (and its dependencies) up front, the registries on :class:`build.Build` use the
+static manifest below to import a module the first time one of its names is looked up.
+
+Keep the manifest up to date when adding a task or predicate: :func:`verify` will
+tell you if it isn't.
+'''
+import logging
+
+LOG = logging.getLogger(__name__)
+
+_TASKS_BY_MODULE = {
+	'android_tasks': ('clean_android', 'run_android', 'package_android'),
+	'check_tasks': ('lint_javascript', 'check_local_config_schema'),
+	'customer_tasks': (
+		'rename_files', 'copy_files', '_rename_or_copy_files', 'find_and_replace', 'find_and_replace_in_dir',
+		'set_in_biplist', 'resolve_urls', 'wrap_activations', 'populate_icons', 'populate_xml_safe_name',
+		'populate_json_safe_name',
+	),
+	'firefox_tasks': ('clean_firefox', 'run_firefox'),
+	'ie_tasks': ('package_ie',),
+	'ios_tasks': ('run_ios', 'package_ios'),
+	'web_tasks': ('clean_web', 'run_web', 'package_web'),
+}
+
+_PREDICATES_BY_MODULE = {
+	'predicates': (
+		'is_external', 'have_safari_icons', 'have_android_icons', 'have_firefox_icons', 'have_ios_icons',
+		'have_ios_launch', 'have_android_launch', 'include_user', 'include_affiliate', 'include_gmail',
+		'include_jquery', 'disable_orientation_iphone_portrait_up', 'disable_orientation_iphone_portrait_down',
+		'disable_orientation_iphone_landscape_left', 'disable_orientation_iphone_landscape_right',
+		'disable_orientation_ipad_portrait_up', 'disable_orientation_ipad_portrait_down',
+		'disable_orientation_ipad_landscape_left', 'disable_orientation_ipad_landscape_right',
+		'partner_parse_enabled', 'partner_parse_disabled', 'module_topbar_enabled', 'is_osx',
+	),
+}
+
+def _invert(by_module):
+	return dict((name, module) for module, names in by_module.items() for name in names)
+
+TASK_MODULES = _invert(_TASKS_BY_MODULE)
+PREDICATE_MODULES = _invert(_PREDICATES_BY_MODULE)
+
+def _import(module_name):
+	LOG.debug('importing {0}'.format(module_name))
+	# relative to this package
+	__import__(module_name, globals(), locals(), [], -1)
+
+class LazyRegistry(dict):
+	'''A ``name -> function`` mapping which imports the module defining a name
+	(according to ``manifest``) the first time it's looked up'''
+	def __init__(self, manifest):
+		super(LazyRegistry, self).__init__()
+		self.manifest = manifest
+
+	def __missing__(self, name):
+		module_name = self.manifest.get(name)
+		if module_name is None:
+			raise KeyError(name)
+		_import(module_name)
+		# the import will have registered it, if the manifest is right (task_resources
+		# only has tasks which declare their resources)
+		if not dict.__contains__(self, name):
+			raise KeyError(name)
+		return dict.__getitem__(self, name)
+
+	def __contains__(self, name):
+		return dict.__contains__(self, name) or name in self.manifest
+
+	def has_key(self, name):
+		return name in self
+
+	def get(self, name, default=None):
+		try:
+			return self[name]
+		except KeyError:
+			return default
+
+def verify(build_class):
+	'''Import every module in the manifests, and check they register exactly what the manifests say
+
+	:return: a list of problems (empty if all is well)
+	'''
+	problems = []
+	for by_module, registry in ((_TASKS_BY_MODULE, build_class.tasks), (_PREDICATES_BY_MODULE, build_class.predicates)):
+		for module_name in by_module:
+			_import(module_name)
+		for name, module_name in _invert(by_module).items():
+			if not dict.__contains__(registry, name):
+				problems.append('{0} is in the manifest for {1}, which does not register it'.format(name, module_name))
+		for name, function in dict.items(registry):
+			if name not in registry.manifest:
+				problems.append('{0} from {1} is missing from the manifest'.format(name, function.__module__))
+	return problems
@@ -0,0 +1,316 @@
+'''Batch up the rewrites build steps make to files.
+
+``find_and_replace``, ``find_and_replace_in_dir`` and ``wrap_activations`` don't
+touch the disk: they queue rules with :class:`RewriteEngine`. A file's queued rules
+are applied in one go, and the file written once, just before another step might
+look at it (according to its declared resources), or at the end of the build.
+
+Rules are applied in the order they were queued. Runs of consecutive replacements
+which can't interfere with each other (no match of one can overlap a match of, or
+the text inserted by, another) are done together, in a single scan of the file.
+
+Large files are never read into memory in one go: a memory-mapped scan skips those
+which don't contain anything to replace, and the rest are rewritten a chunk at a
+time, keeping back enough text at the end of each chunk to catch matches which span
+two chunks.
+
+Files are replaced by renaming a new version over them. With ``general.fsync``, all
+the files rewritten are flushed to disk together at the end of the build.
+'''
+import codecs
+import errno
+import logging
+import mmap
+import os
+from os import path
+import re
+import threading
+
+import lib
+from scheduler import static_prefix, any_overlap
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+# files at least this big are rewritten a chunk at a time
+_STREAMING_SIZE = 1024 * 1024
+_CHUNK_SIZE = 256 * 1024
+# encodings in which an ASCII string is always encoded as the same bytes
+_NOT_ASCII_COMPATIBLE = ('utf-16', 'utf-32')
+
+class _Replace(object):
+	__slots__ = ('find', 'replace')
+
+	def __init__(self, find, replace):
+		self.find = find
+		self.replace = replace
+
+class _Wrap(object):
+	__slots__ = ('before', 'after')
+
+	def __init__(self, before, after):
+		self.before = before
+		self.after = after
+
+	def apply(self, text):
+		return self.before + text + self.after
+
+	def stream(self, chunks):
+		yield self.before
+		for chunk in chunks:
+			yield chunk
+		yield self.after
+
+def _can_overlap(first, second):
+	'Could an occurrence of ``first`` share any characters with an occurrence of ``second``?'
+	if first in second or second in first:
+		return True
+	shortest = min(len(first), len(second))
+	return any(first.endswith(second[:i]) or second.endswith(first[:i]) for i in range(1, shortest))
+
+def _independent(replace, earlier):
+	'Would applying ``replace`` at the same time as the ``earlier`` replacements give the same result?'
+	return not any(
+		_can_overlap(replace.find, other.find) or _can_overlap(replace.find, other.replace)
+		for other in earlier
+	)
+
+def _stream_sub(regex, replacement, longest, chunks):
+	'''Like ``regex.sub(replacement, ''.join(chunks))``, a chunk at a time, for a regex
+	matching literal strings no longer than ``longest``'''
+	pending = u''
+	for chunk in chunks:
+		pending += chunk
+		# a match starting before here must be complete
+		cut = len(pending) - (longest - 1)
+		if cut <= 0:
+			continue
+		out = []
+		position = 0
+		for match in regex.finditer(pending):
+			if match.start() >= cut:
+				break
+			out.append(pending[position:match.start()])
+			out.append(replacement(match))
+			position = match.end()
+		end = max(position, cut)
+		out.append(pending[position:end])
+		pending = pending[end:]
+		yield u''.join(out)
+	yield regex.sub(replacement, pending)
+
+class _MultiReplace(object):
+	'Several independent replacements, done in one scan'
+	def __init__(self, replaces):
+		self.replacements = dict((r.find, r.replace) for r in replaces)
+		self.regex = re.compile('|'.join(re.escape(find) for find in self.replacements))
+		self.needles = tuple(self.replacements)
+
+	def _replacement(self, match):
+		return self.replacements[match.group(0)]
+
+	def apply(self, text):
+		return self.regex.sub(self._replacement, text)
+
+	def stream(self, chunks):
+		return _stream_sub(self.regex, self._replacement, max(len(needle) for needle in self.needles), chunks)
+
+class _SingleReplace(object):
+	def __init__(self, replace):
+		self.find = replace.find
+		self.replace = replace.replace
+		self.needles = (self.find,)
+
+	def apply(self, text):
+		return text.replace(self.find, self.replace)
+
+	def stream(self, chunks):
+		# a function, so that backslashes in the replacement aren't treated specially
+		return _stream_sub(re.compile(re.escape(self.find)), lambda match: self.replace, len(self.find), chunks)
+
+def _streamable(rewrite_pass):
+	'''Can ``rewrite_pass`` be applied a chunk at a time? Not if it replaces the empty
+	string, which would match at each chunk boundary twice'''
+	return hasattr(rewrite_pass, 'stream') and all(getattr(rewrite_pass, 'needles', ()))
+
+def _contains_any(filename, needles):
+	'Do the bytes of ``filename`` contain any of ``needles``?'
+	with open(filename, 'rb') as in_file:
+		if os.fstat(in_file.fileno()).st_size == 0:
+			return False
+		mapped = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			return any(mapped.find(needle) != -1 for needle in needles)
+		finally:
+			mapped.close()
+
+def _fsync(name):
+	try:
+		fd = os.open(name, os.O_RDONLY)
+	except OSError:
+		# e.g. directories on Windows
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+class RewriteEngine(object):
+	def __init__(self, log=None, fsync=False):
+		'''
+		:param log: a :class:`logging.Logger` instance
+		:param fsync: remember which files we write, so that :meth:`sync` can flush them to disk
+		'''
+		self.log = log if log is not None else LOG
+		self.fsync = fsync
+		self._written = set()
+		# file name -> list of rules, in the order they were queued
+		self._pending = {}
+		self._lock = threading.Lock()
+		# tuple of replacements -> compiled passes: the same rules are often queued for many files
+		self._passes = {}
+
+	def replace(self, filename, find, replace):
+		'Queue replacing every occurrence of ``find`` with ``replace`` in ``filename``'
+		self._queue(filename, _Replace(find, replace))
+
+	def wrap(self, filename, before, after):
+		'Queue surrounding the contents of ``filename`` with ``before`` and ``after``'
+		self._queue(filename, _Wrap(before, after))
+
+	def _queue(self, filename, rule):
+		# complain now, rather than when some later step causes the rewrite to happen
+		if not path.isfile(filename):
+			raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+		with self._lock:
+			self._pending.setdefault(filename, []).append(rule)
+
+	def flush(self, resources=None):
+		'''Apply and write out queued rewrites
+
+		:param resources: only those to files under these paths (as declared with
+			:func:`lib.accesses`); ``None``: all of them
+		'''
+		with self._lock:
+			if resources is None:
+				filenames = list(self._pending)
+			else:
+				prefixes = [static_prefix(resource) for resource in resources]
+				filenames = [name for name in self._pending if any_overlap([static_prefix(name)], prefixes)]
+			work = [(name, self._pending.pop(name)) for name in filenames]
+
+		for filename, rules in work:
+			self._rewrite(filename, rules)
+
+	def sync(self):
+		'Flush every file written so far (and the directories they\'re in) to disk'
+		with self._lock:
+			written, self._written = self._written, set()
+		if not written:
+			return
+		self.log.debug('syncing {0} rewritten files'.format(len(written)))
+		for name in sorted(written) + sorted(set(path.dirname(path.abspath(name)) for name in written)):
+			_fsync(name)
+
+	def _rewrite(self, filename, rules):
+		self.log.debug('applying {0} rewrites to {1}'.format(len(rules), filename))
+		passes = self._compile(rules)
+		if path.getsize(filename) >= _STREAMING_SIZE and all(_streamable(p) for p in passes):
+			if self._rewrite_streaming(filename, passes):
+				return
+
+		original, encoding = lib.read_file_with_encoding(filename)
+		text = original
+		for rewrite_pass in passes:
+			text = rewrite_pass.apply(text)
+
+		if text == original and encoding == 'utf-8':
+			# would write back exactly what's there
+			return
+		encoded = text.encode('utf8')
+		with lib.replacing(filename) as tmp_file:
+			with open(tmp_file, 'wb') as out_file:
+				out_file.write(encoded)
+		self._wrote(filename, len(encoded))
+
+	def _rewrite_streaming(self, filename, passes):
+		'''Rewrite a large file a chunk at a time
+
+		:return: ``False`` if the file turned out not to be in the encoding we guessed
+		'''
+		encoding = lib.guess_encoding(filename) or 'utf-8'
+		needles = [needle for rewrite_pass in passes for needle in getattr(rewrite_pass, 'needles', (None,))]
+		if None not in needles and encoding not in _NOT_ASCII_COMPATIBLE and \
+				all(isinstance(needle, str) or all(ord(c) < 128 for c in needle) for needle in needles):
+			if not _contains_any(filename, [str(needle) for needle in needles]):
+				self.log.debug('nothing to replace in {0}'.format(filename))
+				return True
+
+		decoder = codecs.getincrementaldecoder(encoding)('strict')
+		encoder = codecs.getincrementalencoder('utf8')('strict')
+		try:
+			with open(filename, 'rb') as in_file:
+				def chunks():
+					for raw in iter(lambda: in_file.read(_CHUNK_SIZE), ''):
+						tracing.record_read(filename, len(raw))
+						yield decoder.decode(raw)
+					yield decoder.decode('', True)
+				stream = chunks()
+				for rewrite_pass in passes:
+					stream = rewrite_pass.stream(stream)
+
+				with lib.replacing(filename) as tmp_file:
+					with open(tmp_file, 'wb') as out_file:
+						for text in stream:
+							out_file.write(encoder.encode(text))
+						out_file.write(encoder.encode(u'', True))
+						written = out_file.tell()
+		except UnicodeDecodeError:
+			self.log.debug('{0} is not {1}: reading it all in to detect its encoding'.format(filename, encoding))
+			return False
+		self._wrote(filename, written)
+		return True
+
+	def _wrote(self, filename, num_bytes):
+		tracing.record_write(filename, num_bytes)
+		if self.fsync:
+			with self._lock:
+				self._written.add(filename)
+
+	def _compile(self, rules):
+		'Group runs of independent replacements together'
+		key = tuple((type(rule),) + tuple(getattr(rule, slot) for slot in rule.__slots__) for rule in rules)
+		with self._lock:
+			passes = self._passes.get(key)
+		if passes is not None:
+			return passes
+
+		passes = []
+		group = []
+		def end_group():
+			if len(group) == 1:
+				passes.append(_SingleReplace(group[0]))
+			elif group:
+				passes.append(_MultiReplace(group))
+			del group[:]
+
+		for rule in rules:
+			if isinstance(rule, _Wrap):
+				end_group()
+				passes.append(rule)
+			elif rule.find and _independent(rule, group):
+				group.append(rule)
+			else:
+				end_group()
+				if rule.find:
+					group.append(rule)
+				else:
+					# replacing the empty string: leave to str.replace
+					passes.append(_SingleReplace(rule))
+		end_group()
+
+		with self._lock:
+			self._passes[key] = passes
+		return passes
@@ -0,0 +1,158 @@
+'''Run the steps of a build script on a pool of worker threads.
+
+Two steps are ordered (the later one waits for the earlier one) when:
+
+* they are for overlapping platforms (``all`` overlaps everything), or
+* one of them writes a path which the other reads or writes, or
+* either of them is a task which hasn't declared its resources with :func:`lib.accesses`
+
+Anything else is free to run at the same time.
+'''
+import logging
+from os import path
+import Queue
+import sys
+import threading
+
+LOG = logging.getLogger(__name__)
+
+# resource name standing for the build.config dictionary
+CONFIG = ':config'
+
+_GLOB_OR_TEMPLATE_CHARS = ('*', '?', '[', '$', '%{')
+
+def static_prefix(resource):
+	'''The leading part of a path which doesn't contain any glob or template characters
+
+	e.g. ``development/ios/*/assets/src`` -> ``development/ios``
+	'''
+	if resource == CONFIG:
+		return resource
+	crumbs = []
+	for crumb in resource.replace('\\', '/').split('/'):
+		if any(special in crumb for special in _GLOB_OR_TEMPLATE_CHARS):
+			break
+		crumbs.append(crumb)
+	prefix = path.normpath('/'.join(crumbs)).replace('\\', '/') if crumbs else ''
+	return '' if prefix == '.' else prefix
+
+def _overlap(first, second):
+	'Could the two resources refer to the same file? An empty prefix could be anything'
+	if not first or not second or first == second:
+		return True
+	return first.startswith(second + '/') or second.startswith(first + '/')
+
+def any_overlap(firsts, seconds):
+	return any(_overlap(first, second) for first in firsts for second in seconds)
+
+class _Node(object):
+	def __init__(self, build, index, step):
+		self.index = index
+		self.step = step
+		self.platforms = step.platforms
+		self.reads, self.writes = self._resources(build, step)
+		self.waiting_on = 0
+		self.dependents = []
+
+	@staticmethod
+	def _resources(build, step):
+		'Returns a (reads, writes) pair of static path prefixes, or (None, None) if unknown'
+		resources = build.task_resources.get(step.func_name)
+		if resources is None:
+			return None, None
+		try:
+			reads, writes = resources(build, *step.args, **step.kw)
+		except Exception, e:
+			# leave the task itself to complain about bad arguments
+			LOG.debug("couldn't determine resources for {0}: {1}".format(step.func_name, e))
+			return None, None
+		return [static_prefix(r) for r in reads], [static_prefix(w) for w in writes]
+
+	def must_follow(self, other):
+		'Does this node have to wait for ``other`` to finish?'
+		if self.writes is None or other.writes is None:
+			return True
+		if self.platforms is None or other.platforms is None or self.platforms & other.platforms:
+			return True
+		return any_overlap(self.writes, other.reads + other.writes) or \
+			any_overlap(other.writes, self.reads)
+
+def _plan(build, script):
+	nodes = [_Node(build, index, step) for index, step in enumerate(script)]
+	for node in nodes:
+		for earlier in nodes[:node.index]:
+			if node.must_follow(earlier):
+				node.waiting_on += 1
+				earlier.dependents.append(node)
+	return nodes
+
+def run_concurrently(build, script, jobs):
+	'''Run a preprocessed script using up to ``jobs`` worker threads.
+
+	If a step fails, no further steps are started; the first exception is
+	re-raised once the steps already in flight have finished.
+
+	:param build: the :class:`build.Build` the script belongs to
+	:param script: list of :class:`plan.Step` objects
+	:param jobs: maximum number of steps to run at the same time
+	'''
+	nodes = _plan(build, script)
+	LOG.debug('scheduling {0} steps on {1} workers'.format(len(nodes), jobs))
+
+	todo = Queue.Queue()
+	results = Queue.Queue()
+
+	def worker():
+		while True:
+			node = todo.get()
+			if node is None:
+				return
+			try:
+				build._run_task(node.step.func_name, node.step.args, node.step.kw)
+			except BaseException:
+				results.put((node, sys.exc_info()))
+			else:
+				results.put((node, None))
+
+	workers = [threading.Thread(target=worker, name='build-worker-%d' % i) for i in range(jobs)]
+	for thread in workers:
+		thread.daemon = True
+		thread.start()
+
+	failure = None
+	in_flight = 0
+	try:
+		for node in nodes:
+			if node.waiting_on == 0:
+				todo.put(node)
+				in_flight += 1
+
+		while in_flight:
+			# a timeout keeps the main thread responsive to KeyboardInterrupt
+			try:
+				node, exc_info = results.get(True, 3600)
+			except Queue.Empty:
+				continue
+			in_flight -= 1
+
+			if exc_info is not None:
+				failure = failure or exc_info
+			if failure is not None:
+				continue
+
+			for dependent in node.dependents:
+				dependent.waiting_on -= 1
+				if dependent.waiting_on == 0:
+					todo.put(dependent)
+					in_flight += 1
+	finally:
+		for _ in workers:
+			todo.put(None)
+		# don't leave workers inside todo.get() for the interpreter to tear down
+		for thread in workers:
+			while thread.is_alive():
+				# with a timeout, so that KeyboardInterrupt still gets through
+				thread.join(3600)
+
+	if failure is not None:
+		raise failure[0], failure[1], failure[2]
@@ -0,0 +1,237 @@
+'''Skip build steps whose inputs haven't changed since the last build.
+
+A step can be cached if its task has declared its resources with :func:`lib.accesses`
+and doesn't change ``build.config``. Its cache key is made from:
+
+* the task name and its arguments
+* a digest of ``build.config``, if the task reads it
+* the digests of every file under the paths it reads and writes
+
+After a step runs, the files under the paths it writes are recorded, and copies are
+kept in a content-addressed object store. When a later build finds the same key, the
+step is skipped and its recorded outputs are *virtually* applied: they are only
+restored to disk when a step which does need to run looks at them, or at the end of the
+build. This way, a chain of steps rewriting the same files (e.g. ``copy_files`` then
+``find_and_replace_in_dir``) sees exactly what it saw the first time round.
+'''
+import errno
+import glob
+import hashlib
+import json
+import logging
+import os
+from os import path
+import shutil
+import threading
+
+from digests import FileDigests
+import lib
+from scheduler import CONFIG
+import utils
+
+LOG = logging.getLogger(__name__)
+
+_NO_PREVIOUS_RUN = 'no previous run with these arguments'
+
+def _json_digest(thing):
+	return hashlib.sha1(json.dumps(thing, sort_keys=True, default=repr)).hexdigest()
+
+class StepCache(object):
+	def __init__(self, cache_dir, explain=False, log=None):
+		'''
+		:param cache_dir: directory to keep the cache index and object store in
+		:param explain: log why each step had to be run
+		:param log: a :class:`logging.Logger` instance
+		'''
+		self.cache_dir = cache_dir
+		self.explain = explain
+		self.log = log if log is not None else LOG
+		self._index_file = path.join(cache_dir, 'steps.json')
+		self._objects = path.join(cache_dir, 'objects')
+		self._lock = threading.Lock()
+
+		index = self._load_index()
+		self._entries = index.get('entries', {})
+		self._digests = FileDigests(index.get('digests'))
+		# file name -> digest each file *should* have at this point in the build (None: absent)
+		self._virtual = {}
+		self._occurrences = {}
+
+	def _load_index(self):
+		try:
+			with open(self._index_file) as index_file:
+				return json.load(index_file)
+		except IOError:
+			return {}
+		except ValueError:
+			self.log.warning('ignoring corrupt step cache index {0}'.format(self._index_file))
+			return {}
+
+	def run(self, build, func_name, function, args, kw):
+		'Run a task, or skip it if its cache key matches the last time it was run'
+		resources = self._resources(build, func_name, args, kw)
+		if resources is None:
+			# could touch anything: put everything into place first
+			self._materialise(self._virtual.keys())
+			function(build, *args, **kw)
+			return
+
+		reads, writes = resources
+		cacheable = CONFIG not in writes
+		inputs = self._files_under(build, reads + writes)
+		if inputs is None:
+			self._materialise(self._virtual.keys())
+			function(build, *args, **kw)
+			return
+
+		step_id = self._step_id(func_name, args, kw)
+		key = {
+			'config': build.config.cached('digest', lambda: _json_digest(build.config)) if CONFIG in reads else None,
+			'inputs': dict((name, self._current(name)) for name in inputs),
+		}
+
+		if cacheable:
+			reason = self._why_stale(step_id, key)
+			if reason is None:
+				self.log.debug('{0} is unchanged: skipping'.format(func_name))
+				self._virtual.update(self._entries[step_id]['outputs'])
+				return
+			if self.explain:
+				self.log.info('running {0}{1}: {2}'.format(func_name, tuple(args), reason))
+
+		outputs_before = self._files_under(build, writes)
+		self._materialise(inputs)
+		function(build, *args, **kw)
+		outputs_after = self._files_under(build, writes, virtual=False) or []
+
+		recorded = {}
+		for name in set(outputs_before) | set(outputs_after):
+			self._digests.forget(name)
+			recorded[name] = self._virtual[name] = self._digests.digest(name)
+
+		if cacheable:
+			for name, digest in recorded.items():
+				if digest is not None:
+					self._store(name, digest)
+			with self._lock:
+				self._entries[step_id] = dict(key, outputs=recorded)
+
+	def finish(self):
+		'Put every skipped step\'s outputs into place, and save the cache index'
+		self._materialise(self._virtual.keys())
+		self.save()
+
+	def save(self):
+		if not path.isdir(self.cache_dir):
+			os.makedirs(self.cache_dir)
+		with self._lock:
+			index = {'entries': self._entries, 'digests': self._digests.state()}
+			with open(self._index_file, 'w') as index_file:
+				json.dump(index, index_file)
+
+	def _resources(self, build, func_name, args, kw):
+		resources = build.task_resources.get(func_name)
+		if resources is None:
+			return None
+		try:
+			reads, writes = resources(build, *args, **kw)
+		except Exception:
+			return None
+		return list(reads), list(writes)
+
+	def _step_id(self, func_name, args, kw):
+		'Identify a step by its arguments, and how many identical steps we\'ve seen before'
+		arguments = _json_digest([func_name, args, kw])
+		with self._lock:
+			occurrence = self._occurrences.get(arguments, 0)
+			self._occurrences[arguments] = occurrence + 1
+		return '{0}-{1}'.format(arguments, occurrence)
+
+	def _why_stale(self, step_id, key):
+		'Returns ``None`` if the step can be skipped, or an explanation why not'
+		entry = self._entries.get(step_id)
+		if entry is None:
+			return _NO_PREVIOUS_RUN
+		if entry['config'] != key['config']:
+			return 'the app configuration has changed'
+		for name in sorted(set(entry['inputs']) | set(key['inputs'])):
+			before, now = entry['inputs'].get(name), key['inputs'].get(name)
+			if before != now:
+				if before is None:
+					return '{0} has been added'.format(name)
+				elif now is None:
+					return '{0} has been removed'.format(name)
+				else:
+					return '{0} has changed'.format(name)
+		for name, digest in entry['outputs'].items():
+			if digest is not None and not path.isfile(self._object_path(digest)):
+				return 'the cached copy of {0} has gone'.format(name)
+		return None
+
+	def _current(self, name):
+		'What digest this file should have at this point in the build'
+		if name not in self._virtual:
+			self._virtual[name] = self._digests.digest(name)
+		return self._virtual[name]
+
+	def _files_under(self, build, resources, virtual=True):
+		'''Every file under the given resources: disk contents plus, if ``virtual``,
+		files which skipped steps would have created
+
+		Returns ``None`` if a resource can't be expanded
+		'''
+		names = set()
+		for resource in resources:
+			if resource == CONFIG:
+				continue
+			try:
+				rendered = utils.render_string(build.config, resource) if '$' in resource else resource
+			except Exception:
+				return None
+			for match in glob.glob(rendered) or [rendered]:
+				match = path.normpath(match)
+				if path.isdir(match):
+					for root, _, files in os.walk(match):
+						names.update(path.join(root, name) for name in files)
+				else:
+					names.add(match)
+				if virtual:
+					prefix = match + os.sep
+					names.update(name for name in list(self._virtual)
+							if name == match or name.startswith(prefix))
+		return sorted(names)
+
+	def _object_path(self, digest):
+		return path.join(self._objects, digest[:2], digest)
+
+	def _store(self, name, digest):
+		object_path = self._object_path(digest)
+		if path.isfile(object_path):
+			return
+		directory = path.dirname(object_path)
+		try:
+			os.makedirs(directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+		tmp_path = '{0}.{1}'.format(object_path, threading.current_thread().ident)
+		shutil.copyfile(name, tmp_path)
+		os.rename(tmp_path, object_path)
+
+	def _materialise(self, names):
+		'Make sure the given files on disk are as the build expects them to be by now'
+		for name in list(names):
+			wanted = self._virtual.get(name)
+			if self._digests.digest(name) == wanted:
+				continue
+			if wanted is None:
+				self.log.debug('removing {0}'.format(name))
+				os.remove(name)
+			else:
+				self.log.debug('restoring {0} from the step cache'.format(name))
+				directory = path.dirname(name)
+				if directory and not path.isdir(directory):
+					os.makedirs(directory)
+				with lib.replacing(name) as tmp_file:
+					shutil.copyfile(self._object_path(wanted), tmp_file)
+			self._digests.forget(name)
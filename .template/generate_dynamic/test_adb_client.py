@@ -0,0 +1,237 @@
+'''Tests for :mod:`adb_client`, against a fake adb server listening on localhost.
+
+Run from a checkout with::
+
+	python .template/generate_dynamic/test_adb_client.py
+'''
+import os
+from os import path
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+from generate_dynamic.adb_client import AdbClient, AdbError, AdbUnavailable, Device
+
+def _string(text):
+	return '{0:04x}{1}'.format(len(text), text)
+
+def _read_exactly(sock, length):
+	data = []
+	while length:
+		chunk = sock.recv(length)
+		if not chunk:
+			raise EOFError
+		data.append(chunk)
+		length -= len(chunk)
+	return ''.join(data)
+
+class FakeAdbServer(object):
+	'''Enough of the adb server's protocol to test the client with
+
+	:param devices: what ``host:devices-l`` and ``host:track-devices`` report first
+	:param track_delay: how long ``host:track-devices`` takes to report anything
+	:param later_devices: list of ``(delay, devices)``: what ``host:track-devices``
+		reports after that, as devices come and go
+	:param shell_output: function from a shell command line to what it prints
+	'''
+	def __init__(self, devices='', track_delay=0, later_devices=(), shell_output=None):
+		self.devices = devices
+		self.track_delay = track_delay
+		self.later_devices = list(later_devices)
+		self.shell_output = shell_output or (lambda command: '')
+		self.serials = set(line.split()[0] for line in devices.splitlines() if line.strip())
+		for _, more in self.later_devices:
+			self.serials.update(line.split()[0] for line in more.splitlines() if line.strip())
+		# what happened: lists of (serial, command) and (serial, remote path, mode, data, mtime)
+		self.shells = []
+		self.pushes = []
+		self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self._sock.bind(('127.0.0.1', 0))
+		self._sock.listen(5)
+		self.port = self._sock.getsockname()[1]
+		self._closed = threading.Event()
+		thread = threading.Thread(target=self._serve)
+		thread.daemon = True
+		thread.start()
+
+	def close(self):
+		self._closed.set()
+		try:
+			# wake up accept(), which closing alone doesn't do everywhere
+			self._sock.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self._sock.close()
+
+	def _serve(self):
+		while not self._closed.is_set():
+			try:
+				conn, _ = self._sock.accept()
+			except socket.error:
+				return
+			thread = threading.Thread(target=self._handle, args=(conn,))
+			thread.daemon = True
+			thread.start()
+
+	def _request(self, conn):
+		return _read_exactly(conn, int(_read_exactly(conn, 4), 16))
+
+	def _handle(self, conn):
+		try:
+			request = self._request(conn)
+			if request == 'host:devices-l':
+				conn.sendall('OKAY' + _string(self.devices))
+			elif request == 'host:track-devices':
+				conn.sendall('OKAY')
+				self._closed.wait(self.track_delay)
+				conn.sendall(_string(self.devices))
+				for delay, devices in self.later_devices:
+					self._closed.wait(delay)
+					conn.sendall(_string(devices))
+				# the real server keeps the connection open until the client goes away
+				self._closed.wait(10)
+			elif request.startswith('host:transport:'):
+				serial = request[len('host:transport:'):]
+				if serial not in self.serials:
+					conn.sendall('FAIL' + _string('device \'{0}\' not found'.format(serial)))
+					return
+				conn.sendall('OKAY')
+				self._device_request(conn, serial, self._request(conn))
+			else:
+				conn.sendall('FAIL' + _string('unknown host service'))
+		except (EOFError, socket.error):
+			pass
+		finally:
+			conn.close()
+
+	def _device_request(self, conn, serial, request):
+		if request.startswith('shell:'):
+			command = request[len('shell:'):]
+			self.shells.append((serial, command))
+			conn.sendall('OKAY' + self.shell_output(command))
+		elif request == 'sync:':
+			conn.sendall('OKAY')
+			command, length = struct.unpack('<4sI', _read_exactly(conn, 8))
+			assert command == 'SEND', command
+			remote, mode = _read_exactly(conn, length).rsplit(',', 1)
+			data = []
+			while True:
+				command, length = struct.unpack('<4sI', _read_exactly(conn, 8))
+				if command == 'DONE':
+					break
+				assert command == 'DATA', command
+				data.append(_read_exactly(conn, length))
+			self.pushes.append((serial, remote, int(mode), ''.join(data), length))
+			conn.sendall('OKAY' + struct.pack('<I', 0))
+			command, _ = struct.unpack('<4sI', _read_exactly(conn, 8))
+			assert command == 'QUIT', command
+		else:
+			conn.sendall('FAIL' + _string('unknown device service'))
+
+_EMULATOR = 'emulator-5554          device product:sdk model:sdk device:generic\n'
+_PHONE = '0123456789ABCDEF       device usb:1-1 product:hammerhead model:Nexus_5\n'
+_OFFLINE = '0123456789ABCDEF       offline\n'
+
+class AdbClientTest(unittest.TestCase):
+	def server(self, **kw):
+		server = FakeAdbServer(**kw)
+		self.addCleanup(server.close)
+		return server, AdbClient(port=server.port, timeout=5)
+
+	def test_devices(self):
+		_, client = self.server(devices=_EMULATOR + _OFFLINE)
+		self.assertEqual(client.devices(), [
+			Device('emulator-5554', 'device', {'product': 'sdk', 'model': 'sdk', 'device': 'generic'}),
+			Device('0123456789ABCDEF', 'offline', {}),
+		])
+
+	def test_no_server(self):
+		# a port nothing is listening on
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.bind(('127.0.0.1', 0))
+		port = sock.getsockname()[1]
+		sock.close()
+		self.assertRaises(AdbUnavailable, AdbClient(port=port, timeout=5).devices)
+
+	def test_shell(self):
+		server, client = self.server(devices=_EMULATOR, shell_output=lambda command: 'ran ' + command)
+		self.assertEqual(client.shell('emulator-5554', 'am start -n a/a.B'), 'ran am start -n a/a.B')
+		self.assertEqual(server.shells, [('emulator-5554', 'am start -n a/a.B')])
+
+	def test_unknown_device(self):
+		_, client = self.server(devices=_EMULATOR)
+		try:
+			client.shell('nosuch', 'ls')
+		except AdbUnavailable:
+			self.fail('a device the server doesn\'t know is an AdbError, not AdbUnavailable')
+		except AdbError, e:
+			self.assertTrue('not found' in str(e), str(e))
+		else:
+			self.fail('expected AdbError')
+
+	def _local_file(self, data):
+		fd, local = tempfile.mkstemp(suffix='.apk')
+		os.write(fd, data)
+		os.close(fd)
+		self.addCleanup(os.remove, local)
+		return local
+
+	def test_push(self):
+		server, client = self.server(devices=_EMULATOR)
+		# more than one DATA packet's worth
+		data = ''.join(chr(i % 251) for i in range(150 * 1024))
+		local = self._local_file(data)
+		client.push('emulator-5554', local, '/sdcard/test.bin', mode=0600)
+		self.assertEqual(server.pushes, [
+			('emulator-5554', '/sdcard/test.bin', 0600, data, int(path.getmtime(local))),
+		])
+
+	def test_install(self):
+		server, client = self.server(
+			devices=_EMULATOR,
+			shell_output=lambda command: '\tpkg: /data/local/tmp/x.apk\r\nSuccess\r\n' if command.startswith('pm install') else '',
+		)
+		local = self._local_file('PK not really an apk')
+		remote = '/data/local/tmp/{0}'.format(path.basename(local))
+		self.assertTrue('Success' in client.install('emulator-5554', local))
+		self.assertEqual([push[1:4] for push in server.pushes], [(remote, 0644, 'PK not really an apk')])
+		self.assertEqual(server.shells, [
+			('emulator-5554', 'pm install -r {0}'.format(remote)),
+			('emulator-5554', 'rm {0}'.format(remote)),
+		])
+
+	def test_install_failure(self):
+		server, client = self.server(
+			devices=_EMULATOR,
+			shell_output=lambda command: 'Failure [INSTALL_FAILED_OLDER_SDK]\r\n' if command.startswith('pm install') else '',
+		)
+		local = self._local_file('PK')
+		self.assertRaises(AdbError, client.install, 'emulator-5554', local)
+		# the pushed APK is still removed
+		self.assertEqual(server.shells[-1][1].split()[0], 'rm')
+
+	def test_wait_for_devices_ready(self):
+		_, client = self.server(devices=_EMULATOR)
+		self.assertEqual([device.serial for device in client.wait_for_devices(1)], ['emulator-5554'])
+
+	def test_wait_for_devices_coming_online(self):
+		_, client = self.server(devices=_OFFLINE, later_devices=[(0.2, ''), (0.2, _PHONE)])
+		self.assertEqual([device.serial for device in client.wait_for_devices(5)], ['0123456789ABCDEF'])
+
+	def test_wait_for_devices_timeout(self):
+		# shorter than the client's own timeout: the first read has to respect it too
+		_, client = self.server(devices=_PHONE, track_delay=3)
+		start = time.time()
+		self.assertEqual(client.wait_for_devices(0.5), [])
+		self.assertTrue(time.time() - start < 2, time.time() - start)
+
+if __name__ == '__main__':
+	unittest.main()
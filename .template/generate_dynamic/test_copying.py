@@ -0,0 +1,137 @@
+'''Tests for :mod:`copying`: every mode leaves the same tree as :func:`shutil.copytree`.
+
+Run from a checkout with::
+
+	python .template/generate_dynamic/test_copying.py
+'''
+import os
+from os import path
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+from generate_dynamic import copying
+
+def _tree(root):
+	'''``relative path -> (permission bits, contents)`` for every file under ``root``,
+	and ``relative path -> None`` for every directory'''
+	tree = {}
+	for directory, directories, files in os.walk(root, followlinks=True):
+		for name in directories:
+			tree[path.relpath(path.join(directory, name), root)] = None
+		for name in files:
+			filename = path.join(directory, name)
+			with open(filename, 'rb') as in_file:
+				tree[path.relpath(filename, root)] = (stat.S_IMODE(os.stat(filename).st_mode), in_file.read())
+	return tree
+
+class CopyingTest(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.temp_dir)
+		self.src = path.join(self.temp_dir, 'src')
+		self.write('index.html', '<html></html>')
+		self.write('js/app.js', 'forge.logging.info("hi");')
+		self.write('js/lib/jquery.js', '// jquery')
+		self.write('run.sh', '#!/bin/sh', mode=0755)
+		self.write('.hidden/ignored.txt', 'ignored')
+		self.write('empty/.keep', '')
+		# followed, as shutil.copytree does
+		os.symlink(path.join(self.src, 'js'), path.join(self.src, 'linked'))
+
+	def write(self, name, contents, root=None, mode=0644):
+		filename = path.join(root or self.src, name)
+		if not path.isdir(path.dirname(filename)):
+			os.makedirs(path.dirname(filename))
+		with open(filename, 'wb') as out_file:
+			out_file.write(contents)
+		os.chmod(filename, mode)
+		return filename
+
+	def expected(self, ignore=None):
+		'What shutil.copytree makes of the source'
+		expected_dir = path.join(self.temp_dir, 'expected')
+		if path.exists(expected_dir):
+			shutil.rmtree(expected_dir)
+		shutil.copytree(self.src, expected_dir, ignore=ignore)
+		return _tree(expected_dir)
+
+	def check_mode(self, mode):
+		ignore = shutil.ignore_patterns('.hidden')
+		dst = path.join(self.temp_dir, mode)
+		copied, unchanged, deleted = copying.copy_tree(self.src, dst, ignore=ignore, mode=mode)
+		self.assertEqual(_tree(dst), self.expected(ignore))
+		self.assertEqual((copied, unchanged, deleted), (7, 0, 0))
+		return dst
+
+	def test_copy(self):
+		self.check_mode('copy')
+
+	def test_reflink(self):
+		dst = self.check_mode('reflink')
+		# a clone (or copy), not the same file
+		self.write('index.html', 'changed')
+		self.assertEqual(_tree(dst)['index.html'][1], '<html></html>')
+
+	def test_hardlink(self):
+		dst = self.check_mode('hardlink')
+		self.assertTrue(path.samefile(path.join(dst, 'index.html'), path.join(self.src, 'index.html')))
+
+	def test_sync_into_nothing(self):
+		self.check_mode('sync')
+
+	def test_sync_again(self):
+		dst = self.check_mode('sync')
+		self.assertEqual(copying.copy_tree(self.src, dst, mode='sync'), (1, 7, 0))
+		self.assertEqual(_tree(dst), self.expected())
+
+	def test_sync_changes(self):
+		dst = path.join(self.temp_dir, 'sync')
+		copying.copy_tree(self.src, dst, mode='sync')
+		self.write('index.html', '<html>changed</html>')
+		self.write('new.js', '// new')
+		os.remove(path.join(self.src, 'js', 'lib', 'jquery.js'))
+		self.write('stale.txt', 'not in the source', root=dst)
+		self.write('old/stale.txt', 'not in the source', root=dst)
+		self.write('.git/HEAD', 'ref: refs/heads/master', root=dst)
+		self.write('js/.git', 'kept at any level', root=dst)
+		# a file where the source now has a directory, and the other way round
+		shutil.rmtree(path.join(self.src, 'empty'))
+		self.write('empty', 'now a file')
+		self.write('new_dir', 'a file in dst', root=dst)
+		self.write('new_dir/file.txt', 'now a directory')
+
+		copied, unchanged, deleted = copying.copy_tree(self.src, dst, mode='sync', keep=('.git',))
+		tree = _tree(dst)
+		self.assertEqual(tree.pop('.git'), None)
+		self.assertEqual(tree.pop(path.join('.git', 'HEAD')), (0644, 'ref: refs/heads/master'))
+		self.assertEqual(tree.pop(path.join('js', '.git')), (0644, 'kept at any level'))
+		self.assertEqual(tree, self.expected())
+		# index.html, new.js, empty, new_dir/file.txt
+		self.assertEqual(copied, 4)
+		# stale.txt, old, both jquery.js (linked/ is a copy), empty as a directory and new_dir as a file
+		self.assertEqual(deleted, 6)
+
+	def test_copy_file(self):
+		dst_dir = path.join(self.temp_dir, 'dst')
+		os.mkdir(dst_dir)
+		for mode in copying.MODES:
+			# into a directory, and onto an existing file
+			self.assertTrue(copying.copy_file(path.join(self.src, 'run.sh'), dst_dir, mode=mode))
+			self.assertEqual(_tree(dst_dir), {'run.sh': (0755, '#!/bin/sh')})
+			self.write('other.sh', 'other', root=dst_dir)
+			copying.copy_file(path.join(self.src, 'run.sh'), path.join(dst_dir, 'other.sh'), mode=mode)
+			self.assertEqual(_tree(dst_dir)['other.sh'], (0755, '#!/bin/sh'), mode)
+			os.remove(path.join(dst_dir, 'other.sh'))
+			if mode == 'sync':
+				self.assertFalse(copying.copy_file(path.join(self.src, 'run.sh'), dst_dir, mode=mode))
+			os.remove(path.join(dst_dir, 'run.sh'))
+
+if __name__ == '__main__':
+	unittest.main()
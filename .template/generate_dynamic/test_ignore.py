@@ -0,0 +1,132 @@
+'''Tests for :mod:`ignore`: :class:`IgnoreMatcher` ignores exactly what the
+``fnmatch``-based ignore function it replaced did.
+
+Run from a checkout with::
+
+	python .template/generate_dynamic/test_ignore.py
+'''
+import fnmatch
+import glob
+import os
+from os import path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+from generate_dynamic.ignore import IgnoreMatcher
+from generate_dynamic.lib import cd
+
+def _git_ignore(root, patterns):
+	'The ignore function ``copy_files`` used before :class:`IgnoreMatcher`, as it was'
+	classified_patterns = []
+	with cd(root):
+		for pattern in patterns:
+			if pattern:
+				if '/' in pattern[:-1]:
+					classified_patterns.extend(('path', match) for match in glob.glob(pattern))
+				else:
+					classified_patterns.append(('file', pattern))
+
+	def git_ignorer(src, names):
+		relative_src = src[len(root):].lstrip('\\/')
+		ignored = []
+		for name in names:
+			for pattern_type, value in classified_patterns:
+				if pattern_type == 'path':
+					if path.join(relative_src, name) == os.path.normpath(value):
+						ignored.append(name)
+				elif pattern_type == 'file':
+					ignore_name = value
+					if value[-1] in ('/', '\\'):
+						if path.isdir(path.join(src, name)):
+							ignore_name = ignore_name[:-1]
+
+					if fnmatch.fnmatch(name, ignore_name):
+						ignored.append(name)
+
+		return set(ignored)
+
+	return git_ignorer
+
+_TREE = (
+	'index.html', 'config.json', '.forgeignore', '.DS_Store',
+	'js/app.js', 'js/app.min.js', 'js/lib/jquery.js', 'js/lib/README',
+	'build/out.js', 'src/build', 'src/x/a.txt', 'src/abc', 'src/a.c',
+	'node_modules/pkg/index.js', 'docs/[draft].md', 'Thumbs.db', 'css/build/site.css',
+)
+
+_PATTERNS = (
+	'*.js', '*.min.*', 'build/', 'build', 'js/lib/*', 'js/lib/', 'src/x/', 'node_modules', '.*',
+	'[ab]*', 'a?c', '*[!s]', 'docs/[[]draft].md', './config.json', 'nosuch/*', 'README', 'js/*.js',
+	'*/build', '', 'Thumbs.db', 'js/lib\\',
+)
+
+class IgnoreMatcherTest(unittest.TestCase):
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+		for name in _TREE:
+			filename = path.join(self.root, name)
+			if not path.isdir(path.dirname(filename)):
+				os.makedirs(path.dirname(filename))
+			with open(filename, 'w') as out_file:
+				out_file.write(name)
+
+	def ignored(self, ignore):
+		'``directory -> ignored names`` for every directory in the tree'
+		result = {}
+		for directory, directories, files in os.walk(self.root):
+			result[path.relpath(directory, self.root)] = ignore(directory, sorted(directories + files))
+		return result
+
+	def check(self, patterns):
+		self.assertEqual(
+			self.ignored(IgnoreMatcher(self.root, patterns)),
+			self.ignored(_git_ignore(self.root, patterns)),
+			patterns,
+		)
+
+	def test_each_pattern(self):
+		for pattern in _PATTERNS:
+			self.check([pattern])
+
+	def test_all_patterns(self):
+		self.check(list(_PATTERNS))
+
+	def test_random_patterns(self):
+		rand = random.Random(0)
+		for _ in range(100):
+			self.check(rand.sample(_PATTERNS, rand.randint(1, 5)))
+
+	def test_no_patterns(self):
+		self.check([])
+
+	def test_root_with_trailing_slash(self):
+		patterns = ['js/lib/*', '*.html', 'build/']
+		self.assertEqual(
+			self.ignored(IgnoreMatcher(self.root + os.sep, patterns)),
+			self.ignored(_git_ignore(self.root + os.sep, patterns)),
+		)
+
+	def test_copytree(self):
+		patterns = ['*.min.js', 'build/', 'js/lib/*', '.*']
+		copied = path.join(tempfile.mkdtemp(), 'copied')
+		self.addCleanup(shutil.rmtree, path.dirname(copied))
+		shutil.copytree(self.root, copied, ignore=IgnoreMatcher(self.root, patterns))
+		self.assertEqual(sorted(path.relpath(path.join(directory, name), copied)
+				for directory, _, files in os.walk(copied) for name in files), [
+			# build/ is any directory called build; src/build is a file
+			'Thumbs.db', 'config.json',
+			path.join('docs', '[draft].md'), 'index.html', path.join('js', 'app.js'),
+			path.join('node_modules', 'pkg', 'index.js'), path.join('src', 'a.c'), path.join('src', 'abc'),
+			path.join('src', 'build'), path.join('src', 'x', 'a.txt'),
+		])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,108 @@
+'''Tests for :mod:`plan`: saved plans give tasks the same arguments as compiled ones,
+and are only re-used while the predicates they depend on are unchanged.
+
+Run from a checkout with::
+
+	python .template/generate_dynamic/test_plan.py
+'''
+import imp
+import json
+import os
+from os import path
+import shutil
+import sys
+import tempfile
+import unittest
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+from generate_dynamic import plan
+
+def _types(value):
+	'``value``, with the type of everything in it spelled out'
+	if isinstance(value, (list, tuple)):
+		return (type(value).__name__, [_types(item) for item in value])
+	if isinstance(value, dict):
+		return ('dict', sorted((_types(key), _types(item)) for key, item in value.items()))
+	return (type(value).__name__, value)
+
+class _Config(dict):
+	def all_config(self):
+		return dict(self)
+
+class _Build(object):
+	'As much of :class:`build.Build` as compiling a plan needs'
+	def __init__(self, predicates):
+		self.config = {'name': 'test'}
+		self.enabled_platforms = ('chrome', 'ios')
+		self.template_only = False
+		self.external = False
+		self.tool_config = _Config()
+		self.predicates = predicates
+		self.tasks = {}
+
+_PREDICATES = '''
+_ENABLED = {enabled!r}
+
+def _helper(build):
+	return _ENABLED
+
+def is_enabled(build):
+	return _helper(build)
+'''
+
+class PlanTest(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.temp_dir)
+
+	def test_saved_steps_keep_argument_types(self):
+		step = plan.Step(frozenset(['ios']), 'find_and_replace', (
+			'plain', u'unicode', ['a', ('b', 1, 2.5, None, True)], 'caf\xc3\xa9', '\xff',
+		), {'in': ('*.html',), u'key': {'nested': [u'x']}})
+		loaded = plan.Step.from_json(json.loads(json.dumps(step.to_json())))
+		self.assertEqual(loaded.platforms, step.platforms)
+		self.assertEqual(_types(loaded.func_name), _types(step.func_name))
+		self.assertEqual(_types(loaded.args), _types(step.args))
+		self.assertEqual(_types(loaded.kw), _types(step.kw))
+
+	def test_unsaveable_arguments(self):
+		self.assertRaises(TypeError, plan.Step(None, 'task', (object(),)).to_json)
+
+	def test_cached_plan_matches_compiled_plan(self):
+		script = [
+			('all', None, 'copy_files', ('src', u'development'), {'from': 'a', 'to': ('b', 'c')}),
+			('ios', None, 'find_and_replace', (), {'in': ('*.plist',), 'find': u'x', 'replace': 'y'}),
+			('firefox', None, 'not_for_these_platforms', ()),
+		]
+		cache_dir = path.join(self.temp_dir, 'plans')
+		compiled = plan.compile_script(_Build({}), script, cache_dir=cache_dir)
+		self.assertEqual(len(os.listdir(cache_dir)), 1)
+		cached = plan.compile_script(_Build({}), script, cache_dir=cache_dir)
+		self.assertEqual(
+			[(step.platforms, _types(step.func_name), _types(step.args), _types(step.kw)) for step in cached],
+			[(step.platforms, _types(step.func_name), _types(step.args), _types(step.kw)) for step in compiled],
+		)
+
+	def _load_predicates(self, enabled):
+		filename = path.join(self.temp_dir, 'plan_test_predicates.py')
+		with open(filename, 'w') as out_file:
+			out_file.write(_PREDICATES.format(enabled=enabled))
+		plan._module_digests.pop('plan_test_predicates', None)
+		module = imp.load_source('plan_test_predicates', filename)
+		self.addCleanup(sys.modules.pop, 'plan_test_predicates', None)
+		return {'is_enabled': module.is_enabled}
+
+	def test_cache_key_covers_predicate_helpers(self):
+		script = [('all', 'is_enabled', 'copy_files', ())]
+		before = plan.Compiler(_Build(self._load_predicates(True))).cache_key(script)
+		same = plan.Compiler(_Build(self._load_predicates(True))).cache_key(script)
+		# is_enabled itself is unchanged: only what it calls is different
+		after = plan.Compiler(_Build(self._load_predicates(False))).cache_key(script)
+		self.assertEqual(before, same)
+		self.assertNotEqual(before, after)
+
+if __name__ == '__main__':
+	unittest.main()
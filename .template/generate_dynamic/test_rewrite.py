@@ -0,0 +1,181 @@
+'''Tests for :mod:`rewrite`: queued rewrites leave files as the replacements done one
+after another with ``unicode.replace`` did, whether a file is read into memory or
+streamed a chunk at a time.
+
+Run from a checkout with::
+
+	python .template/generate_dynamic/test_rewrite.py
+'''
+import os
+from os import path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+from generate_dynamic import rewrite
+from generate_dynamic.rewrite import RewriteEngine
+
+def _one_at_a_time(contents, rules):
+	'What rewriting a file did before rewrites were queued: each rule in turn, on the whole file'
+	text = contents.decode('utf-8')
+	for rule in rules:
+		if rule[0] == 'replace':
+			text = text.replace(rule[1], rule[2])
+		else:
+			text = rule[1] + text + rule[2]
+	return text.encode('utf-8')
+
+class _RewriteTest(unittest.TestCase):
+	# bigger than any test file, so nothing is streamed
+	streaming_size = 1024 * 1024
+
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.temp_dir)
+		self._patch('_STREAMING_SIZE', self.streaming_size)
+		# much smaller than the needles in some tests, so that matches span chunks
+		self._patch('_CHUNK_SIZE', 7)
+
+	def _patch(self, name, value):
+		self.addCleanup(setattr, rewrite, name, getattr(rewrite, name))
+		setattr(rewrite, name, value)
+
+	def file(self, name, contents):
+		filename = path.join(self.temp_dir, name)
+		with open(filename, 'wb') as out_file:
+			out_file.write(contents)
+		return filename
+
+	def read(self, filename):
+		with open(filename, 'rb') as in_file:
+			return in_file.read()
+
+	def check(self, contents, rules):
+		'Queue ``rules`` for a file holding ``contents``, and compare the outcome with :func:`_one_at_a_time`'
+		filename = self.file('test.txt', contents)
+		engine = RewriteEngine()
+		for rule in rules:
+			getattr(engine, rule[0])(filename, *rule[1:])
+		engine.flush()
+		self.assertEqual(self.read(filename), _one_at_a_time(contents, rules), rules)
+
+	def test_independent_replacements(self):
+		self.check('var a = "${name}"; var b = "${uuid}";\n', [
+			('replace', u'${name}', u'weather'),
+			('replace', u'${uuid}', u'abc123'),
+			('replace', u'var', u'let'),
+		])
+
+	def test_chained_replacements(self):
+		# each replacement sees what the one before it did
+		self.check('aaa bbb ccc', [
+			('replace', u'a', u'b'),
+			('replace', u'b', u'c'),
+			('replace', u'cc', u'd'),
+		])
+
+	def test_overlapping_replacements(self):
+		self.check('abcabcab', [
+			('replace', u'ab', u'x'),
+			('replace', u'bc', u'y'),
+			('replace', u'ca', u'z'),
+		])
+
+	def test_replacement_making_a_match(self):
+		self.check('one two', [
+			('replace', u'one', u'two'),
+			('replace', u'two', u'three'),
+		])
+
+	def test_backslashes(self):
+		self.check('path=here', [('replace', u'here', u'C:\\new\\1\\g<0>')])
+
+	def test_empty_find(self):
+		self.check('abc', [('replace', u'b', u'B'), ('replace', u'', u'-'), ('replace', u'-a', u'+')])
+
+	def test_wrap(self):
+		self.check('forge.logging.info("hi");', [
+			('replace', u'hi', u'hello'),
+			('wrap', u'if (frames) {\n', u'\n}'),
+			('replace', u'{', u'{ '),
+		])
+
+	def test_unicode(self):
+		self.check(u'caf\xe9 \u2603 caf\xe9'.encode('utf-8'), [
+			('replace', u'caf\xe9', u'tea'),
+			('replace', u'\u2603', u'snow\u2603man'),
+		])
+
+	def test_long_matches(self):
+		self.check('x' * 20 + '<a long needle, longer than a chunk>' + 'y' * 30, [
+			('replace', u'<a long needle, longer than a chunk>', u'found'),
+			('replace', u'xfoundy', u'!'),
+		])
+
+	def test_random_replacements(self):
+		rand = random.Random(0)
+		for _ in range(200):
+			contents = ''.join(rand.choice('abc') for _ in range(rand.randint(0, 60)))
+			rules = [
+				('replace', u''.join(rand.choice('abc') for _ in range(rand.randint(1, 3))),
+					u''.join(rand.choice('abc') for _ in range(rand.randint(0, 3))))
+				for _ in range(rand.randint(1, 4))
+			]
+			self.check(contents, rules)
+
+	def test_files_are_independent(self):
+		first = self.file('first.txt', 'first file')
+		second = self.file('second.txt', 'second file')
+		engine = RewriteEngine()
+		engine.replace(first, u'file', u'thing')
+		engine.replace(second, u'second', u'other')
+		engine.replace(first, u'first', u'one')
+		engine.flush()
+		self.assertEqual(self.read(first), 'one thing')
+		self.assertEqual(self.read(second), 'other file')
+
+	def test_flush_some(self):
+		one = self.file('one.txt', 'one')
+		other = path.join(self.temp_dir, 'other')
+		os.mkdir(other)
+		two = self.file(path.join('other', 'two.txt'), 'two')
+		engine = RewriteEngine()
+		engine.replace(one, u'one', u'1')
+		engine.replace(two, u'two', u'2')
+		engine.flush([other])
+		self.assertEqual(self.read(one), 'one')
+		self.assertEqual(self.read(two), '2')
+		engine.flush()
+		self.assertEqual(self.read(one), '1')
+
+	def test_missing_file(self):
+		self.assertRaises(IOError, RewriteEngine().replace, path.join(self.temp_dir, 'nosuch'), u'a', u'b')
+
+class InMemoryTest(_RewriteTest):
+	pass
+
+class StreamingTest(_RewriteTest):
+	# every file is streamed, a few bytes at a time
+	streaming_size = 0
+
+	def test_nothing_to_replace(self):
+		filename = self.file('test.txt', 'nothing here')
+		engine = RewriteEngine()
+		engine.replace(filename, u'something', u'else')
+		before = os.stat(filename)
+		engine.flush()
+		# not even rewritten
+		self.assertEqual(os.stat(filename).st_ino, before.st_ino)
+		self.assertEqual(self.read(filename), 'nothing here')
+
+# the base class's tests are run by its subclasses
+del _RewriteTest
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,172 @@
+'''Tests for :mod:`step_cache`: a build with the step cache leaves the same files as one
+without it, running only the steps whose inputs have changed.
+
+Run from a checkout with::
+
+	python .template/generate_dynamic/test_step_cache.py
+'''
+import os
+from os import path
+import shutil
+import sys
+import tempfile
+import unittest
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+from generate_dynamic.scheduler import CONFIG
+from generate_dynamic.step_cache import StepCache
+from generate_dynamic.versioned_config import VersionedDict
+
+def copy(build, from_file, to_file):
+	shutil.copyfile(from_file, to_file)
+
+def sign(build, filename):
+	'Append the app name, from the configuration'
+	with open(filename, 'a') as out_file:
+		out_file.write(build.config['name'])
+
+def shout(build, filename):
+	with open(filename) as in_file:
+		contents = in_file.read()
+	with open(filename, 'w') as out_file:
+		out_file.write(contents.upper())
+
+def rename_app(build, name):
+	build.config['name'] = name
+
+def anything(build, filename):
+	with open(filename, 'w') as out_file:
+		out_file.write('anything')
+
+# files the steps write
+_OUTPUTS = ('output', 'copied')
+
+_TASKS = dict((function.func_name, function) for function in (copy, sign, shout, rename_app, anything))
+
+class _Build(object):
+	'As much of :class:`build.Build` as the step cache needs'
+	task_resources = {
+		'copy': lambda build, from_file, to_file: ([from_file], [to_file]),
+		'sign': lambda build, filename: ([CONFIG], [filename]),
+		'shout': lambda build, filename: ([], [filename]),
+		'rename_app': lambda build, name: ([], [CONFIG]),
+	}
+
+	def __init__(self, name):
+		self.config = VersionedDict({'name': name})
+
+class StepCacheTest(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.temp_dir)
+		self.cache_dir = path.join(self.temp_dir, 'cache')
+		self.write('source', 'hello\n')
+
+	def file(self, name):
+		return path.join(self.temp_dir, name)
+
+	def write(self, name, contents):
+		with open(self.file(name), 'w') as out_file:
+			out_file.write(contents)
+
+	def read(self, name):
+		with open(self.file(name)) as in_file:
+			return in_file.read()
+
+	def build(self, steps, name='first', template=None):
+		'''Run ``(task name, args)`` steps through a step cache, in a freshly laid out
+		output directory as a real build would be
+
+		:param template: ``name -> contents`` of output files to start with
+		:return: the names of the tasks which actually ran
+		'''
+		for output in _OUTPUTS:
+			if path.exists(self.file(output)):
+				os.remove(self.file(output))
+		for output, contents in (template or {}).items():
+			self.write(output, contents)
+
+		build = _Build(name)
+		cache = StepCache(self.cache_dir)
+		ran = []
+		def running(func_name):
+			def function(build, *args, **kw):
+				ran.append(func_name)
+				_TASKS[func_name](build, *args, **kw)
+			return function
+		for func_name, args in steps:
+			cache.run(build, func_name, running(func_name), args, {})
+		cache.finish()
+		return ran
+
+	def chain(self):
+		return [
+			('copy', (self.file('source'), self.file('output'))),
+			('sign', (self.file('output'),)),
+			('shout', (self.file('output'),)),
+		]
+
+	def test_unchanged_steps_are_skipped(self):
+		self.assertEqual(self.build(self.chain()), ['copy', 'sign', 'shout'])
+		self.assertEqual(self.read('output'), 'HELLO\nFIRST')
+		self.assertEqual(self.build(self.chain()), [])
+		# put back from the cache
+		self.assertEqual(self.read('output'), 'HELLO\nFIRST')
+
+	def test_changed_input(self):
+		self.build(self.chain())
+		self.write('source', 'goodbye\n')
+		self.assertEqual(self.build(self.chain()), ['copy', 'sign', 'shout'])
+		self.assertEqual(self.read('output'), 'GOODBYE\nFIRST')
+
+	def test_changed_output(self):
+		self.build(self.chain())
+		# copy has to run again, as it overwrites something new; the steps after it
+		# see what they saw the first time round
+		self.assertEqual(self.build(self.chain(), template={'output': 'from the template'}), ['copy'])
+		self.assertEqual(self.read('output'), 'HELLO\nFIRST')
+
+	def test_changed_config(self):
+		self.build(self.chain())
+		# copy is skipped, but sign still has to see what copy wrote
+		self.assertEqual(self.build(self.chain(), name='second'), ['sign', 'shout'])
+		self.assertEqual(self.read('output'), 'HELLO\nSECOND')
+		# the first build's steps are forgotten
+		self.assertEqual(self.build(self.chain()), ['sign', 'shout'])
+		self.assertEqual(self.read('output'), 'HELLO\nFIRST')
+
+	def test_only_changed_steps_run(self):
+		steps = [
+			('copy', (self.file('source'), self.file('output'))),
+			('shout', (self.file('output'),)),
+			('copy', (self.file('output'), self.file('copied'))),
+		]
+		self.build(steps)
+		self.assertEqual(self.build(steps, template={'copied': 'from the template'}), ['copy'])
+		self.assertEqual(self.read('output'), 'HELLO\n')
+		self.assertEqual(self.read('copied'), 'HELLO\n')
+
+	def test_uncacheable_steps_always_run(self):
+		steps = [('rename_app', ('renamed',)), ('anything', (self.file('output'),))]
+		self.assertEqual(self.build(steps), ['rename_app', 'anything'])
+		# changes build.config; doesn't say what it accesses
+		self.assertEqual(self.build(steps), ['rename_app', 'anything'])
+
+	def test_lost_object_store(self):
+		self.build(self.chain())
+		shutil.rmtree(path.join(self.cache_dir, 'objects'))
+		self.assertEqual(self.build(self.chain()), ['copy', 'sign', 'shout'])
+		self.assertEqual(self.read('output'), 'HELLO\nFIRST')
+
+	def test_corrupt_index(self):
+		self.build(self.chain())
+		with open(path.join(self.cache_dir, 'steps.json'), 'w') as index_file:
+			index_file.write('{')
+		self.assertEqual(self.build(self.chain()), ['copy', 'sign', 'shout'])
+		self.assertEqual(self.read('output'), 'HELLO\nFIRST')
+
+if __name__ == '__main__':
+	unittest.main()
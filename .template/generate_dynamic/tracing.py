@@ -0,0 +1,189 @@
+'''Opt-in instrumentation of the tasks run by a build.
+
+For each task dispatch we record wall time, CPU time, peak RSS, the files read and
+written, bytes moved and subprocesses spawned. Code doing I/O on behalf of a task
+reports it with :func:`record_read`, :func:`record_write` and :func:`record_subprocess`;
+these do nothing unless a traced task is running on the current thread.
+
+CPU time and peak RSS are process-wide figures (including finished subprocesses), so
+they are only exact when steps aren't running concurrently.
+'''
+from contextlib import contextmanager
+import json
+import logging
+import os
+from os import path
+import sys
+import threading
+import time
+
+try:
+	import resource
+except ImportError:
+	# e.g. on Windows
+	resource = None
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+def _current_span():
+	return getattr(_local, 'span', None)
+
+def record_read(filename, num_bytes):
+	'Note that the current task read ``num_bytes`` from ``filename``'
+	span = _current_span()
+	if span is not None:
+		span.files_read.add(filename)
+		span.bytes_read += num_bytes
+
+def record_write(filename, num_bytes):
+	'Note that the current task wrote ``num_bytes`` to ``filename``'
+	span = _current_span()
+	if span is not None:
+		span.files_written.add(filename)
+		span.bytes_written += num_bytes
+
+def record_copy(src, dst):
+	'Note that the current task copied the file or tree at ``src`` to ``dst``'
+	if _current_span() is None:
+		return
+	if path.isdir(src):
+		# the copy of a tree: everything under dst came from src
+		for root, _, files in os.walk(dst):
+			for name in files:
+				copied = path.join(root, name)
+				size = path.getsize(copied)
+				record_read(path.join(src, path.relpath(copied, dst)), size)
+				record_write(copied, size)
+		return
+	# a file, perhaps copied into the directory dst alongside others
+	copied = path.join(dst, path.basename(src)) if path.isdir(dst) else dst
+	if path.isfile(copied):
+		size = path.getsize(copied)
+		record_read(src, size)
+		record_write(copied, size)
+
+def record_subprocess(args):
+	'Note that the current task started a subprocess'
+	span = _current_span()
+	if span is not None:
+		span.subprocesses.append(path.basename(args[0]) if args else '?')
+
+def _cpu_time():
+	times = os.times()
+	# user + system, for us and our finished children
+	return times[0] + times[1] + times[2] + times[3]
+
+def _peak_rss_kb():
+	if resource is None:
+		return None
+	peaks = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+	peak = max(peaks)
+	# OS X reports bytes, Linux reports kilobytes
+	return peak // 1024 if sys.platform.startswith('darwin') else peak
+
+class _Span(object):
+	__slots__ = ('name', 'detail', 'thread', 'start', 'wall', 'cpu', 'peak_rss_kb',
+			'files_read', 'files_written', 'bytes_read', 'bytes_written', 'subprocesses')
+
+	def __init__(self, name, detail):
+		self.name = name
+		self.detail = detail
+		self.thread = threading.current_thread().ident
+		self.start = time.time()
+		self.wall = self.cpu = 0.0
+		self.peak_rss_kb = None
+		self.files_read = set()
+		self.files_written = set()
+		self.bytes_read = self.bytes_written = 0
+		self.subprocesses = []
+
+class Tracer(object):
+	def __init__(self, log=None):
+		self.log = log if log is not None else LOG
+		self.spans = []
+		self._lock = threading.Lock()
+		self._epoch = time.time()
+
+	@contextmanager
+	def span(self, func_name, args, kw):
+		'Measure the task run inside this context'
+		detail = '{0}({1}, {2})'.format(func_name, args, kw)
+		span = _Span(func_name, detail)
+		outer, _local.span = _current_span(), span
+		cpu_start = _cpu_time()
+		try:
+			yield span
+		finally:
+			span.wall = time.time() - span.start
+			span.cpu = _cpu_time() - cpu_start
+			span.peak_rss_kb = _peak_rss_kb()
+			_local.span = outer
+			with self._lock:
+				self.spans.append(span)
+
+	def write_chrome_trace(self, filename):
+		'''Write the spans recorded so far in Chrome's trace event format
+
+		(load into chrome://tracing)
+		'''
+		pid = os.getpid()
+		events = []
+		for span in self.spans:
+			events.append({
+				'name': span.name,
+				'cat': 'task',
+				'ph': 'X',
+				'pid': pid,
+				'tid': span.thread,
+				'ts': int((span.start - self._epoch) * 1e6),
+				'dur': int(span.wall * 1e6),
+				'args': {
+					'step': span.detail,
+					'cpu_s': round(span.cpu, 6),
+					'peak_rss_kb': span.peak_rss_kb,
+					'files_read': len(span.files_read),
+					'files_written': len(span.files_written),
+					'bytes_read': span.bytes_read,
+					'bytes_written': span.bytes_written,
+					'subprocesses': span.subprocesses,
+				},
+			})
+		with open(filename, 'w') as trace_file:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, trace_file)
+
+	def summary(self):
+		'Lines of a table of time spent in each task, most expensive first'
+		totals = {}
+		for span in self.spans:
+			total = totals.setdefault(span.name, {
+				'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'rss': 0, 'read': 0, 'written': 0, 'bytes': 0, 'procs': 0,
+			})
+			total['calls'] += 1
+			total['wall'] += span.wall
+			total['cpu'] += span.cpu
+			total['rss'] = max(total['rss'], span.peak_rss_kb or 0)
+			total['read'] += len(span.files_read)
+			total['written'] += len(span.files_written)
+			total['bytes'] += span.bytes_read + span.bytes_written
+			total['procs'] += len(span.subprocesses)
+
+		row = '{0:<28} {1:>5} {2:>9} {3:>9} {4:>10} {5:>7} {6:>7} {7:>9} {8:>5}'
+		lines = [row.format('task', 'calls', 'wall s', 'cpu s', 'peak RSS', 'read', 'written', 'MB moved', 'procs')]
+		for name, total in sorted(totals.items(), key=lambda item: item[1]['wall'], reverse=True):
+			lines.append(row.format(
+				name, total['calls'],
+				'%.3f' % total['wall'], '%.3f' % total['cpu'],
+				'%dK' % total['rss'],
+				total['read'], total['written'],
+				'%.2f' % (total['bytes'] / (1024.0 * 1024)),
+				total['procs'],
+			))
+		return lines
+
+	def report(self, filename):
+		'Write the Chrome trace to ``filename`` and log the summary table'
+		self.write_chrome_trace(filename)
+		self.log.info('wrote build trace to {0}'.format(filename))
+		self.log.info('time spent in each task:\n' + '\n'.join(self.summary()))
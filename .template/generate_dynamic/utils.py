@@ -1,14 +1,26 @@
 # XXX should consolidate this with lib
+from collections import deque, OrderedDict
 import logging
 from os import path
+import Queue
 import subprocess
-import StringIO
+import sys
+import threading
+import time
 import lib
-
-from genshi.template import NewTextTemplate
+import tracing
+from versioned_config import VersionedDict
 
 LOG = logging.getLogger(__name__)
 
+# how many compiled templates render_string remembers
+_TEMPLATE_CACHE_SIZE = 256
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+# anything Genshi's text templates would change: expressions, directives, comments, and
+# escapes (line continuations, and a doubled backslash for a single one)
+_TEMPLATE_MARKERS = ('$', '{%', '{#', '\\\n', '\\\r\n', '\\\\')
+
 class ShellError(lib.BASE_EXCEPTION):
 	def __init__(self, message, output):
 		self.message = message
@@ -38,11 +50,89 @@ def transform(data, node_steps, fn):
 	:param node_steps: dot-separated data path, e.g. my_dict.[].*.target_key
 	:param fn: mutating function - will be passed the data found at the end
 		``node_steps``, and should return the desired new value
+	:return: a (shallow) copy of ``data`` with the changes made, or ``data`` itself,
+		changed in place, if it's a :class:`versioned_config.VersionedDict`
+	'''
+	return transform_many(data, (node_steps,), fn)
+
+def transform_many(data, paths, fn):
+	'''As :func:`transform`, for several paths at once, in a single traversal of ``data``
+
+	Where one path leads inside a node another path changes, the changes are made in
+	the order the paths are given.
+
+	:param paths: sequence of dot-separated data paths
 	'''
-	obj = data.copy()
-	list(_handle_all(obj, node_steps.split('.'), fn))
+	# versioned dicts keep track of changes themselves, so needn't be copied to be safe
+	obj = data if isinstance(data, VersionedDict) else data.copy()
+	_walk(obj, _path_tree(tuple(paths)), fn)
 	return obj
 
+class _PathNode(object):
+	'One step in a tree of merged data paths'
+	__slots__ = ('order', 'terminals', 'children')
+
+	def __init__(self, order):
+		# index of the first path to pass through this node
+		self.order = order
+		# indices of the paths ending here
+		self.terminals = []
+		# list of (step, _PathNode), in path order
+		self.children = []
+
+	def child(self, step, order):
+		for existing_step, node in self.children:
+			if existing_step == step:
+				return node
+		node = _PathNode(order)
+		self.children.append((step, node))
+		return node
+
+# tuple of paths -> _PathNode
+_path_trees = {}
+
+def _path_tree(paths):
+	'Merge data paths into a prefix tree, compiled once for each distinct set of paths'
+	tree = _path_trees.get(paths)
+	if tree is None:
+		tree = _PathNode(0)
+		for index, node_steps in enumerate(paths):
+			node = tree
+			for step in node_steps.split('.'):
+				node = node.child(step, index)
+			node.terminals.append(index)
+		_path_trees[paths] = tree
+	return tree
+
+def _walk(obj, tree, fn):
+	for step, node in tree.children:
+		if node.children and (not node.terminals or node.children[0][1].order < node.terminals[0]):
+			_descend(obj, step, node, fn)
+			for _ in node.terminals:
+				_apply(obj, step, fn)
+		else:
+			for _ in node.terminals:
+				_apply(obj, step, fn)
+			_descend(obj, step, node, fn)
+
+def _descend(obj, step, node, fn):
+	if node.children:
+		for value in _yield_any(obj, step):
+			_walk(value, node, fn)
+
+def _apply(obj, step, fn):
+	'Change the data a path ending with ``step`` leads to, in ``obj``'
+	if step == '*':
+		assert hasattr(obj, 'iteritems'), 'Expecting a dictionary, got %s' % obj
+		recurse_dict(obj, fn)
+	elif step == '[]':
+		assert hasattr(obj, '__iter__'), 'Expecting an array, got %s' % obj
+		for i, x in enumerate(obj):
+			obj[i] = fn(x)
+	else:
+		if hasattr(obj, '__contains__') and step in obj:
+			obj[step] = fn(obj[step])
+
 def _yield_plain(obj, name):
 	'If obj is a dictionary, yield an attribute'
 	if hasattr(obj, '__contains__') and name in obj:
@@ -75,24 +165,6 @@ def recurse_dict(dictionary, fn):
 			recurse_dict(value, fn)
 		else:
 			dictionary[key] = fn(value)
-
-def _handle_all(obj, steps, fn):
-	if len(steps) > 1:
-		for value in _yield_any(obj, steps[0]):
-			for x in _handle_all(value, steps[1:], fn):
-				yield x
-	else:
-		step = steps[0]
-		if step == '*':
-			assert hasattr(obj, 'iteritems'), 'Expecting a dictionary, got %s' % obj
-			recurse_dict(obj, fn)
-		elif step == '[]':
-			assert hasattr(obj, '__iter__'), 'Expecting an array, got %s' % obj
-			for i, x in enumerate(obj):
-				obj[i] = fn(x)
-		else:
-			if hasattr(obj, '__contains__') and step in obj:
-				obj[step] = fn(obj[step])
 	
 # # # # # # # # # # # # # # # # # # # 
 #
@@ -106,13 +178,39 @@ def render_string(config, in_s):
 	:param config: data dictionary
 	:param in_s: genshi template
 	'''
-	tmpl = NewTextTemplate(in_s)
+	if isinstance(in_s, basestring) and not any(marker in in_s for marker in _TEMPLATE_MARKERS):
+		# nothing to render: return what Genshi would (which is '' for an empty template)
+		if not in_s:
+			return ''
+		return in_s if isinstance(in_s, unicode) else in_s.decode('utf-8')
+	tmpl = _compiled_template(in_s)
 
 	# older versions of python don't allow unicode keyword arguments
 	# so we have to encode the keys (for best compatibility in the client side tools)
-	config = _encode_unicode_keys(config)
+	if isinstance(config, VersionedDict):
+		config = config.cached('keywords', lambda: _encode_unicode_keys(config))
+	else:
+		config = _encode_unicode_keys(config)
 	return tmpl.generate(**config).render('text')
 
+def _compiled_template(in_s):
+	'The Genshi template for a string, compiled at most once while it\'s in use'
+	with _templates_lock:
+		tmpl = _templates.pop(in_s, None)
+		if tmpl is not None:
+			# most recently used goes to the end
+			_templates[in_s] = tmpl
+			return tmpl
+
+	# genshi import must be done here: it's slow to import, and most strings aren't templates
+	from genshi.template import NewTextTemplate
+	tmpl = NewTextTemplate(in_s)
+	with _templates_lock:
+		_templates[in_s] = tmpl
+		while len(_templates) > _TEMPLATE_CACHE_SIZE:
+			_templates.popitem(last=False)
+	return tmpl
+
 def _encode_unicode_keys(dictionary):
 	'''Returns a new dictionary constructed from the given one, but with the keys encoded as strings.
 	:param dictionary: dictionary to encode the keys for
@@ -129,27 +227,142 @@ def _resolve_url(config, url, prefix):
 	else:
 		return prefix + url if url.startswith('/') else prefix + '/' + url
 
+# how many lines of a command's output run_shell keeps, by default
+DEFAULT_TAIL_LINES = 10000
+
+class _ShellProcess(object):
+	'''A running command, whose output is read (and logged) on a thread of its own,
+	keeping only the last ``tail_lines`` lines'''
+	def __init__(self, args, env=None, tail_lines=DEFAULT_TAIL_LINES, command_log_level=logging.DEBUG, prefix=None):
+		self.args = args
+		self.command_log_level = command_log_level
+		self.prefix = '[{0}] '.format(prefix) if prefix else ''
+		self.lines = deque(maxlen=tail_lines)
+		self.lines_dropped = 0
+
+		LOG.debug('{prefix}Running: {cmd}'.format(prefix=self.prefix, cmd=" ".join(args)))
+		tracing.record_subprocess(args)
+		self.proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+		self._reader = threading.Thread(target=self._read, name='output of {0}'.format(path.basename(args[0])))
+		self._reader.daemon = True
+		self._reader.start()
+
+	def _read(self):
+		for line in iter(self.proc.stdout.readline, ''):
+			if len(self.lines) == self.lines.maxlen:
+				self.lines_dropped += 1
+			self.lines.append(line)
+			LOG.log(self.command_log_level, self.prefix + line.rstrip('\r\n'))
+		self.proc.stdout.close()
+
+	def wait(self, timeout=None):
+		'''Wait for the command to finish, killing it if it takes more than ``timeout`` seconds
+
+		:return: ``(return code, output)``, where the return code is ``None`` if it timed out
+		'''
+		deadline = time.time() + timeout if timeout is not None else None
+		# joining in short steps lets KeyboardInterrupt through
+		while self._reader.is_alive():
+			remaining = deadline - time.time() if deadline is not None else 1
+			if remaining <= 0:
+				LOG.debug('{0}{1} took more than {2}s: killing it'.format(self.prefix, self.args[0], timeout))
+				self._kill()
+				self._reader.join()
+				return None, self.output()
+			self._reader.join(min(remaining, 1))
+		return self.proc.wait(), self.output()
+
+	def _kill(self):
+		try:
+			self.proc.kill()
+		except OSError:
+			# already finished
+			pass
+		self.proc.wait()
+
+	def output(self):
+		output = ''.join(self.lines)
+		if self.lines_dropped:
+			output = '[{0} earlier lines dropped]\n{1}'.format(self.lines_dropped, output)
+		return output
+
 def run_shell(*args, **kw):
-	fail_silently = kw.get('fail_silently', False)
-	command_log_level = kw.get("command_log_level", logging.DEBUG)
+	'''Run a command, logging its output as it goes, and return the output
 
-	LOG.debug('Running: {cmd}'.format(cmd=" ".join(args)))
-	proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=kw.get('env'))
-	output = StringIO.StringIO()
+	:param fail_silently: don't raise :class:`ShellError` if the command fails
+	:param command_log_level: level to log each line of output at
+	:param env: environment to run the command with
+	:param tail_lines: how many lines of output to keep (``None``: all of them)
+	:param timeout: kill the command if it takes longer than this many seconds
+	:param prefix: put in front of each line of output logged
+	'''
+	fail_silently = kw.get('fail_silently', False)
+	timeout = kw.get('timeout')
 
-	for line in iter(proc.stdout.readline, ''):
-		output.write(line)
-		LOG.log(command_log_level, line.rstrip('\r\n'))
+	process = _ShellProcess(args,
+		env=kw.get('env'),
+		tail_lines=kw.get('tail_lines', DEFAULT_TAIL_LINES),
+		command_log_level=kw.get("command_log_level", logging.DEBUG),
+		prefix=kw.get('prefix'),
+	)
+	returncode, output = process.wait(timeout)
 
-	if proc.wait() != 0:
+	if returncode != 0:
 		if fail_silently:
 			LOG.debug('Failed to run %s, but was told to carry on anyway' % subprocess.list2cmdline(args))
+		elif returncode is None:
+			raise ShellError(
+				message = "Timed out after {timeout}s when running {command}".format(timeout=timeout, command=args[0]),
+				output = output
+			)
 		else:
 			raise ShellError(
 				message = "Failed when running {command}".format(command=args[0]),
-				output = output.getvalue()
+				output = output
 			)
-	return output.getvalue()
+	return output
+
+def run_shells(commands, jobs=None, **kw):
+	'''Run several commands at the same time, each as :func:`run_shell` would
+
+	Output is logged as it arrives, each line prefixed with the name of its command.
+	If any of the commands fail, the first failure is raised once they have all finished.
+
+	:param commands: list of ``(name, args)`` pairs
+	:param jobs: how many commands to run at once (default: all of them)
+	:param kw: as for :func:`run_shell`
+	:return: list of the commands' outputs, in the same order as ``commands``
+	'''
+	todo = Queue.Queue()
+	for index, (name, args) in enumerate(commands):
+		todo.put((index, name, args))
+	outputs = [None] * len(commands)
+	failures = []
+
+	def worker():
+		while True:
+			try:
+				index, name, args = todo.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				outputs[index] = run_shell(*args, **dict(kw, prefix=name))
+			except Exception:
+				failures.append((index, sys.exc_info()))
+
+	workers = [threading.Thread(target=worker, name='run_shells-%d' % i) for i in range(jobs or len(commands))]
+	for thread in workers:
+		thread.daemon = True
+		thread.start()
+	for thread in workers:
+		# joining in short steps lets KeyboardInterrupt through
+		while thread.is_alive():
+			thread.join(1)
+
+	if failures:
+		_, exc_info = min(failures)
+		raise exc_info[0], exc_info[1], exc_info[2]
+	return outputs
 
 def path_to_lib():
 	return path.abspath(path.join(
@@ -0,0 +1,145 @@
+'''Containers which know when they, or anything inside them, have changed.
+
+``build.config`` is a :class:`VersionedDict`. Every dictionary and list nested inside
+it is wrapped too, and shares its *generation*, which changes whenever any of them is
+changed. Things derived from the whole configuration (e.g. the keyword arguments
+:func:`utils.render_string` passes to Genshi) can then be worked out once per
+generation with :meth:`VersionedDict.cached`, instead of once per use.
+'''
+import itertools
+import threading
+
+# next() on a count is atomic, so no two changes can get the same generation
+_generations = itertools.count(1)
+
+class _Root(object):
+	'State shared by a :class:`VersionedDict` and everything nested inside it'
+	__slots__ = ('generation', 'views', 'lock')
+
+	def __init__(self):
+		self.generation = next(_generations)
+		self.views = {}
+		self.lock = threading.Lock()
+
+	def bump(self):
+		self.generation = next(_generations)
+
+def _wrap(value, root):
+	if isinstance(value, (VersionedDict, VersionedList)) and value._root is root:
+		return value
+	if isinstance(value, dict):
+		return VersionedDict(value, _root=root)
+	if isinstance(value, list):
+		return VersionedList(value, _root=root)
+	return value
+
+# the generation is always bumped *after* a change: a view worked out while a change
+# is being made will then be thrown away
+
+def _changes(method_name, base):
+	method = getattr(base, method_name)
+
+	def changing(self, *args, **kw):
+		try:
+			return method(self, *args, **kw)
+		finally:
+			self._root.bump()
+	changing.__name__ = method_name
+	return changing
+
+class VersionedDict(dict):
+	def __init__(self, data=(), _root=None):
+		'''
+		:param data: a dictionary to copy (deeply, as far as dictionaries and lists go)
+		'''
+		super(VersionedDict, self).__init__()
+		self._root = _root if _root is not None else _Root()
+		for key, value in dict(data).iteritems():
+			dict.__setitem__(self, key, _wrap(value, self._root))
+
+	@property
+	def generation(self):
+		'Changes whenever this, or anything nested inside it, changes'
+		return self._root.generation
+
+	def cached(self, name, compute):
+		'''The value of ``compute()``, worked out again only if we've changed since the last time
+
+		:param name: what the value is: different views must have different names
+		:param compute: function of no arguments
+		'''
+		root = self._root
+		generation = root.generation
+		with root.lock:
+			view = root.views.get((id(self), name))
+		if view is not None and view[0] == generation:
+			return view[1]
+		value = compute()
+		with root.lock:
+			root.views[(id(self), name)] = (generation, value)
+		return value
+
+	def __setitem__(self, key, value):
+		dict.__setitem__(self, key, _wrap(value, self._root))
+		self._root.bump()
+
+	def setdefault(self, key, default=None):
+		if key not in self:
+			self[key] = default
+		return dict.__getitem__(self, key)
+
+	def update(self, *args, **kw):
+		for key, value in dict(*args, **kw).iteritems():
+			self[key] = value
+
+	__delitem__ = _changes('__delitem__', dict)
+	clear = _changes('clear', dict)
+	pop = _changes('pop', dict)
+	popitem = _changes('popitem', dict)
+
+	def __repr__(self):
+		return dict.__repr__(self)
+
+class VersionedList(list):
+	def __init__(self, data=(), _root=None):
+		super(VersionedList, self).__init__()
+		self._root = _root if _root is not None else _Root()
+		list.extend(self, (_wrap(value, self._root) for value in data))
+
+	def __setitem__(self, index, value):
+		if isinstance(index, slice):
+			value = [_wrap(item, self._root) for item in value]
+		else:
+			value = _wrap(value, self._root)
+		list.__setitem__(self, index, value)
+		self._root.bump()
+
+	def __setslice__(self, start, end, values):
+		self[max(start, 0):max(end, 0)] = values
+
+	def append(self, value):
+		list.append(self, _wrap(value, self._root))
+		self._root.bump()
+
+	def extend(self, values):
+		list.extend(self, [_wrap(value, self._root) for value in values])
+		self._root.bump()
+
+	def insert(self, index, value):
+		list.insert(self, index, _wrap(value, self._root))
+		self._root.bump()
+
+	def __iadd__(self, values):
+		self.extend(values)
+		return self
+
+	__delitem__ = _changes('__delitem__', list)
+	__delslice__ = _changes('__delslice__', list)
+	__imul__ = _changes('__imul__', list)
+	pop = _changes('pop', list)
+	remove = _changes('remove', list)
+	reverse = _changes('reverse', list)
+	sort = _changes('sort', list)
+
+	def __repr__(self):
+		return list.__repr__(self)
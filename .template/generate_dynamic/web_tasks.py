@@ -1,6 +1,7 @@
 import socket
 import time
 import errno
+import hashlib
 import json
 import logging
 import os
@@ -20,6 +21,18 @@ from utils import run_shell, ShellError
 
 LOG = logging.getLogger(__name__)
 
+# node_modules trees installed before, shared between apps: one per dependencies key
+NPM_CACHE = path.expanduser(path.join('~', '.forge', 'npm-cache'))
+# what node_modules was installed for
+_NPM_STAMP = path.join('node_modules', '.forge-stamp')
+
+DEFAULT_PORT = 3000
+# the port the local server was last started on, which may not be the one asked for
+_PORT_FILE = path.join('development', '.forge-cache', 'web', 'port')
+# how long to wait for the local server to stop, or to start answering requests
+_STOP_TIMEOUT = 5
+_START_TIMEOUT = 60
+
 class WebError(lib.BASE_EXCEPTION):
 	pass
 
@@ -43,6 +56,73 @@ def _port_available(port):
 		if s is not None:
 			s.close()
 
+def _wait_for(condition, timeout, stop=None):
+	'''Check ``condition()`` until it's true, backing off from 10ms to 250ms between checks
+
+	:param stop: a :class:`threading.Event`: give up as soon as it's set
+	:return: whether ``condition()`` came true in time
+	'''
+	deadline = time.time() + timeout
+	delay = 0.01
+	while True:
+		if condition():
+			return True
+		remaining = deadline - time.time()
+		if remaining <= 0 or (stop is not None and stop.is_set()):
+			return False
+		if stop is not None:
+			stop.wait(min(delay, remaining))
+		else:
+			time.sleep(min(delay, remaining))
+		delay = min(delay * 2, 0.25)
+
+def _server_answers(port):
+	'Does something answer HTTP requests on ``port``?'
+	try:
+		requests.get('http://localhost:%d/' % port, timeout=1)
+		return True
+	except requests.exceptions.RequestException:
+		return False
+
+def _free_port():
+	'A port nothing is listening on, chosen by the OS'
+	s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	try:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+	finally:
+		s.close()
+
+def _configured_port(build):
+	port = build.tool_config.get('web.port', DEFAULT_PORT)
+	try:
+		return int(port)
+	except ValueError:
+		raise WebError("web.port should be a number, not {port}".format(port=port))
+
+def _stop_local_server(port):
+	'''Ask a local server started by run_web to stop, and wait until it has
+
+	:return: whether ``port`` is now free
+	'''
+	if _port_available(port):
+		return True
+	LOG.info('Port %d in use, attempting to send a kill signal' % port)
+	try:
+		requests.post('http://localhost:%d/_forge/kill/' % port, timeout=_STOP_TIMEOUT)
+	except requests.exceptions.RequestException as e:
+		# the server may well go away before answering
+		LOG.debug('kill request: {0}'.format(e))
+	return _wait_for(lambda: _port_available(port), _STOP_TIMEOUT)
+
+def _open_when_ready(port, stop):
+	'Open the local server in a browser, once it answers requests'
+	if _wait_for(lambda: _server_answers(port), _START_TIMEOUT, stop):
+		LOG.info("Attempting to open browser at http://localhost:%d/" % port)
+		_open_url("http://localhost:%d/" % port)
+	elif not stop.is_set():
+		LOG.warning("The local server isn't answering on port %d: not opening a browser" % port)
+
 def _npm(*args, **kw):
 	if sys.platform.startswith("win"):
 		npm = "npm.cmd"
@@ -54,47 +134,108 @@ def _npm(*args, **kw):
 	except OSError as e:
 		if e.errno == errno.ENOENT:
 			raise WebError("failed to run npm: do you have Node.js installed and on your path?")
+		raise
+
+def _node_version():
+	try:
+		return run_shell('node', '--version', fail_silently=True).strip()
+	except OSError:
+		return ''
+
+def _dependencies_key():
+	'Hash of everything npm install depends on: package.json (and any shrinkwrap), and the Node version'
+	sha = hashlib.sha1()
+	for name in ('package.json', 'npm-shrinkwrap.json'):
+		if path.isfile(name):
+			with open(name, 'rb') as dependencies_file:
+				sha.update('{0}\0{1}\0'.format(name, dependencies_file.read()))
+	sha.update(_node_version())
+	return sha.hexdigest()
+
+def _save_to_npm_cache(cached):
+	'Copy node_modules into the shared cache, for other apps and checkouts with the same dependencies'
+	tmp_dir = '{0}.{1}.tmp'.format(path.dirname(cached), os.getpid())
+	try:
+		shutil.copytree('node_modules', path.join(tmp_dir, 'node_modules'), symlinks=True)
+		# another process may have got there first: theirs will do just as well
+		os.rename(tmp_dir, path.dirname(cached))
+	except (EnvironmentError, shutil.Error), e:
+		LOG.debug("Couldn't add node_modules to the npm cache: {0}".format(e))
+	finally:
+		if path.isdir(tmp_dir):
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _npm_install(build):
+	'''npm install, in the current directory, unless node_modules is already up to date
+
+	node_modules is up to date if it's stamped with the current dependencies key. If it
+	isn't, but the shared cache has a tree for that key, it's copied from there.
+	'''
+	key = _dependencies_key()
+	try:
+		with open(_NPM_STAMP) as stamp_file:
+			if stamp_file.read().strip() == key:
+				LOG.debug('Dependencies unchanged since the last npm install')
+				return
+	except IOError:
+		pass
+
+	cache_dir = build.tool_config.get('web.npm_cache', NPM_CACHE)
+	if cache_dir:
+		cache_dir = path.join(build.orig_wd, path.expanduser(cache_dir))
+	cached = path.join(cache_dir, key, 'node_modules') if cache_dir else None
+	if cached and path.isdir(cached):
+		LOG.info('Copying node_modules from {0}'.format(cached))
+		if path.lexists('node_modules'):
+			shutil.rmtree('node_modules')
+		shutil.copytree(cached, 'node_modules', symlinks=True)
+		return
+
+	_npm("install")
+	with open(_NPM_STAMP, 'w') as stamp_file:
+		stamp_file.write(key)
+	if cached:
+		if not path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+		_save_to_npm_cache(cached)
 
 @task
 def clean_web(build):
-	# TODO: port should be a parameter/configuration
-	port = 3000
-	requests.post('http://localhost:%d/_forge/kill/' % port)
-	time.sleep(1)
+	try:
+		with open(_PORT_FILE) as port_file:
+			port = int(port_file.read())
+	except (IOError, ValueError):
+		port = _configured_port(build)
+	if not _stop_local_server(port):
+		LOG.warning("The local server on port %d didn't stop" % port)
 
 @task
 def run_web(build):
 	# run Node locally
-	# TODO: port should be a parameter/configuration
-	port = 3000
-
-	def show_local_server():
-		LOG.info("Attempting to open browser at http://localhost:%d/" % port)
-		_open_url("http://localhost:%d/" % port)
+	port = _configured_port(build)
+	if not _stop_local_server(port):
+		fallback = _free_port()
+		LOG.warning("Port %d is in use: using port %d instead" % (port, fallback))
+		port = fallback
+
+	port_dir = path.dirname(_PORT_FILE)
+	if not path.isdir(port_dir):
+		os.makedirs(port_dir)
+	with open(_PORT_FILE, 'w') as port_file:
+		port_file.write(str(port))
 
 	with cd(path.join("development", "web")):
-		timer = None
+		stop = threading.Event()
 		try:
-			_npm("install")
-
-			attempts = 0
-			while not _port_available(port):
-				LOG.info('Port still in use, attempting to send a kill signal')
-				#TODO: appropriate timeout and handling
-				requests.post('http://localhost:%d/_forge/kill/' % port)
+			_npm_install(build)
 
-				time.sleep(1)
-
-				attempts += 1
-				if attempts > 5:
-					raise WebError("Port %d seems to be in use, you should specify a different port to use" % port)
-
-			timer = threading.Timer(3, show_local_server).start()
+			opener = threading.Thread(target=_open_when_ready, args=(port, stop))
+			opener.daemon = True
+			opener.start()
 			_npm("start", command_log_level=logging.INFO, env=dict(os.environ, PORT=str(port), FORGE_DEBUG='1'))
 
 		finally:
-			if timer:
-				timer.cancel()
+			stop.set()
 
 def _git(cmd, *args, **kwargs):
 	"""Runs a git command and scrapes the output for common problems, so that we can try
@@ -103,7 +244,8 @@ def _git(cmd, *args, **kwargs):
 	e.g. _git('push', '--all')
 	"""
 	try:
-		output = run_shell('git', cmd, *args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
+		# keep all the output: callers parse it
+		output = run_shell('git', cmd, *args, tail_lines=None, **kwargs)
 	except OSError as e:
 		if e.errno == errno.ENOENT:
 			# TODO: download portable copy of git/locate git?
@@ -296,23 +438,11 @@ def package_web(build):
 					build_config.save_local(local_config)
 
 
-		# remove all previous files/folders except for .git!
-		with cd(output):
-			for f in os.listdir('.'):
-				if not f == '.git':
-					if path.isfile(f):
-						os.remove(f)
-
-					elif path.isdir(f):
-						shutil.rmtree(f)
-
-		# copy code from development to release!
-		with cd(development):
-			for f in os.listdir('.'):
-				if path.isfile(f):
-					shutil.copy2(f, output)
-				elif path.isdir(f) and path.basename(f) != '.git':
-					shutil.copytree(f, path.join(output, f), ignore=shutil.ignore_patterns('.git'))
+		# bring release in line with development, leaving .git and unchanged files alone, so
+		# that git can tell what has changed from its index without reading every file
+		copied, unchanged, deleted = copying.copy_tree(development, output,
+				ignore=shutil.ignore_patterns('.git'), mode='sync', log=LOG, keep=['.git'])
+		LOG.debug('Updated {0} files in {1}, removed {2}: {3} were unchanged'.format(copied, output, deleted, unchanged))
 
 		with cd(output):
 			# setup with the specified remote
@@ -327,9 +457,8 @@ def package_web(build):
 			_git('remote', 'add', 'heroku', 'git@heroku.com:%s.git' % chosen_app)
 
 			# commit
-			_git('add', '.')
-			diff = _git('diff', 'HEAD')
-			if not diff.strip():
+			changes = _git('status', '--porcelain')
+			if not changes.strip():
 				if interactive:
 					LOG.warning("No app changes detected: did you forget to forge build?")
 				else:
@@ -337,6 +466,7 @@ def package_web(build):
 					# doesn't really make sense
 					LOG.warning("No app changes detected, pushing to heroku anyway")
 			else:
+				_git('add', '.')
 				_git('commit', '-am', 'forge package web')
 
 			# push
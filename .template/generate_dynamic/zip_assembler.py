@@ -0,0 +1,154 @@
+'''Write zip archives (APKs, IPAs) entry by entry, re-using entries from earlier archives.
+
+:class:`ZipAssembler` can copy an entry's compressed bytes straight out of another
+archive, without decompressing and compressing it again.
+
+Only what our packages need is supported: no ZIP64, encryption or data descriptors.
+'''
+import struct
+import zlib
+
+import lib
+
+_LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+_LOCAL_HEADER_SIGNATURE = 0x04034b50
+_CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+_CENTRAL_HEADER_SIGNATURE = 0x02014b50
+_END_RECORD = struct.Struct('<IHHHHIIH')
+_END_RECORD_SIGNATURE = 0x06054b50
+
+STORED = 0
+DEFLATED = 8
+
+# version 2.0: deflate
+_VERSION = 20
+# "made by" Unix, so that external attributes hold permissions and file types
+_MADE_BY_UNIX = 3 << 8
+_UTF8_FLAG = 0x800
+_CHUNK_SIZE = 64 * 1024
+_MAX_SIZE = 0xffffffff
+
+class ZipAssemblyError(lib.BASE_EXCEPTION):
+	pass
+
+def _dos_date_time(date_time):
+	year, month, day, hours, minutes, seconds = date_time[:6]
+	dos_date = (max(year, 1980) - 1980) << 9 | month << 5 | day
+	dos_time = hours << 11 | minutes << 5 | seconds // 2
+	return dos_date, dos_time
+
+def compress(data, method=DEFLATED):
+	'''Compress ``data`` as it would be stored in a zip archive
+
+	Safe to call from several threads at once.
+
+	:return: ``(compressed bytes, CRC-32, uncompressed size)``
+	'''
+	crc = zlib.crc32(data) & 0xffffffff
+	if method == STORED:
+		return data, crc, len(data)
+	# negative window bits: raw deflate, no zlib header
+	compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+	return compressor.compress(data) + compressor.flush(), crc, len(data)
+
+class ZipAssembler(object):
+	def __init__(self, filename):
+		'''
+		:param filename: archive to write
+		'''
+		self.filename = filename
+		self._out = open(filename, 'wb')
+		self._central_directory = []
+		self._names = set()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self._out.close()
+
+	def add_compressed(self, name, data, crc, size, method=DEFLATED, date_time=(1980, 1, 1, 0, 0, 0), external_attr=0):
+		'''Add an entry whose data is already compressed (e.g. by :func:`compress`)
+
+		:param name: name of the entry in the archive
+		:param data: compressed bytes
+		:param crc: CRC-32 of the uncompressed data
+		:param size: size of the uncompressed data
+		:param method: :data:`STORED` or :data:`DEFLATED`
+		:param date_time: ``(year, month, day, hours, minutes, seconds)``
+		:param external_attr: e.g. Unix mode bits shifted left 16
+		'''
+		self._write_header(name, crc, len(data), size, method, date_time, external_attr)
+		self._out.write(data)
+
+	def add_bytes(self, name, data, method=DEFLATED, date_time=(1980, 1, 1, 0, 0, 0), external_attr=0):
+		'Add an entry from uncompressed bytes'
+		compressed, crc, size = compress(data, method)
+		self.add_compressed(name, compressed, crc, size, method, date_time, external_attr)
+
+	def copy_entry(self, source, info):
+		'''Copy an entry from another archive, as it is: compressed data isn't touched
+
+		:param source: a :class:`zipfile.ZipFile` open for reading
+		:param info: the :class:`zipfile.ZipInfo` for the entry in ``source``
+		'''
+		if info.flag_bits & 0x1:
+			raise ZipAssemblyError("can't copy encrypted entry {0}".format(info.filename))
+		source_file = source.fp
+		source_file.seek(info.header_offset)
+		header = source_file.read(_LOCAL_HEADER.size)
+		fields = _LOCAL_HEADER.unpack(header)
+		if fields[0] != _LOCAL_HEADER_SIGNATURE:
+			raise ZipAssemblyError('bad local header for {0}'.format(info.filename))
+		name_length, extra_length = fields[-2:]
+		source_file.seek(info.header_offset + _LOCAL_HEADER.size + name_length + extra_length)
+
+		self._write_header(info.filename, info.CRC, info.compress_size, info.file_size,
+				info.compress_type, info.date_time, info.external_attr)
+		remaining = info.compress_size
+		while remaining:
+			chunk = source_file.read(min(remaining, _CHUNK_SIZE))
+			if not chunk:
+				raise ZipAssemblyError('{0} is truncated'.format(info.filename))
+			self._out.write(chunk)
+			remaining -= len(chunk)
+
+	def _write_header(self, name, crc, compressed_size, size, method, date_time, external_attr):
+		if isinstance(name, unicode):
+			name = name.encode('utf-8')
+			flags = _UTF8_FLAG
+		else:
+			flags = 0
+		if name in self._names:
+			raise ZipAssemblyError('duplicate entry {0}'.format(name))
+		self._names.add(name)
+
+		offset = self._out.tell()
+		if max(offset, compressed_size, size) > _MAX_SIZE:
+			raise ZipAssemblyError('{0} is too big: ZIP64 is not supported'.format(self.filename))
+
+		dos_date, dos_time = _dos_date_time(date_time)
+		self._out.write(_LOCAL_HEADER.pack(
+			_LOCAL_HEADER_SIGNATURE, _VERSION, flags, method, dos_time, dos_date,
+			crc, compressed_size, size, len(name), 0,
+		))
+		self._out.write(name)
+		self._central_directory.append(_CENTRAL_HEADER.pack(
+			_CENTRAL_HEADER_SIGNATURE, _MADE_BY_UNIX | _VERSION, _VERSION, flags, method, dos_time, dos_date,
+			crc, compressed_size, size, len(name), 0, 0, 0, 0, external_attr & 0xffffffff, offset,
+		) + name)
+
+	def close(self):
+		'Write the central directory, and close the archive'
+		start = self._out.tell()
+		for record in self._central_directory:
+			self._out.write(record)
+		end = self._out.tell()
+		count = len(self._central_directory)
+		if count > 0xffff:
+			raise ZipAssemblyError('{0} has too many entries: ZIP64 is not supported'.format(self.filename))
+		self._out.write(_END_RECORD.pack(_END_RECORD_SIGNATURE, 0, 0, count, count, end - start, start, 0))
+		self._out.close()
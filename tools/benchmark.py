@@ -0,0 +1,371 @@
+'''End-to-end benchmark of :func:`customer_goals.generate_app_from_template`.
+
+Generates synthetic apps of a configurable shape, builds them for each set of
+platforms with external toolchains (jsl, makensis, biplist, the tracking call)
+stubbed out, and reports throughput and per-phase timings as JSON. If given a
+baseline, exits non-zero when a phase has regressed past it.
+
+Also reports how long a fresh interpreter takes to import :mod:`generate_dynamic`,
+which platform modules each build caused to be imported, and checks the lazy task
+registry's manifest. ``.template/generate_dynamic/test_imports.py`` holds the import budget.
+
+Run from a checkout with::
+
+	python tools/benchmark.py --files 2000 --depth 4 --baseline bench.json
+'''
+import argparse
+from collections import namedtuple
+from contextlib import contextmanager
+import json
+import logging
+import os
+from os import path
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_TEMPLATE_DIR = path.abspath(path.join(path.dirname(__file__), path.pardir, '.template'))
+if _TEMPLATE_DIR not in sys.path:
+	sys.path.insert(0, _TEMPLATE_DIR)
+
+import generate_dynamic
+
+LOG = logging.getLogger('benchmark')
+
+ALL_PLATFORMS = ('android', 'ios', 'chrome', 'firefox', 'safari', 'ie', 'web')
+
+# tasks which shell out to tools we don't want to measure (or may not have)
+STUBBED_TASKS = ('lint_javascript', 'check_local_config_schema', 'package_ie', 'set_in_biplist')
+
+AppShape = namedtuple('AppShape', 'files depth html_ratio file_size activations')
+
+_HTML = '''<!DOCTYPE html>
+<html>
+<head>
+<title>{title}</title>
+</head>
+<body>
+{body}
+</body>
+</html>
+'''
+
+def _filler(rand, size):
+	words = ('forge', 'trigger', 'weather', 'sunny', 'cloudy', 'activation', 'template', 'platform')
+	text = []
+	length = 0
+	while length < size:
+		word = rand.choice(words)
+		text.append(word)
+		length += len(word) + 1
+	return ' '.join(text)[:size]
+
+def generate_app(app_dir, shape, seed=0):
+	'''Write a synthetic app with ``src/`` laid out according to ``shape``
+
+	:param app_dir: directory to create the app in
+	:param shape: an :class:`AppShape`
+	:param seed: for reproducible file contents
+	'''
+	rand = random.Random(seed)
+	src = path.join(app_dir, 'src')
+	directories = [src]
+	for level in range(1, shape.depth + 1):
+		directories.append(path.join(directories[-1], 'level{0}'.format(level)))
+	for directory in directories:
+		os.makedirs(directory)
+
+	num_html = max(1, int(shape.files * shape.html_ratio))
+	for i in range(shape.files):
+		directory = directories[i % len(directories)]
+		if i == 0:
+			name, contents = path.join(src, 'index.html'), _HTML.format(title='index', body=_filler(rand, shape.file_size))
+		elif i < num_html:
+			name, contents = path.join(directory, 'page{0}.html'.format(i)), _HTML.format(title=i, body=_filler(rand, shape.file_size))
+		else:
+			name, contents = path.join(directory, 'asset{0}.js'.format(i)), '// {0}\n'.format(_filler(rand, shape.file_size))
+		with open(name, 'w') as out_file:
+			out_file.write(contents)
+
+	activations = []
+	os.makedirs(path.join(src, 'activations'))
+	for i in range(shape.activations):
+		script = 'activations/activation{0}.js'.format(i)
+		with open(path.join(src, script), 'w') as out_file:
+			out_file.write('forge.logging.info({0!r});\n'.format(_filler(rand, shape.file_size)))
+		activations.append({'patterns': ['http://*/*'], 'scripts': [script], 'styles': [], 'all_frames': i % 2 == 0})
+
+	config = {
+		'name': 'benchmark',
+		'uuid': 'benchmark{0}'.format(seed),
+		'version': '0.1',
+		'platform_version': 'v1.2',
+		'activations': activations,
+		'browser_action': {'default_popup': 'index.html'},
+	}
+	with open(path.join(src, 'config.json'), 'w') as config_file:
+		json.dump(config, config_file, indent=1)
+	return config
+
+def _development_skeleton(app_dir):
+	'Lay out development/ as the platform templates would, where we have them'
+	development = path.join(app_dir, 'development')
+	if path.isdir(development):
+		shutil.rmtree(development)
+	os.makedirs(development)
+	for platform in ALL_PLATFORMS:
+		template = path.join(_TEMPLATE_DIR, platform)
+		if path.isdir(template):
+			shutil.copytree(template, path.join(development, platform), symlinks=True)
+
+class _StubbedRegistry(generate_dynamic.registry.LazyRegistry):
+	'''Stands in for one of :class:`build.Build`'s registries, with some names replaced or hidden
+
+	Stubbing a task mustn't import the module defining it, or every build would seem to
+	need that module; nor may importing the module later replace the stub.
+
+	:param registry: the :class:`registry.LazyRegistry` to stand in for
+	:param stubs: ``name -> function`` to use instead of what ``registry`` has
+	:param hidden: names to act as if ``registry`` didn't have
+	'''
+	def __init__(self, registry, stubs, hidden=()):
+		replaced = set(stubs) | set(hidden)
+		super(_StubbedRegistry, self).__init__(dict(
+			(name, module_name) for name, module_name in registry.manifest.items() if name not in replaced
+		))
+		self.registry = registry
+		self.replaced = replaced
+		dict.update(self, ((name, function) for name, function in dict.items(registry) if name not in replaced))
+		dict.update(self, stubs)
+
+	def __setitem__(self, name, function):
+		# a module imported while stubbed, registering what it defines
+		dict.__setitem__(self.registry, name, function)
+		if name not in self.replaced:
+			dict.__setitem__(self, name, function)
+
+@contextmanager
+def stubbed_toolchains(marks):
+	'''Replace toolchain tasks with no-ops and add the ``_benchmark_phase`` marker task
+
+	:param marks: list to append ``(phase name, time)`` pairs to
+	'''
+	Build = generate_dynamic.build.Build
+	customer_goals = generate_dynamic.customer_goals
+	original_tasks, original_resources = Build.tasks, Build.task_resources
+	original_log_build = customer_goals.log_build
+
+	def mark_phase(build, name):
+		marks.append((name, time.time()))
+
+	stubs = dict((name, lambda build, *args, **kw: None) for name in STUBBED_TASKS)
+	stubs['_benchmark_phase'] = mark_phase
+	try:
+		Build.tasks = _StubbedRegistry(original_tasks, stubs)
+		# the stubs don't say what they access
+		Build.task_resources = _StubbedRegistry(original_resources, {}, hidden=stubs)
+		customer_goals.log_build = lambda build, action: None
+		yield
+	finally:
+		customer_goals.log_build = original_log_build
+		Build.tasks, Build.task_resources = original_tasks, original_resources
+
+class _PhaseMarkingPhases(object):
+	'Stands in for :mod:`customer_phases`, putting a marker step before each phase'
+	def __getattr__(self, name):
+		phase = getattr(generate_dynamic.customer_phases, name)
+		if name.startswith('_') or not callable(phase):
+			return phase
+
+		def marked_phase(*args, **kw):
+			return [('all', None, '_benchmark_phase', (name,))] + phase(*args, **kw)
+		return marked_phase
+
+class _GenerateModule(object):
+	'Stands in for the :mod:`generate_dynamic` package passed to goals'
+	customer_phases = _PhaseMarkingPhases()
+
+	def __getattr__(self, name):
+		return getattr(generate_dynamic, name)
+
+def _tree_size(directory):
+	files = size = 0
+	for root, _, names in os.walk(directory):
+		for name in names:
+			files += 1
+			size += path.getsize(path.join(root, name))
+	return files, size
+
+_IMPORT_TIMER = '''
+import sys, time
+sys.path.insert(0, {template_dir!r})
+start = time.time()
+import generate_dynamic
+end = time.time()
+print end - start
+print ",".join(sorted(name for name in sys.modules if name.startswith("generate_dynamic.") and sys.modules[name]))
+'''
+
+def import_time(repeat=3):
+	'''Best time a fresh interpreter takes to import :mod:`generate_dynamic`, and the modules it imported'''
+	best, modules = None, None
+	for _ in range(repeat):
+		output = subprocess.check_output([sys.executable, '-c', _IMPORT_TIMER.format(template_dir=_TEMPLATE_DIR)])
+		seconds, modules = output.strip().split('\n')
+		best = float(seconds) if best is None else min(best, float(seconds))
+	return best, modules.split(',')
+
+def _build_command(platforms, extra_args):
+	'Python to build once in a fresh interpreter and print the generate_dynamic modules imported'
+	return '''
+import sys
+sys.path.insert(0, {template_dir!r})
+import benchmark, generate_dynamic
+app_dir, config = sys.argv[1], benchmark.json.load(open(sys.argv[2]))
+benchmark.run_once(app_dir, config, {platforms!r}, {extra_args!r})
+print ",".join(sorted(name for name in sys.modules if name.startswith("generate_dynamic.") and sys.modules[name]))
+'''.format(template_dir=_TEMPLATE_DIR, platforms=tuple(platforms), extra_args=list(extra_args))
+
+def modules_imported(app_dir, config, platforms, extra_args):
+	'''Which :mod:`generate_dynamic` modules building for ``platforms`` imports'''
+	config_file = path.join(app_dir, 'benchmark-config.json')
+	with open(config_file, 'w') as out_file:
+		json.dump(config, out_file)
+	output = subprocess.check_output(
+		[sys.executable, '-c', _build_command(platforms, extra_args), app_dir, config_file],
+		cwd=path.dirname(path.abspath(__file__)),
+	)
+	return output.strip().split('\n')[-1].split(',')
+
+def run_once(app_dir, config, platforms, extra_args):
+	'Build the app once, returning (total seconds, {phase: seconds})'
+	_development_skeleton(app_dir)
+	marks = []
+	with generate_dynamic.lib.cd(app_dir):
+		with stubbed_toolchains(marks):
+			build = generate_dynamic.build.Build(
+				json.loads(json.dumps(config)), app_dir, 'development',
+				enabled_platforms=platforms,
+				forge_root=app_dir,
+				log=logging.getLogger('benchmark.build'),
+				extra_args=list(extra_args),
+			)
+			start = time.time()
+			generate_dynamic.customer_goals.generate_app_from_template(_GenerateModule(), build)
+			end = time.time()
+
+	phases = {}
+	for i, (name, started) in enumerate(marks):
+		finished = marks[i + 1][1] if i + 1 < len(marks) else end
+		phases[name] = phases.get(name, 0.0) + (finished - started)
+	return end - start, phases
+
+def benchmark(shape, platform_sets, repeat=3, extra_args=()):
+	'''Benchmark a synthetic app of the given shape for each set of platforms
+
+	Timings are the best of ``repeat`` runs.
+	'''
+	app_dir = tempfile.mkdtemp(prefix='forge-benchmark-')
+	try:
+		config = generate_app(app_dir, shape)
+		src_files, src_bytes = _tree_size(path.join(app_dir, 'src'))
+
+		results = []
+		for platforms in platform_sets:
+			best_total, best_phases = None, {}
+			for _ in range(repeat):
+				total, phases = run_once(app_dir, config, platforms, extra_args)
+				best_total = total if best_total is None else min(best_total, total)
+				for name, seconds in phases.items():
+					best_phases[name] = min(best_phases.get(name, seconds), seconds)
+
+			# every enabled platform gets its own copy of the user's code
+			files_moved = src_files * len(platforms)
+			bytes_moved = src_bytes * len(platforms)
+			results.append({
+				'platforms': ','.join(platforms),
+				'modules': modules_imported(app_dir, config, platforms, extra_args),
+				'seconds': round(best_total, 4),
+				'files_per_second': round(files_moved / best_total, 1) if best_total else None,
+				'mb_per_second': round(bytes_moved / best_total / (1024 * 1024), 2) if best_total else None,
+				'phases': dict((name, round(seconds, 4)) for name, seconds in best_phases.items()),
+			})
+		return {'shape': shape._asdict(), 'src_files': src_files, 'src_bytes': src_bytes, 'results': results}
+	finally:
+		shutil.rmtree(app_dir, ignore_errors=True)
+
+def regressions(report, baseline, tolerance, slack):
+	'''Phases slower than the baseline by more than ``tolerance`` (a fraction) plus ``slack`` seconds'''
+	previous = dict((result['platforms'], result) for result in baseline.get('results', []))
+	problems = []
+	for result in report['results']:
+		before = previous.get(result['platforms'])
+		if before is None:
+			continue
+		timings = dict(result['phases'], total=result['seconds'])
+		previous_timings = dict(before['phases'], total=before['seconds'])
+		for name, seconds in sorted(timings.items()):
+			if name not in previous_timings:
+				continue
+			limit = previous_timings[name] * (1 + tolerance) + slack
+			if seconds > limit:
+				problems.append('{platforms} {phase}: {now:.4f}s, baseline {then:.4f}s'.format(
+					platforms=result['platforms'], phase=name, now=seconds, then=previous_timings[name],
+				))
+	return problems
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+	parser.add_argument('--files', type=int, default=500, help='number of files in src/')
+	parser.add_argument('--depth', type=int, default=3, help='directory depth of src/')
+	parser.add_argument('--html-ratio', type=float, default=0.2, help='fraction of files which are HTML')
+	parser.add_argument('--file-size', type=int, default=4096, help='approximate size of each file, in bytes')
+	parser.add_argument('--activations', type=int, default=4, help='number of activations in config.json')
+	parser.add_argument('--platforms', action='append',
+			help='comma-separated platforms to build together; may be repeated (default: each alone, then all)')
+	parser.add_argument('--repeat', type=int, default=3, help='take the best of this many runs')
+	parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+	parser.add_argument('--baseline', help='fail if slower than the report in this file')
+	parser.add_argument('--save-baseline', help='write the report here to compare against later')
+	parser.add_argument('--tolerance', type=float, default=0.25, help='fraction slower than baseline allowed')
+	parser.add_argument('--slack', type=float, default=0.02, help='seconds slower than baseline allowed')
+	parser.add_argument('-v', '--verbose', action='store_true')
+	args, extra_args = parser.parse_known_args(argv)
+
+	logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+	if args.platforms:
+		platform_sets = [tuple(platforms.split(',')) for platforms in args.platforms]
+	else:
+		platform_sets = [(platform,) for platform in ALL_PLATFORMS] + [ALL_PLATFORMS]
+
+	shape = AppShape(args.files, args.depth, args.html_ratio, args.file_size, args.activations)
+	# anything we don't recognise is passed to the build as tool configuration, e.g. --general.jobs 4
+	report = benchmark(shape, platform_sets, repeat=args.repeat, extra_args=extra_args)
+	report['import_seconds'], report['import_modules'] = import_time(args.repeat)
+
+	serialised = json.dumps(report, indent=1, sort_keys=True)
+	print serialised
+	for filename in (args.output, args.save_baseline):
+		if filename:
+			with open(filename, 'w') as out_file:
+				out_file.write(serialised)
+
+	failed = False
+	manifest_problems = generate_dynamic.registry.verify(generate_dynamic.build.Build)
+	if manifest_problems:
+		LOG.error('task registry manifest is out of date:\n' + '\n'.join(manifest_problems))
+		failed = True
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			problems = regressions(report, json.load(baseline_file), args.tolerance, args.slack)
+		if problems:
+			LOG.error('phases slower than baseline:\n' + '\n'.join(problems))
+			failed = True
+	return 1 if failed else 0
+
+if __name__ == '__main__':
+	sys.exit(main())